@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+"""A columnar store of the daily report data saved by bq_util.
+
+The reports in email_bq_data draw sparklines from the last two weeks of
+data.  Rather than unpickling a whole day's worth of rows for each day
+just to pull out a number or two per route, we also keep the numeric
+columns of each day's data in a compact columnar file:
+
+    ~/bq_data/history/<report>/keys.json
+        A json list of every key (e.g. url_route) seen on the days we
+        have for this report; a key's position in the list is its id.
+        save_day only ever appends to it, so ids are stable across days;
+        compact() renumbers them when it drops keys no day uses.
+    ~/bq_data/history/<report>/<YYYYMMDD>.columns
+        A small header, then a byte per key id saying whether that key
+        is present on that day, then one array of doubles per numeric
+        column, indexed by key id (NaN where there's no value).
+
+Day files are read via mmap, so getting a column for a day is a single
+array read no matter how many routes there are.  Only the last
+HISTORY_RETENTION_DAYS days are kept; compact(), run daily by
+compact_bq_data.py, deletes older days.
+
+When run as a script, this imports the existing per-day pickles into the
+store.
+"""
+
+import array
+import contextlib
+import datetime
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+
+
+_HISTORY_DIRECTORY = os.path.join(os.getenv('HOME'), 'bq_data', 'history')
+
+# The columns that identify a row, for each report we keep history for.
+REPORT_KEY_COLUMNS = {
+    'instance_hours': ('url_route',),
+    'rpcs': ('url_route',),
+    'out_of_memory_errors_by_module': ('module_id',),
+    'out_of_memory_errors_by_route': ('module_id', 'url_route'),
+    'log_bytes': ('firstword',),
+}
+
+_MAGIC = 'BQHIST01'
+# magic, number of keys, length of the json header.
+_PREAMBLE = struct.Struct('<8sII')
+
+_NAN = float('nan')
+
+# How many days of history compact() keeps.  The reports only draw
+# sparklines of the last two weeks.
+HISTORY_RETENTION_DAYS = 60
+
+_DAY_FILENAME_RE = re.compile(r'^(\d{8})\.columns$')
+
+
+def _report_directory(report):
+    return os.path.join(_HISTORY_DIRECTORY, report)
+
+
+def _day_filename(report, yyyymmdd):
+    return os.path.join(_report_directory(report), yyyymmdd + '.columns')
+
+
+@contextlib.contextmanager
+def _locked_report(report, exclusive=True):
+    """Hold a lock on the report's directory.
+
+    Writers hold it exclusively while they assign ids to new keys and
+    write the day, so that two writers (say a backfill and the nightly
+    run) can't give the same id to different keys.  Readers hold it
+    shared, so they don't see keys renumbered by compact() alongside
+    days that haven't been rewritten yet.  We lock the directory since,
+    unlike the files in it, it's never replaced.
+    """
+    fd = os.open(_report_directory(report), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)        # which releases the lock
+
+
+def _write_file(filename, contents):
+    """Write a file atomically, so readers never see a partial file."""
+    tmp_filename = '%s.tmp.%s' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(contents)
+    os.rename(tmp_filename, filename)
+
+
+def _load_keys(report):
+    """Return the report's keys, in id order."""
+    try:
+        with open(os.path.join(_report_directory(report), 'keys.json')) as f:
+            return [tuple(k) if len(k) > 1 else k[0] for k in json.load(f)]
+    except IOError:
+        return []
+
+
+def _save_keys(report, keys):
+    _write_file(os.path.join(_report_directory(report), 'keys.json'),
+                json.dumps([list(k) if isinstance(k, tuple) else [k]
+                            for k in keys]))
+
+
+def _key(row, key_columns):
+    key = tuple(row[c] for c in key_columns)
+    return key[0] if len(key) == 1 else key
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value,
+                                                                   bool)
+
+
+def has_day(report, yyyymmdd):
+    return os.path.exists(_day_filename(report, yyyymmdd))
+
+
+def save_day(report, yyyymmdd, rows):
+    """Save the numeric columns of a day's rows for a report.
+
+    rows is an iterable of dicts, as returned by bq_util.query_bigquery or
+    query_bigquery_iter; we only keep the numeric values, not the rows.
+    The report must be listed in REPORT_KEY_COLUMNS.  This will clobber
+    any existing data for that day.
+    """
+    key_columns = REPORT_KEY_COLUMNS[report]
+    try:
+        os.makedirs(_report_directory(report))
+    except OSError:
+        if not os.path.isdir(_report_directory(report)):
+            raise
+
+    # We pull out the keys and numbers before taking the lock, so we
+    # don't hold it while the rows stream in.
+    values = [(_key(row, key_columns),
+               {name: value for (name, value) in row.iteritems()
+                if _is_number(value)})
+              for row in rows]
+
+    with _locked_report(report):
+        keys = _load_keys(report)
+        key_ids = {k: i for (i, k) in enumerate(keys)}
+        num_old_keys = len(keys)
+        present = set()
+        columns = {}      # column name -> {key id: value}
+        for (key, numbers) in values:
+            if key not in key_ids:
+                key_ids[key] = len(keys)
+                keys.append(key)
+            key_id = key_ids[key]
+            present.add(key_id)
+            for (name, value) in numbers.iteritems():
+                columns.setdefault(name, {})[key_id] = value
+        if len(keys) > num_old_keys:
+            _save_keys(report, keys)
+        _write_day(report, yyyymmdd, len(keys), present, columns)
+
+
+def _write_day(report, yyyymmdd, num_keys, present, columns):
+    """Write a day file.
+
+    present is the set of key ids present that day, and columns maps
+    each column name to a dict of key id -> value.
+    """
+    names = sorted(columns)
+    header = json.dumps({'columns': names, 'byteorder': sys.byteorder})
+    parts = [_PREAMBLE.pack(_MAGIC, num_keys, len(header)), header]
+    parts.append(''.join('\x01' if i in present else '\x00'
+                         for i in xrange(num_keys)))
+    # Align the columns so they can be read straight out of the mmap.
+    parts.append('\x00' * (-sum(len(p) for p in parts) % 8))
+    for name in names:
+        column = array.array('d', [_NAN]) * num_keys
+        for (key_id, value) in columns[name].iteritems():
+            column[key_id] = value
+        parts.append(column.tostring())
+    _write_file(_day_filename(report, yyyymmdd), ''.join(parts))
+
+
+def _read_day(report, yyyymmdd, columns=None):
+    """Read some columns of a day's data.
+
+    Returns None if we have no data for that day, or else a dict with
+    'present', a string with a (non-NUL) byte per key id present on that
+    day, and an array('d') for each requested column (or, if columns is
+    None, for every column the day has).
+    """
+    try:
+        f = open(_day_filename(report, yyyymmdd), 'rb')
+    except IOError:
+        return None
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:     # an empty file
+            return None
+    try:
+        (magic, num_keys, header_len) = _PREAMBLE.unpack_from(mm, 0)
+        if magic != _MAGIC:
+            return None
+        offset = _PREAMBLE.size
+        header = json.loads(mm[offset:offset + header_len])
+        offset += header_len
+        day = {'present': mm[offset:offset + num_keys]}
+        if '\x01' not in day['present']:
+            # Like bq_util.process_past_data, treat empty days as missing.
+            return None
+        offset += num_keys
+        offset += -offset % 8
+        column_size = 8 * num_keys
+        if columns is None:
+            columns = header['columns']
+        for column in columns:
+            values = array.array('d')
+            if column in header['columns']:
+                start = offset + column_size * header['columns'].index(column)
+                values.fromstring(mm[start:start + column_size])
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+            else:
+                values.fromlist([_NAN] * num_keys)
+            day[column] = values
+        return day
+    finally:
+        mm.close()
+
+
+class History(object):
+    """The last N days of some numeric columns of a report's data."""
+    def __init__(self, key_ids, days, columns):
+        self.key_ids = key_ids
+        self.days = days              # oldest first; None for missing days
+        self.columns = columns
+
+    def series(self, key, fn, absent=None):
+        """Return a list with fn(*column values) for key, for each day.
+
+        The list has None for days where we have no data at all, or
+        where any of the columns have no value for the key, and `absent`
+        for days where we have data but the key doesn't appear.
+        """
+        key_id = self.key_ids.get(key)
+        retval = []
+        for day in self.days:
+            if day is None:
+                retval.append(None)
+            elif (key_id is None or key_id >= len(day['present'])
+                    or day['present'][key_id] == '\x00'):
+                retval.append(absent)
+            else:
+                values = [day[c][key_id] for c in self.columns]
+                if any(math.isnan(v) for v in values):
+                    retval.append(None)
+                else:
+                    retval.append(fn(*values))
+        return retval
+
+
+def get_history(report, end_date, history_length, columns):
+    """Get the given columns of a report for the days up to end_date.
+
+    'history_length' is the number of days of data to include, not
+    counting end_date itself.  Use History.series() to get a sparkline
+    for a particular key.
+
+    Days that aren't in the store -- say they were saved before it
+    existed, or have been compacted away -- are read from the daily
+    data bq_util saved, if it has them (see import_pickles to add them
+    to the store for good).
+    """
+    dates = [(end_date - datetime.timedelta(i)).strftime("%Y%m%d")
+             for i in xrange(history_length, -1, -1)]
+    keys = []
+    days = [None] * len(dates)
+    if os.path.isdir(_report_directory(report)):
+        with _locked_report(report, exclusive=False):
+            keys = _load_keys(report)
+            days = [_read_day(report, yyyymmdd, columns)
+                    for yyyymmdd in dates]
+    key_ids = {k: i for (i, k) in enumerate(keys)}
+    for (i, yyyymmdd) in enumerate(dates):
+        if days[i] is None and not has_day(report, yyyymmdd):
+            days[i] = _day_from_daily_data(report, yyyymmdd, columns,
+                                           key_ids)
+    return History(key_ids, days, columns)
+
+
+def _day_from_daily_data(report, yyyymmdd, columns, key_ids):
+    """Like _read_day, but from the daily data bq_util saved.
+
+    Keys that aren't in key_ids yet are added to it.
+    """
+    import bq_util
+
+    data = bq_util.get_daily_data(report, yyyymmdd)
+    if not data:
+        return None
+    key_columns = REPORT_KEY_COLUMNS[report]
+    for row in data:
+        key_ids.setdefault(_key(row, key_columns), len(key_ids))
+    present = bytearray(len(key_ids))
+    day = {column: array.array('d', [_NAN]) * len(key_ids)
+           for column in columns}
+    for row in data:
+        key_id = key_ids[_key(row, key_columns)]
+        present[key_id] = 1
+        for column in columns:
+            if _is_number(row.get(column)):
+                day[column][key_id] = row[column]
+    day['present'] = str(present)
+    return day
+
+
+def compact(report, today, retention_days=HISTORY_RETENTION_DAYS):
+    """Delete a report's days older than retention_days, and unused keys.
+
+    save_day only ever adds keys, and every day file has room for all of
+    them, so once a quarter of the keys aren't used by any of the days
+    we still have, we drop those, renumber the rest, and rewrite the
+    days with the new ids.  Returns a pair (number of days deleted,
+    number of keys dropped).
+    """
+    directory = _report_directory(report)
+    if not os.path.isdir(directory):
+        return (0, 0)
+    oldest = (today - datetime.timedelta(retention_days)).strftime("%Y%m%d")
+    with _locked_report(report):
+        num_deleted = 0
+        days = {}      # yyyymmdd -> what _read_day returns
+        for filename in sorted(os.listdir(directory)):
+            m = _DAY_FILENAME_RE.match(filename)
+            if not m:
+                continue
+            if m.group(1) < oldest:
+                os.unlink(os.path.join(directory, filename))
+                num_deleted += 1
+            else:
+                days[m.group(1)] = _read_day(report, m.group(1))
+
+        keys = _load_keys(report)
+        used = set()
+        for day in days.itervalues():
+            if day is not None:
+                used.update(i for (i, c) in enumerate(day['present'])
+                            if c != '\x00')
+        if len(keys) - len(used) <= len(keys) // 4:
+            return (num_deleted, 0)
+
+        new_ids = {old_id: new_id
+                   for (new_id, old_id) in enumerate(sorted(used))}
+        # Rewrite the days before the keys: if we die in between, the
+        # ids in the days are wrong, but the keys file still has ids
+        # for every key they use.
+        for (yyyymmdd, day) in days.iteritems():
+            if day is None:
+                continue        # an empty day has no ids to renumber
+            columns = {}
+            for (name, values) in day.iteritems():
+                if name != 'present':
+                    columns[name] = {new_ids[i]: value
+                                     for (i, value) in enumerate(values)
+                                     if i in new_ids
+                                     and not math.isnan(value)}
+            present = set(new_ids[i] for (i, c) in enumerate(day['present'])
+                          if c != '\x00')
+            _write_day(report, yyyymmdd, len(new_ids), present, columns)
+        _save_keys(report, [keys[i] for i in sorted(used)])
+    return (num_deleted, len(keys) - len(used))
+
+
+def import_pickles(reports, force=False, verbose=False):
+    """Import the per-day pickles saved by bq_util into the columnar store.
+
+    Days already in the store are skipped unless force is True.
+    """
+    import bq_util
+
+    for filename in sorted(os.listdir(bq_util._DATA_DIRECTORY)):
+        (basename, ext) = os.path.splitext(filename)
+        (report, _, yyyymmdd) = basename.rpartition('_')
+        if ext != '.pickle' or report not in reports:
+            continue
+        if not force and has_day(report, yyyymmdd):
+            continue
+        data = bq_util.get_daily_data(report, yyyymmdd)
+        if data is None:
+            continue
+        if verbose:
+            print 'Importing %s for %s (%s rows)' % (report, yyyymmdd,
+                                                    len(data))
+        save_day(report, yyyymmdd, data)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Import the per-day report pickles in ~/bq_data into '
+                    'the columnar history store.')
+    parser.add_argument('--report', action='append',
+                        choices=sorted(REPORT_KEY_COLUMNS),
+                        help=('Report to import (may be repeated; '
+                              'default: all)'))
+    parser.add_argument('--force', action='store_true',
+                        help='Re-import days that are already in the store.')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Show more information about what we're doing.")
+    args = parser.parse_args()
+    import_pickles(args.report or REPORT_KEY_COLUMNS.keys(),
+                   force=args.force, verbose=args.verbose)
+
+
+if __name__ == '__main__':
+    main()
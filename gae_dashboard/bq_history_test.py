@@ -0,0 +1,169 @@
+import cPickle
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import bq_history
+import bq_util
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+        self.mock(bq_history, '_HISTORY_DIRECTORY',
+                  os.path.join(data_dir, 'history'))
+
+    def mock(self, container, var_str, new_value):
+        if hasattr(container, var_str):
+            oldval = getattr(container, var_str)
+            self.mock_origs[(container, var_str)] = oldval
+            self.addCleanup(lambda: setattr(container, var_str, oldval))
+        else:
+            self.mock_origs[(container, var_str)] = None
+            self.addCleanup(lambda: delattr(container, var_str))
+        setattr(container, var_str, new_value)
+
+
+class TestHistory(HistoryTestCase):
+    def test_series(self):
+        bq_history.save_day('instance_hours', '20190101', [
+            {'url_route': '/a', 'instance_hours': 2.0, 'count_': 4},
+            {'url_route': '/b', 'instance_hours': 1.0, 'count_': 1},
+        ])
+        # No data on the 2nd.
+        bq_history.save_day('instance_hours', '20190103', [
+            {'url_route': '/c', 'instance_hours': 3.0, 'count_': 1},
+            {'url_route': '/a', 'instance_hours': 1.0, 'count_': 1},
+        ])
+        history = bq_history.get_history(
+            'instance_hours', datetime.date(2019, 1, 3), 2,
+            ['instance_hours', 'count_'])
+        per_request = lambda hours, count: hours / count
+        self.assertEqual([0.5, None, 1.0],
+                         history.series('/a', per_request))
+        self.assertEqual([1.0, None, 'absent'],
+                         history.series('/b', per_request, absent='absent'))
+        self.assertEqual([None, None, 3.0],
+                         history.series('/c', per_request))
+        self.assertEqual([None, None, None],
+                         history.series('/d', per_request))
+
+    def test_concurrent_saves(self):
+        load_keys = bq_history._load_keys
+
+        def slow_load_keys(report):
+            keys = load_keys(report)
+            time.sleep(0.05)      # so the writers would overlap
+            return keys
+        self.mock(bq_history, '_load_keys', slow_load_keys)
+
+        def save(day):
+            bq_history.save_day('instance_hours', '201901%02d' % day, [
+                {'url_route': '/%s' % day, 'instance_hours': float(day)}])
+        threads = [threading.Thread(target=save, args=(day,))
+                   for day in (1, 2, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        history = bq_history.get_history(
+            'instance_hours', datetime.date(2019, 1, 3), 2,
+            ['instance_hours'])
+        for day in (1, 2, 3):
+            series = history.series('/%s' % day, lambda hours: hours)
+            self.assertEqual(float(day), series[day - 1])
+
+    def test_tuple_keys_and_missing_columns(self):
+        bq_history.save_day('out_of_memory_errors_by_route', '20190101', [
+            {'module_id': 'default', 'url_route': '/a', 'count_': 3},
+            {'module_id': 'batch', 'url_route': '/a', 'count_': '(None)'},
+        ])
+        history = bq_history.get_history(
+            'out_of_memory_errors_by_route', datetime.date(2019, 1, 1), 0,
+            ['count_'])
+        self.assertEqual([3], history.series(('default', '/a'),
+                                             lambda count: count))
+        self.assertEqual([None], history.series(('batch', '/a'),
+                                                lambda count: count))
+        history = bq_history.get_history(
+            'out_of_memory_errors_by_route', datetime.date(2019, 1, 1), 0,
+            ['count_', 'not_a_column'])
+        self.assertEqual([None], history.series(('default', '/a'),
+                                                lambda count, _: count))
+
+    def test_save_daily_data_saves_history(self):
+        bq_util.save_daily_data([{'firstword': 'foo', 'size_mb': 1.5}],
+                                'log_bytes', '20190101')
+        history = bq_history.get_history(
+            'log_bytes', datetime.date(2019, 1, 1), 0, ['size_mb'])
+        self.assertEqual([1.5], history.series('foo', lambda mb: mb))
+
+    def test_compact(self):
+        bq_history.save_day('instance_hours', '20190101', [
+            {'url_route': '/1a', 'instance_hours': 1.0},
+            {'url_route': '/1b', 'instance_hours': 1.0}])
+        for day in (1, 2, 3):
+            bq_history.save_day('instance_hours', '201901%02d' % day, [
+                {'url_route': '/%s' % day, 'instance_hours': float(day)},
+                {'url_route': '/all', 'instance_hours': 10.0 + day}])
+        bq_history.save_day('instance_hours', '20190104', [])
+        # /1, /1a and /1b were only used on the 1st.
+        self.assertEqual((1, 3), bq_history.compact(
+            'instance_hours', datetime.date(2019, 1, 4), retention_days=2))
+        self.assertFalse(bq_history.has_day('instance_hours', '20190101'))
+        self.assertEqual(['/all', '/2', '/3'],
+                         bq_history._load_keys('instance_hours'))
+
+        history = bq_history.get_history(
+            'instance_hours', datetime.date(2019, 1, 4), 3,
+            ['instance_hours'])
+        hours = lambda hours: hours
+        self.assertEqual([None, 12.0, 13.0, None],
+                         history.series('/all', hours))
+        self.assertEqual([None, 2.0, None, None], history.series('/2', hours))
+        self.assertEqual([None, None, None, None],
+                         history.series('/1', hours))
+
+        # Nothing more to do.
+        self.assertEqual((0, 0), bq_history.compact(
+            'instance_hours', datetime.date(2019, 1, 4), retention_days=2))
+
+    def test_falls_back_to_daily_data(self):
+        bq_history.save_day('rpcs', '20190102', [
+            {'url_route': '/a', 'rpc_cost': 4, 'requests': 1}])
+        # Saved before there was a history store.
+        with open(os.path.join(bq_util._DATA_DIRECTORY,
+                               'rpcs_20190101.pickle'), 'w') as f:
+            cPickle.dump([{'url_route': '/b', 'rpc_cost': 10, 'requests': 5},
+                          {'url_route': '/a', 'rpc_cost': 3,
+                           'requests': '(None)'}], f)
+        history = bq_history.get_history(
+            'rpcs', datetime.date(2019, 1, 2), 2, ['rpc_cost', 'requests'])
+        cost = lambda c, r: c / r
+        self.assertEqual([None, None, 4], history.series('/a', cost))
+        self.assertEqual([None, 2, 'absent'],
+                         history.series('/b', cost, absent='absent'))
+        # We didn't write anything.
+        self.assertFalse(bq_history.has_day('rpcs', '20190101'))
+
+    def test_import_pickles(self):
+        with open(os.path.join(bq_util._DATA_DIRECTORY,
+                               'rpcs_20190101.pickle'), 'w') as f:
+            cPickle.dump([{'url_route': '/a', 'rpc_cost': 10,
+                           'requests': 5}], f)
+        bq_history.import_pickles(['rpcs'])
+        history = bq_history.get_history(
+            'rpcs', datetime.date(2019, 1, 1), 0, ['rpc_cost', 'requests'])
+        self.assertEqual([2.0], history.series('/a', lambda c, r: c / r))
+
+
+if __name__ == '__main__':
+    unittest.main()
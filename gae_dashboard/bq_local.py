@@ -0,0 +1,725 @@
+#!/usr/bin/env python
+
+"""A stand-in for bigquery, backed by a local sqlite database.
+
+This lets us run our reports -- email_bq_data, email_uptime,
+check_failing_routes, dos_alert -- without talking to bigquery, so we
+can profile and load-test the python side of them.  Point bq_util at it
+with
+    bq_util.use_local_backend('/tmp/bq_local.sqlite')
+or by setting $BQ_UTIL_LOCAL_DB, after filling the database with
+synthetic logs via create_fixtures() (or by running this as a script).
+See report_benchmark.py for timing the reports against it.
+
+We implement just enough of the bigquery v2 API (the jobs and tables
+resources) for bq_util, and just enough of legacy SQL for the queries
+our reports run; see translate_legacy_sql().  Tables are stored in
+sqlite as "<dataset>.<table>" -- the project is ignored -- and each
+dataset has a "<dataset>.__TABLES__" table of metadata, like bigquery.
+Nested records are stored flattened into columns like
+"app_logs.message", with a single value per request for repeated
+fields, so results are only roughly what bigquery would give, but have
+a realistic shape and size.  Table decorators are ignored.
+"""
+
+import calendar
+import datetime
+import random
+import re
+import sqlite3
+import threading
+import time
+
+import bq_util
+
+
+# --- Translating legacy SQL to sqlite.
+
+# String literals (maybe raw), comments, and [bracketed table names].
+# Everything in between is code.
+_TOKEN_RE = re.compile(r"""
+    (?P<string> (?<!\w)r?'(?:[^'\\]|\\.)*' | (?<!\w)r?"(?:[^"\\]|\\.)*")
+  | (?P<comment> --[^\n]* | \#[^\n]*)
+  | (?P<table> \[[^\]]+\])
+""", re.VERBOSE)
+
+# Functions whose names sqlite won't accept, or that mean something
+# else to sqlite.  We implement them as BQ_<name>.  (The lookahead keeps
+# us from mangling "LEFT OUTER JOIN (SELECT ...".)
+_RENAMED_FUNCTIONS_RE = re.compile(
+    r'\b(LEFT|IF|INTEGER|FLOAT|TIMESTAMP)\s*\((?!\s*SELECT\b)', re.IGNORECASE)
+
+# Unbracketed table names, e.g. FROM logs.requestlogs_20190101.
+_BARE_TABLE_RE = re.compile(
+    r'\b(FROM|JOIN)(\s+)([\w-]+(?::[\w-]+)?(?:\.[\w$-]+)+)', re.IGNORECASE)
+
+# A legacy-sql union: FROM [table1], [table2], ...
+_UNION_RE = re.compile(r'\bFROM(\s+)("[^"]+"(?:\s*,\s*"[^"]+")+)',
+                       re.IGNORECASE)
+
+_CONTAINS_RE = re.compile(r'([\w."]+)\s+CONTAINS\s*$', re.IGNORECASE)
+
+
+def _string_value(token):
+    """Return the value of a legacy-sql string literal."""
+    if token[0] in 'rR':
+        return token[2:-1]
+    return re.sub(r'\\(.)',
+                  lambda m: {'n': '\n', 't': '\t'}.get(m.group(1),
+                                                       m.group(1)),
+                  token[1:-1])
+
+
+def _table_name(bracketed):
+    """Map [project:dataset.table@decorator] to "dataset.table"."""
+    name = bracketed.strip('[]').split('@', 1)[0].strip()
+    name = name.rsplit(':', 1)[-1]
+    return '"%s"' % '.'.join(name.split('.')[-2:])
+
+
+def _split_call(sql, start):
+    """Given the index of a '(' in sql, return the args and the end index.
+
+    The args are the comma-separated (top-level) strings inside the
+    parens, and the end index is just past the closing paren.
+    """
+    depth = 0
+    args = []
+    arg_start = start + 1
+    i = start
+    while i < len(sql):
+        c = sql[i]
+        if c == "'":
+            i = sql.index("'", i + 1)
+            while sql[i + 1:i + 2] == "'":       # an escaped quote
+                i = sql.index("'", i + 2)
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(sql[arg_start:i].strip())
+                return (args, i + 1)
+        elif c == ',' and depth == 1:
+            args.append(sql[arg_start:i].strip())
+            arg_start = i + 1
+        i += 1
+    raise ValueError('Unbalanced parens in %s' % sql)
+
+
+def _rewrite_quantiles(sql):
+    """NTH(n, QUANTILES(expr, k)) -> BQ_QUANTILE(expr, k, n)."""
+    while True:
+        m = re.search(r'\bNTH\s*\(', sql, re.IGNORECASE)
+        if not m:
+            return sql
+        (args, end) = _split_call(sql, m.end() - 1)
+        inner = re.match(r'QUANTILES\s*\(', args[1], re.IGNORECASE)
+        if not inner:
+            raise ValueError('NTH() is only supported with QUANTILES()')
+        (quantile_args, _) = _split_call(args[1], inner.end() - 1)
+        sql = '%sBQ_QUANTILE(%s, %s, %s)%s' % (
+            sql[:m.start()], quantile_args[0], quantile_args[1], args[0],
+            sql[end:])
+
+
+def _rewrite_within_record(sql):
+    """AGG(expr) WITHIN RECORD -> expr, since our records have one value.
+
+    (See the module docstring: repeated fields are flattened into a
+    single value per row.)
+    """
+    pos = 0
+    while True:
+        m = re.compile(r'\b(SUM|COUNT|MIN|MAX|GROUP_CONCAT)\s*\(',
+                       re.IGNORECASE).search(sql, pos)
+        if not m:
+            return sql
+        (args, end) = _split_call(sql, m.end() - 1)
+        within = re.compile(r'\s*WITHIN\s+RECORD\b',
+                            re.IGNORECASE).match(sql, end)
+        if not within:
+            pos = m.end()
+            continue
+        if m.group(1).upper() == 'COUNT':
+            replacement = '(%s IS NOT NULL)' % args[0]
+        else:
+            replacement = '(%s)' % args[0]
+        sql = sql[:m.start()] + replacement + sql[within.end():]
+        pos = m.start()
+
+
+def translate_legacy_sql(sql, record_prefixes=()):
+    """Translate a bigquery legacy-sql query to sqlite.
+
+    This handles the constructs our reports use: [bracketed] and bare
+    table names (and comma-unions of them), dotted fields of records
+    (record_prefixes lists the record names, e.g. 'app_logs'), CONTAINS,
+    raw and double-quoted strings, floating-point division, trailing
+    commas in the select list, NTH(QUANTILES()), WITHIN RECORD, and
+    functions that are implemented by LocalBigQueryService.  It is not a
+    general translator.
+    """
+    fields_re = None
+    if record_prefixes:
+        fields_re = re.compile(r'(?<!")\b(%s)\.(\w+)\b'
+                               % '|'.join(re.escape(p)
+                                          for p in record_prefixes))
+    output = []
+    close_contains = False
+    pos = 0
+    for m in list(_TOKEN_RE.finditer(sql)) + [None]:
+        code = sql[pos:m.start() if m else len(sql)]
+        code = _RENAMED_FUNCTIONS_RE.sub(
+            lambda m: 'BQ_%s(' % m.group(1).upper(), code)
+        code = code.replace('/', '* 1.0 /')
+        code = _BARE_TABLE_RE.sub(
+            lambda m: m.group(1) + m.group(2) + _table_name(m.group(3)),
+            code)
+        if fields_re:
+            code = fields_re.sub(r'"\1.\2"', code)
+        code = re.sub(r',(\s*FROM\b)', r'\1', code, flags=re.IGNORECASE)
+        if _CONTAINS_RE.search(code):
+            code = _CONTAINS_RE.sub(r'instr(\1, ', code)
+            close_contains = True
+        output.append(code)
+        if m is None:
+            break
+        pos = m.end()
+
+        if m.group('string'):
+            output.append("'%s'" % _string_value(m.group('string'))
+                          .replace("'", "''"))
+            if close_contains:
+                output.append(') > 0')
+                close_contains = False
+        elif m.group('table'):
+            output.append(_table_name(m.group('table')))
+        # We just drop comments.
+
+    sql = ''.join(output)
+    sql = _UNION_RE.sub(
+        lambda m: 'FROM%s(%s)' % (m.group(1), ' UNION ALL '.join(
+            'SELECT * FROM %s' % t.strip() for t in m.group(2).split(','))),
+        sql)
+    return _rewrite_within_record(_rewrite_quantiles(sql))
+
+
+def referenced_tables(sql):
+    """Return the set of "dataset.table" names a legacy-sql query reads."""
+    tables = set()
+    for m in _TOKEN_RE.finditer(sql):
+        if m.group('table'):
+            tables.add(_table_name(m.group('table')).strip('"'))
+    for m in _BARE_TABLE_RE.finditer(_TOKEN_RE.sub(' ', sql)):
+        tables.add(_table_name(m.group(3)).strip('"'))
+    return tables
+
+
+# --- The functions (and aggregates) our translated queries use.
+
+def _regexp_extract(s, regexp):
+    if s is None:
+        return None
+    m = re.search(regexp, s)
+    return m.group(1) if m else None
+
+
+def _regexp_match(s, regexp):
+    return None if s is None else bool(re.search(regexp, s))
+
+
+def _regexp_replace(s, regexp, replacement):
+    return None if s is None else re.sub(regexp, replacement, s)
+
+
+def _integer(x):
+    try:
+        return None if x is None else int(float(x))
+    except ValueError:
+        return None
+
+
+def _float(x):
+    try:
+        return None if x is None else float(x)
+    except ValueError:
+        return None
+
+
+def _timestamp(s):
+    """Parse 'YYYY-MM-DD[ HH:MM:SS]' into seconds since the epoch."""
+    if s is None:
+        return None
+    s = s.replace('T', ' ')
+    fmt = '%Y-%m-%d %H:%M:%S' if ' ' in s else '%Y-%m-%d'
+    return float(calendar.timegm(time.strptime(s[:19], fmt)))
+
+
+class _First(object):
+    def __init__(self):
+        self.value = None
+        self.seen = False
+
+    def step(self, value):
+        if not self.seen:
+            self.value = value
+            self.seen = True
+
+    def finalize(self):
+        return self.value
+
+
+class _Quantile(object):
+    """BQ_QUANTILE(expr, k, n) is legacy-sql's NTH(n, QUANTILES(expr, k))."""
+    def __init__(self):
+        self.values = []
+        self.k = self.n = None
+
+    def step(self, value, k, n):
+        (self.k, self.n) = (k, n)
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        self.values.sort()
+        index = (self.n - 1) * (len(self.values) - 1) / (self.k - 1)
+        return self.values[int(round(index))]
+
+
+_FUNCTIONS = {
+    'BQ_IF': (3, lambda cond, a, b: a if cond else b),
+    'BQ_INTEGER': (1, _integer),
+    'BQ_FLOAT': (1, _float),
+    'BQ_LEFT': (2, lambda s, n: None if s is None else s[:n]),
+    'BQ_TIMESTAMP': (1, _timestamp),
+    'SEC_TO_TIMESTAMP': (1, _float),
+    'REGEXP_EXTRACT': (2, _regexp_extract),
+    'REGEXP_MATCH': (2, _regexp_match),
+    'REGEXP_REPLACE': (3, _regexp_replace),
+}
+
+_AGGREGATES = {
+    'FIRST': (1, _First),
+    'BQ_QUANTILE': (3, _Quantile),
+}
+
+
+# --- The fake bigquery service.
+
+class _Request(object):
+    """Like an apiclient HttpRequest: call execute() to run it."""
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self, num_retries=0):
+        return self.fn()
+
+
+def _not_found(what, name):
+    return bq_util.BQCallError(['local'], 'Not found: %s %s' % (what, name))
+
+
+def _field_type(values):
+    """Guess a result column's bigquery type from its values."""
+    for value in values:
+        if isinstance(value, bool):
+            return 'BOOLEAN'
+        if isinstance(value, (int, long)):
+            return 'INTEGER'
+        if isinstance(value, float):
+            return 'FLOAT'
+        if value is not None:
+            return 'STRING'
+    return 'STRING'
+
+
+def _cell(value):
+    """Format a value like the bigquery API does: as a string."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+
+class LocalBigQueryService(object):
+    """Enough of the bigquery v2 API service for bq_util, using sqlite.
+
+    Query jobs run synchronously when they're inserted, so they're
+    always DONE by the time anyone asks.
+    """
+    def __init__(self, db_filename):
+        self.db = sqlite3.connect(db_filename, check_same_thread=False)
+        for (name, (num_args, fn)) in _FUNCTIONS.iteritems():
+            self.db.create_function(name, num_args, fn)
+        for (name, (num_args, cls)) in _AGGREGATES.iteritems():
+            self.db.create_aggregate(name, num_args, cls)
+        self.lock = threading.Lock()
+        self.jobs_by_id = {}
+
+    def jobs(self):
+        return self
+
+    def tables(self):
+        return _LocalTables(self)
+
+    def _table_metadata(self, dataset, table):
+        """Return (row count, size, last-modified ms) or None."""
+        try:
+            return self.db.execute(
+                'SELECT row_count, size_bytes, last_modified_time '
+                'FROM "%s.__TABLES__" WHERE table_id = ?' % dataset,
+                (table,)).fetchone()
+        except sqlite3.OperationalError:      # no such dataset
+            return None
+
+    def _dataset_exists(self, dataset):
+        return self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            ('%s.__TABLES__' % dataset,)).fetchone() is not None
+
+    def _record_prefixes(self):
+        """Return the names of all the (flattened) records in our tables."""
+        prefixes = set()
+        for (sql,) in self.db.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table'"):
+            columns = (sql or '').split('(', 1)[-1]
+            prefixes.update(re.findall(r'"(\w+)\.\w+" ', columns))
+        return prefixes
+
+    def _bytes_processed(self, sql):
+        num_bytes = 0
+        for table in referenced_tables(sql):
+            (dataset, table_id) = table.split('.', 1)
+            if table_id == '__TABLES__':
+                # Metadata queries are free, but the dataset must exist.
+                if not self._dataset_exists(dataset):
+                    raise _not_found('Dataset', dataset)
+                continue
+            metadata = self._table_metadata(dataset, table_id)
+            if metadata is None:
+                raise _not_found('Table', table)
+            num_bytes += metadata[1]
+        return num_bytes
+
+    def insert(self, projectId, body, media_body=None):
+        config = body['configuration']
+        if 'query' not in config:
+            raise NotImplementedError('Only query jobs are supported locally')
+        sql = config['query']['query']
+        if not config['query'].get('useLegacySql', True):
+            raise NotImplementedError('Only legacy sql is supported locally')
+
+        def fn():
+            with self.lock:
+                num_bytes = self._bytes_processed(sql)
+                if config.get('dryRun'):
+                    return {'statistics': {
+                        'totalBytesProcessed': str(num_bytes)}}
+
+                job_id = body['jobReference']['jobId']
+                job = {'jobReference': body['jobReference'],
+                       'status': {'state': 'DONE'}}
+                start_ms = int(time.time() * 1000)
+                try:
+                    cursor = self.db.execute(translate_legacy_sql(
+                        sql, self._record_prefixes()))
+                    rows = cursor.fetchall()
+                    names = [d[0] for d in cursor.description or []]
+                    self.jobs_by_id[job_id] = (names, rows)
+                except sqlite3.Error as e:
+                    job['status']['errorResult'] = {'message': str(e)}
+                    self.jobs_by_id[job_id] = e
+                end_ms = int(time.time() * 1000)
+                job['statistics'] = {
+                    'creationTime': str(start_ms),
+                    'startTime': str(start_ms),
+                    'endTime': str(end_ms),
+                    'totalBytesProcessed': str(num_bytes),
+                    'query': {'totalBytesBilled': str(num_bytes),
+                              'totalSlotMs': str(end_ms - start_ms),
+                              'cacheHit': False},
+                }
+                self.jobs_by_id[job_id + '.job'] = job
+                return job
+        return _Request(fn)
+
+    def get(self, projectId, jobId):
+        def fn():
+            if jobId + '.job' not in self.jobs_by_id:
+                raise _not_found('Job', jobId)
+            return self.jobs_by_id[jobId + '.job']
+        return _Request(fn)
+
+    def getQueryResults(self, projectId, jobId, timeoutMs=None,
+                        maxResults=None, pageToken=None):
+        def fn():
+            if jobId not in self.jobs_by_id:
+                raise _not_found('Job', jobId)
+            result = self.jobs_by_id[jobId]
+            if isinstance(result, Exception):
+                raise bq_util.BQCallError(['getQueryResults'], str(result))
+            (names, rows) = result
+            fields = [{'name': name,
+                       'type': _field_type(row[i] for row in rows)}
+                      for (i, name) in enumerate(names)]
+            start = int(pageToken or 0)
+            end = len(rows) if maxResults is None else start + maxResults
+            reply = {'jobComplete': True,
+                     'schema': {'fields': fields},
+                     'totalRows': str(len(rows)),
+                     'rows': [{'f': [{'v': _cell(v)} for v in row]}
+                              for row in rows[start:end]]}
+            if end < len(rows):
+                reply['pageToken'] = str(end)
+            return reply
+        return _Request(fn)
+
+    def cancel(self, projectId, jobId):
+        return _Request(lambda: {})
+
+
+class _LocalTables(object):
+    """The tables resource of LocalBigQueryService."""
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, projectId, datasetId, tableId):
+        def fn():
+            with self.service.lock:
+                metadata = self.service._table_metadata(datasetId, tableId)
+            if metadata is None:
+                raise _not_found('Table', '%s:%s.%s'
+                                 % (projectId, datasetId, tableId))
+            return {'id': '%s:%s.%s' % (projectId, datasetId, tableId),
+                    'numRows': str(metadata[0]),
+                    'numBytes': str(metadata[1]),
+                    'lastModifiedTime': str(metadata[2])}
+        return _Request(fn)
+
+
+# --- Synthetic fixtures.
+
+_MODULES = (('default', 60), ('frontend-highmem', 15), ('batch', 10),
+            ('multithreaded', 10), ('i18n', 5))
+
+_APP_LOG_MESSAGES = (
+    'Fetching user data for %s',
+    'Memcache miss for key %s',
+    'Rendering template %s',
+    'graphql query took %s ms',
+    'Exceeded soft memory limit of 2048 MB with 2078 MB after servicing '
+    '%s requests total. Consider setting a larger instance class in '
+    'app.yaml.',
+    'java.lang.OutOfMemoryError: Java heap space (%s)',
+)
+
+_RPC_STATS = ['stats.rpc_ops.%s.count' % op
+              for op in ('Get', 'Put', 'Next', 'RunQuery', 'Delete',
+                         'Commit')] + ['stats.rpc_ops.cost']
+
+_USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/73.0.3683.103',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_4) Safari/605.1.15',
+    'Khan%20Academy.iOS/6.1.0 CFNetwork/978.0.7 Darwin/18.5.0',
+    'Khan%20Academy.iOS/6.0.2 CFNetwork/976 Darwin/18.2.0',
+    'Googlebot/2.1 (+http://www.google.com/bot.html)',
+)
+
+
+def _weighted_choice(rng, choices):
+    total = sum(w for (_, w) in choices)
+    x = rng.uniform(0, total)
+    for (choice, weight) in choices:
+        x -= weight
+        if x <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def _routes(num_routes):
+    """A list of routes, most popular first."""
+    routes = []
+    for i in xrange(num_routes):
+        if i % 3 == 0:
+            routes.append('api_main:/api/internal/route%d' % i)
+        else:
+            routes.append('main:/route%d' % i)
+    return routes
+
+
+def _route_index(rng, num_routes):
+    """Pick routes with a long-tailed (roughly zipfian) popularity."""
+    return int(rng.paretovariate(1.1) - 1) % num_routes
+
+
+def _requestlogs_rows(rng, date, num_requests, num_routes=2000):
+    day_start = calendar.timegm(date.timetuple())
+    routes = _routes(num_routes)
+    # A few routes that always fail, for check_failing_routes.
+    failing_routes = set(routes[num_routes / 2:num_routes / 2 + 5])
+    for i in xrange(num_requests):
+        route = routes[_route_index(rng, num_routes)]
+        start_time = day_start + rng.uniform(0, 86400)
+        latency = rng.expovariate(5)
+        module_id = _weighted_choice(rng, _MODULES)
+        if route in failing_routes:
+            status = 500
+        else:
+            status = _weighted_choice(rng, ((200, 90), (302, 4), (404, 3),
+                                            (500, 0.3)))
+        message_index = min(int(rng.expovariate(1.5)),
+                            len(_APP_LOG_MESSAGES) - 1)
+        yield (
+            '%s%08d' % (date.strftime('%Y%m%d'), i),         # request_id
+            start_time,
+            start_time + latency,                             # end_time
+            latency,
+            latency * rng.uniform(0, 0.1),                    # pending_time
+            module_id,
+            'znd-test' if rng.random() < 0.02 else '190101-1234-abcdef',
+            '%s-instance-%d' % (module_id, rng.randint(0, 200)),
+            '' if rng.random() < 0.1 else 'main.application',  # url_map_entry
+            route,
+            'bot/dev' if rng.random() < 0.05 else 'desktop',  # device type
+            status,
+            '10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255),
+                             rng.randint(0, 255)),
+            _weighted_choice(rng, [(ua, 1) for ua in _USER_AGENTS]),
+            _APP_LOG_MESSAGES[message_index] % rng.randint(1, 2000),
+            rng.choice(_RPC_STATS),
+            float(rng.randint(1, 50)),
+        )
+
+
+_REQUESTLOGS_COLUMNS = (
+    'request_id TEXT', 'start_time REAL', 'end_time REAL', 'latency REAL',
+    'pending_time REAL', 'module_id TEXT', 'version_id TEXT',
+    'instance_key TEXT', 'url_map_entry TEXT', 'elog_url_route TEXT',
+    'elog_device_type TEXT', 'status INTEGER', 'ip TEXT', 'user_agent TEXT',
+    '"app_logs.message" TEXT', '"elog_stats_rpc_ops.key" TEXT',
+    '"elog_stats_rpc_ops.value" REAL')
+
+
+def _fastly_rows(rng, date, num_rows):
+    day_start = calendar.timegm(date.timetuple())
+    for i in xrange(num_rows):
+        t = time.gmtime(day_start + rng.uniform(0, 86400))
+        is_scratchpad = rng.random() < 0.01
+        yield (
+            '10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255),
+                             rng.randint(0, 255)),
+            ('/api/internal/scratchpads' if is_scratchpad
+             else '/route%d' % _route_index(rng, 2000)),
+            _weighted_choice(rng, [(ua, 1) for ua in _USER_AGENTS]),
+            time.strftime('%Y-%m-%dT%H:%M:%S+0000', t),
+            'POST' if is_scratchpad or rng.random() < 0.1 else 'GET',
+            rng.random() < 0.9,
+        )
+
+
+_FASTLY_COLUMNS = ('client_ip TEXT', 'url TEXT', 'request_user_agent TEXT',
+                   'timestamp TEXT', 'request TEXT', 'at_edge_node INTEGER')
+
+
+def _rrs_rows(rng, num_rows):
+    for i in xrange(num_rows):
+        yield (
+            '/render?path=.%%2Fjavascript%%2Fpackage%d-package%%2Fcomponent%d'
+            '.jsx' % (rng.randint(0, 50), rng.randint(0, 20)),
+            500 if rng.random() < 0.01 else 200,
+            str(rng.expovariate(8)),
+        )
+
+
+_RRS_COLUMNS = ('"httpRequest.requestUrl" TEXT',
+                '"httpRequest.status" INTEGER',
+                '"jsonPayload.latencyseconds" TEXT')
+
+
+def _create_table(db, table, columns, rows):
+    """Create and fill a table, and record its metadata in __TABLES__."""
+    (dataset, table_id) = table.split('.', 1)
+    db.execute('DROP TABLE IF EXISTS "%s"' % table)
+    db.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join(columns)))
+    placeholders = ', '.join('?' * len(columns))
+    db.executemany('INSERT INTO "%s" VALUES (%s)' % (table, placeholders),
+                   rows)
+    (row_count, size_bytes) = db.execute(
+        'SELECT COUNT(*), SUM(%s) FROM "%s"'
+        % (' + '.join('IFNULL(LENGTH(%s), 0)' % c.rsplit(' ', 1)[0]
+                      for c in columns), table)).fetchone()
+    db.execute('CREATE TABLE IF NOT EXISTS "%s.__TABLES__" '
+               '(table_id TEXT PRIMARY KEY, row_count INTEGER, '
+               'size_bytes INTEGER, last_modified_time INTEGER)' % dataset)
+    db.execute('INSERT OR REPLACE INTO "%s.__TABLES__" VALUES (?, ?, ?, ?)'
+               % dataset, (table_id, row_count, size_bytes or 0,
+                           int(time.time() * 1000)))
+
+
+def create_fixtures(db_filename, dates, requests_per_day=100000,
+                    fastly_rows_per_day=100000, rrs_rows_per_day=20000,
+                    seed=0, verbose=False):
+    """Fill a sqlite database with synthetic logs for the given dates.
+
+    For each datetime.date in dates, this creates the tables
+        logs.requestlogs_YYYYMMDD
+        fastly.khanacademy_dot_org_logs_YYYYMMDD
+        react_render_logs.appengine_googleapis_com_nginx_request_YYYYMMDD
+    with the given numbers of rows, replacing any that already exist.
+    The data is random, but repeatable for a given seed.
+    """
+    rng = random.Random(seed)
+    db = sqlite3.connect(db_filename)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    for date in dates:
+        yyyymmdd = date.strftime('%Y%m%d')
+        if verbose:
+            print 'Creating fixtures for %s' % yyyymmdd
+        _create_table(db, 'logs.requestlogs_%s' % yyyymmdd,
+                      _REQUESTLOGS_COLUMNS,
+                      _requestlogs_rows(rng, date, requests_per_day))
+        _create_table(db, 'fastly.khanacademy_dot_org_logs_%s' % yyyymmdd,
+                      _FASTLY_COLUMNS,
+                      _fastly_rows(rng, date, fastly_rows_per_day))
+        _create_table(db, 'react_render_logs.'
+                      'appengine_googleapis_com_nginx_request_%s' % yyyymmdd,
+                      _RRS_COLUMNS, _rrs_rows(rng, rrs_rows_per_day))
+        db.commit()
+    db.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Create a sqlite database of synthetic logs, for use '
+                    'with bq_util.use_local_backend().')
+    parser.add_argument('db', help='The sqlite database file to fill.')
+    parser.add_argument('--date', metavar='YYYYMMDD',
+                        default=(datetime.date.today() -
+                                 datetime.timedelta(1)).strftime('%Y%m%d'),
+                        help='The last day to create logs for '
+                             '(default "%(default)s")')
+    parser.add_argument('--days', type=int, default=15,
+                        help='How many days of logs to create '
+                             '(default %(default)s)')
+    parser.add_argument('--requests', type=int, default=100000,
+                        help='Requests per day (default %(default)s)')
+    parser.add_argument('--fastly-rows', type=int, default=100000,
+                        help='Fastly log lines per day (default %(default)s)')
+    args = parser.parse_args()
+    end = datetime.datetime.strptime(args.date, '%Y%m%d').date()
+    create_fixtures(args.db, [end - datetime.timedelta(i)
+                              for i in xrange(args.days - 1, -1, -1)],
+                    requests_per_day=args.requests,
+                    fastly_rows_per_day=args.fastly_rows, verbose=True)
+
+
+if __name__ == '__main__':
+    main()
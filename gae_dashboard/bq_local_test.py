@@ -0,0 +1,129 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import bq_history
+import bq_local
+import bq_util
+
+
+class TestTranslateLegacySql(unittest.TestCase):
+    def test_table_names(self):
+        self.assertEqual(
+            'SELECT a FROM "logs.requestlogs_20190101"',
+            bq_local.translate_legacy_sql(
+                'SELECT a FROM [khanacademy.org:deductive-jet-827:'
+                'logs.requestlogs_20190101]'))
+        self.assertEqual(
+            'SELECT a FROM "logs.requestlogs_20190101"',
+            bq_local.translate_legacy_sql(
+                'SELECT a FROM logs.requestlogs_20190101'))
+
+    def test_union_with_decorators(self):
+        self.assertEqual(
+            'SELECT a FROM (SELECT * FROM "fastly.logs_20190102" '
+            'UNION ALL SELECT * FROM "fastly.logs_20190101")',
+            bq_local.translate_legacy_sql(
+                'SELECT a FROM [p:fastly.logs_20190102@-600000-], '
+                '[p:fastly.logs_20190101@-600000-]'))
+
+    def test_strings_and_comments(self):
+        self.assertEqual(
+            "SELECT 'bot/dev', 'a\\d', 'it''s' \nFROM \"d.t\"",
+            bq_local.translate_legacy_sql(
+                'SELECT "bot/dev", r\'a\\d\', "it\'s" -- a comment\n'
+                'FROM [d.t]'))
+
+    def test_expressions(self):
+        self.assertEqual(
+            'SELECT BQ_IF(instr("app_logs.message", \'oom\') > 0, '
+            'BQ_LEFT(x, 3), x * 1.0 / 2) AS y\nFROM "d.t"',
+            bq_local.translate_legacy_sql(
+                "SELECT IF(app_logs.message CONTAINS 'oom', "
+                "LEFT(x, 3), x / 2) AS y,\nFROM [d.t]",
+                record_prefixes=['app_logs']))
+
+    def test_quantiles(self):
+        self.assertEqual(
+            'SELECT BQ_QUANTILE(BQ_INTEGER(a), 101, 50) FROM "d.t"',
+            bq_local.translate_legacy_sql(
+                'SELECT NTH(50, QUANTILES(INTEGER(a), 101)) FROM [d.t]'))
+
+    def test_within_record(self):
+        self.assertEqual(
+            'SELECT (BQ_IF(instr("app_logs.message", \'oom\') > 0, 1, 0)) '
+            'AS oom, ("app_logs.message" IS NOT NULL) AS n FROM "d.t"',
+            bq_local.translate_legacy_sql(
+                "SELECT SUM(IF(app_logs.message CONTAINS 'oom', 1, 0)) "
+                "WITHIN RECORD AS oom, "
+                "COUNT(app_logs.message) WITHIN RECORD AS n FROM [d.t]",
+                record_prefixes=['app_logs']))
+
+
+class TestLocalBackend(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        db = os.path.join(tmpdir, 'bq_local.sqlite')
+        bq_local.create_fixtures(db, [datetime.date(2019, 1, 1)],
+                                 requests_per_day=200,
+                                 fastly_rows_per_day=10, rrs_rows_per_day=10)
+        bq_util.use_local_backend(db)
+        self.addCleanup(lambda: bq_util.use_local_backend(None))
+        self.tmpdir = tmpdir
+
+        for (var, value) in (
+                ('_job_stats', []),
+                ('_bytes_scanned', {'estimated': 0, 'billed': 0})):
+            self.addCleanup(setattr, bq_util, var, getattr(bq_util, var))
+            setattr(bq_util, var, value)
+
+    def test_query(self):
+        rows = bq_util.query_bigquery(
+            'SELECT module_id, COUNT(*) AS num_requests, '
+            '  SUM(latency) / COUNT(*) AS avg_latency '
+            'FROM [logs.requestlogs_20190101] '
+            'GROUP BY module_id ORDER BY num_requests DESC')
+        self.assertEqual(200, sum(row['num_requests'] for row in rows))
+        self.assertEqual('default', rows[0]['module_id'])
+        self.assertIsInstance(rows[0]['avg_latency'], float)
+        self.assertLess(0, bq_util.bytes_scanned()['billed'])
+
+    def test_data_stays_local(self):
+        home_data = os.path.join(os.getenv('HOME'), 'bq_data/')
+        paths = (bq_util._DATA_DIRECTORY, bq_util._QUERY_CACHE_DIRECTORY,
+                 bq_util._JOB_STATS_LOG, bq_history._HISTORY_DIRECTORY)
+        for path in paths:
+            self.assertTrue(path.startswith(self.tmpdir), path)
+        bq_util.use_local_backend(None)
+        self.assertEqual(home_data, bq_util._DATA_DIRECTORY)
+        self.assertEqual(os.path.join(home_data, 'query_cache/'),
+                         bq_util._QUERY_CACHE_DIRECTORY)
+
+    def test_missing_table(self):
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_bigquery('SELECT 1 FROM [logs.requestlogs_20180101]',
+                                   retries=0)
+
+    def test_table_metadata(self):
+        self.assertTrue(bq_util.does_table_exist(
+            'khan-academy:logs.requestlogs_20190101'))
+        self.assertFalse(bq_util.does_table_exist(
+            'khan-academy:logs.requestlogs_20180101'))
+        self.assertEqual(
+            200, bq_util.get_table_metadata(
+                'khanacademy.org:deductive-jet-827:'
+                'logs.requestlogs_20190101')['row_count'])
+
+    def test_facts_query(self):
+        import requestlogs_facts
+        facts = bq_util.query_bigquery(
+            requestlogs_facts.facts_query('20190101'))
+        self.assertEqual(200, sum(row['requests'] for row in facts))
+        self.assertEqual(200, sum(row['log_rows'] for row in facts))
+
+
+if __name__ == '__main__':
+    unittest.main()
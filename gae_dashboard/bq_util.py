@@ -1,42 +1,593 @@
 """Utilities for interacting with BigQuery."""
 
+import array
+import collections
+import contextlib
 import cPickle
 import datetime
+import fcntl
+import hashlib
+import io
+import itertools
 import json
+import logging
 import os
 import random
+import re
 import sys
 import subprocess
+import threading
+import time
+import zipfile
+
+import bq_history
+import graphite_util
 
 
 _DATA_DIRECTORY = os.path.join(os.getenv('HOME'), 'bq_data/')
 
+# Where we log the statistics for every query job we run, as json lines.
+_JOB_STATS_LOG = os.path.join(_DATA_DIRECTORY, 'job_stats.jsonl')
+
+# How long (in ms) each getQueryResults call waits for a job to finish
+# before returning so we can poll again.
+_POLL_TIMEOUT_MS = 10 * 1000
+
+# The bigquery API service objects, one per thread since httplib2 isn't
+# thread-safe.  They are created lazily and reused for every call, so we
+# only pay for discovery and authentication once per process.
+_service_cache = threading.local()
+
+# If set, a bq_local.LocalBigQueryService we use instead of bigquery; see
+# use_local_backend().  Setting $BQ_UTIL_LOCAL_DB does the same thing.
+_local_service = None
+# While we're using it, the paths it replaced: (_DATA_DIRECTORY,
+# _QUERY_CACHE_DIRECTORY, _JOB_STATS_LOG, bq_history._HISTORY_DIRECTORY).
+_production_paths = None
+
 
 class BQException(Exception):
     """An error trying to fetch data from bigquery."""
     pass
 
 
+class ScanBudgetExceeded(BQException):
+    """A query would scan more bytes than set_scan_budget() allows."""
+    pass
+
+
+class BQCallError(subprocess.CalledProcessError):
+    """A bigquery API call, or the job it started, failed.
+
+    This subclasses CalledProcessError so callers written against the
+    `bq` command-line tool, which catch that and look at e.output, keep
+    working now that we talk to the API in-process.
+    """
+    def __init__(self, cmd, output):
+        super(BQCallError, self).__init__(1, cmd, output=output)
+
+
+def _set_paths(data_directory, query_cache_directory, job_stats_log,
+               history_directory):
+    global _DATA_DIRECTORY, _QUERY_CACHE_DIRECTORY, _JOB_STATS_LOG
+    _DATA_DIRECTORY = data_directory
+    _QUERY_CACHE_DIRECTORY = query_cache_directory
+    _JOB_STATS_LOG = job_stats_log
+    bq_history._HISTORY_DIRECTORY = history_directory
+
+
+def use_local_backend(db_filename, data_directory=None):
+    """Run queries against a local sqlite database instead of bigquery.
+
+    This is for benchmarking and testing reports offline; see bq_local
+    for what's supported, and how to fill the database with fixtures.
+    So that results from synthetic data never mix with the real ones,
+    the daily data, history, query cache and job statistics that would
+    go in ~/bq_data go in data_directory instead (by default, one next
+    to the database).  Pass None to go back to using bigquery, and
+    ~/bq_data.
+    """
+    global _local_service, _production_paths
+    if db_filename is None:
+        _local_service = None
+        if _production_paths is not None:
+            _set_paths(*_production_paths)
+            _production_paths = None
+        return
+
+    import bq_local
+    if _production_paths is None:
+        _production_paths = (_DATA_DIRECTORY, _QUERY_CACHE_DIRECTORY,
+                             _JOB_STATS_LOG, bq_history._HISTORY_DIRECTORY)
+    if data_directory is None:
+        data_directory = os.path.splitext(db_filename)[0] + '_bq_data'
+    _set_paths(os.path.join(data_directory, 'bq_data/'),
+               os.path.join(data_directory, 'query_cache/'),
+               os.path.join(data_directory, 'job_stats.jsonl'),
+               os.path.join(data_directory, 'history'))
+    _local_service = bq_local.LocalBigQueryService(db_filename)
+
+
+def _get_service():
+    """Return this thread's (cached) bigquery v2 API service object."""
+    if _local_service is not None:
+        return _local_service
+    service = getattr(_service_cache, 'service', None)
+    if service is None:
+        import cloudmonitoring_util
+        service = cloudmonitoring_util.get_cloud_service('bigquery', 'v2')
+        _service_cache.service = service
+    return service
+
+
+def _execute(request):
+    """Execute an API request, retrying on flaky network or server errors.
+
+    Raises BQCallError if the API returns a (non-retryable) error.
+    """
+    if _local_service is not None:
+        return request.execute()     # it raises BQCallError itself
+    import apiclient.errors
+    import cloudmonitoring_util
+    try:
+        return cloudmonitoring_util.execute_with_retries(request)
+    except apiclient.errors.HttpError as e:
+        try:
+            message = json.loads(e.content)['error']['message']
+        except (ValueError, KeyError, TypeError):
+            message = str(e)
+        raise BQCallError([request.methodId],
+                          'BigQuery error in %s: %s'
+                          % (request.methodId, message))
+
+
+def _parse_table_name(table_name, project):
+    """Split 'project:dataset.table' or 'dataset.table' into its parts."""
+    table_name = table_name.strip('[]')
+    if ':' in table_name and '.' in table_name.rsplit(':', 1)[1]:
+        project, table_name = table_name.rsplit(':', 1)
+    (dataset, table) = table_name.split('.', 1)
+    return (project, dataset, table)
+
+
+# Flags to `bq` (global or per-command) that take an argument.  All
+# others are booleans, possibly spelled --noFLAG.
+_BQ_VALUE_FLAGS = frozenset(('job_id', 'max_rows', 'destination_table',
+                             'source_format', 'format', 'project_id'))
+
+
+def _parse_bq_args(args):
+    """Parse a `bq` command line into (command, flags, positional args).
+
+    Global flags (which come before the command) and command flags are
+    merged into one dict; boolean flags map to True or False.
+    """
+    command = None
+    flags = {}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('--'):
+            (name, has_value, value) = arg[2:].partition('=')
+            if not has_value and name in _BQ_VALUE_FLAGS:
+                value = args.pop(0)
+                has_value = True
+            if has_value:
+                flags[name] = value
+            elif name.startswith('no') and name[2:]:
+                flags[name[2:]] = False
+            else:
+                flags[name] = True
+        elif command is None:
+            command = arg
+        else:
+            positional.append(arg)
+    return (command, flags, positional)
+
+
+def _cell_value(field, cell):
+    """Convert an API cell to what `bq --format=json` would have emitted."""
+    value = cell['v']
+    if value is None:
+        return None
+    if field.get('mode') == 'REPEATED':
+        single_field = dict(field, mode='NULLABLE')
+        return [_cell_value(single_field, v) for v in value]
+    if field['type'] == 'RECORD':
+        return _row_to_dict(field['fields'], value)
+    return value
+
+
+def _row_to_dict(fields, row):
+    return {field['name']: _cell_value(field, cell)
+            for (field, cell) in zip(fields, row['f'])}
+
+
+def _query_config(sql_query, project, flags):
+    """Return the 'query' part of a job configuration, given `bq` flags."""
+    query_config = {
+        'query': sql_query,
+        'useLegacySql': flags.get('use_legacy_sql', True),
+    }
+    if 'destination_table' in flags:
+        (dest_project, dataset, table) = _parse_table_name(
+            flags['destination_table'], project)
+        query_config['destinationTable'] = {'projectId': dest_project,
+                                            'datasetId': dataset,
+                                            'tableId': table}
+        query_config['writeDisposition'] = ('WRITE_TRUNCATE'
+                                            if flags.get('replace')
+                                            else 'WRITE_EMPTY')
+    if flags.get('allow_large_results'):
+        query_config['allowLargeResults'] = True
+    return query_config
+
+
+def _insert_query_job(sql_query, project, job_id, flags={}):
+    """Start a query job running; flags are as for `bq query`.
+
+    We do a dry run of the query first, to check it against the scan
+    budget; see set_scan_budget().
+    """
+    query_config = _query_config(sql_query, project, flags)
+    estimate = _check_scan_budget(
+        _estimate_bytes(query_config, project), sql_query)
+    body = {'jobReference': {'projectId': project, 'jobId': job_id},
+            'configuration': {'query': query_config}}
+    try:
+        _execute(_get_service().jobs().insert(projectId=project, body=body))
+    except BaseException:
+        with _state_lock:
+            _bytes_scanned['estimated'] -= estimate
+        raise
+    with _state_lock:
+        _pending_jobs.setdefault(job_id, {})['estimate'] = estimate
+
+
+def _api_query(flags, positional, project):
+    """Run a query job and return its rows as a list of dicts."""
+    job_id = flags.get('job_id') or 'bq_util_%s' % random.randint(
+        0, sys.maxint)
+    _insert_query_job(' '.join(positional), project, job_id, flags)
+    max_rows = int(flags['max_rows']) if 'max_rows' in flags else None
+    return _fetch_job_rows(project, job_id, max_rows)
+
+
+def _get_query_results_reply(project, job_id, page_token=None,
+                             max_results=None):
+    """Wait for a query job to finish, and return a page of its results.
+
+    Returns the getQueryResults reply, which has the result 'schema', the
+    'rows' themselves, and the 'pageToken' for the next page, if any.
+    """
+    service = _get_service()
+    kwargs = {'projectId': project, 'jobId': job_id,
+              'timeoutMs': _POLL_TIMEOUT_MS}
+    if page_token:
+        kwargs['pageToken'] = page_token
+    if max_results is not None:
+        kwargs['maxResults'] = max_results
+    while True:
+        reply = _execute(service.jobs().getQueryResults(**kwargs))
+        if reply.get('jobComplete'):
+            if job_id in _pending_jobs:
+                _record_job_stats(project, job_id)
+            return reply
+
+
+def _get_query_results_page(project, job_id, page_token=None,
+                            max_results=None):
+    """Return a pair (rows, the page-token for the next page or None).
+
+    The rows are dicts, just like `bq --format=json` emits.
+    """
+    reply = _get_query_results_reply(project, job_id, page_token, max_results)
+    fields = reply['schema']['fields']
+    return ([_row_to_dict(fields, row) for row in reply.get('rows', [])],
+            reply.get('pageToken'))
+
+
+# Limits on how many bytes our queries may scan; see set_scan_budget().
+_scan_budget = {
+    'per_query': None,      # None means no limit
+    'per_process': None,
+    'refuse': True,         # if False, we just warn about going over
+}
+
+# Reports run their queries from several threads at once, so updates to
+# _bytes_scanned, _pending_jobs, _job_stats, _query_cache_stats,
+# _table_metadata_cache and _streaming_buffer_cache are made while
+# holding this lock.
+_state_lock = threading.RLock()
+
+# How many bytes the queries run by this process were estimated (by a
+# dry run) to scan, and how many we were actually billed for.
+_bytes_scanned = {'estimated': 0, 'billed': 0}
+
+# Information about the jobs we've started but not yet recorded the
+# statistics for: job id -> {'estimate': ..., 'name': ..., 'retries': ...}.
+# The name and retries are filled in by whoever started the job (see
+# _run_query), before the job is started.
+_pending_jobs = {}
+
+# The statistics for finished jobs that haven't been sent to graphite yet.
+_job_stats = []
+
+
+def _track_job(job_id, name, retries):
+    """Note that we're about to start job_id, to record its stats later."""
+    with _state_lock:
+        _pending_jobs[job_id] = {'name': name, 'retries': retries}
+
+
+def _forget_job(job_id):
+    """Stop tracking a job; return what we knew about it, or None."""
+    with _state_lock:
+        return _pending_jobs.pop(job_id, None)
+
+
+def set_scan_budget(per_query=None, per_process=None, refuse=True):
+    """Limit how many bytes the queries run by this process may scan.
+
+    per_query is the most bytes any single query may scan, and
+    per_process the most that all the queries we run, put together, may
+    scan; None means no limit.  We check each query's dry-run estimate
+    against these before running it.  If it's over budget we raise
+    ScanBudgetExceeded, or, if refuse is False, just log a warning and
+    run it anyway.
+    """
+    _scan_budget['per_query'] = per_query
+    _scan_budget['per_process'] = per_process
+    _scan_budget['refuse'] = refuse
+
+
+def bytes_scanned():
+    """Return the bytes estimated and billed for this process's queries."""
+    with _state_lock:
+        return _bytes_scanned.copy()
+
+
+def _estimate_bytes(query_config, project):
+    """Return how many bytes a query would scan, via a dry run."""
+    body = {'configuration': {'query': query_config, 'dryRun': True}}
+    job = _execute(_get_service().jobs().insert(projectId=project,
+                                                body=body))
+    return int(job['statistics']['totalBytesProcessed'])
+
+
+def estimate_query_bytes(sql_query,
+                         project='khanacademy.org:deductive-jet-827',
+                         use_legacy_sql=True):
+    """Return how many bytes sql_query would scan, without running it."""
+    return _estimate_bytes(
+        _query_config(sql_query, project, {'use_legacy_sql': use_legacy_sql}),
+        project)
+
+
+def _check_scan_budget(estimate, sql_query):
+    """Raise or warn if a query would go over the scan budget.
+
+    If the query is allowed to run, its estimate is added to
+    _bytes_scanned['estimated'] right away, so queries being started
+    concurrently can't together go over the per-process limit; the
+    caller must take it back off if it doesn't start the query after
+    all.  Returns the estimate, for convenience.
+    """
+    with _state_lock:
+        problems = []
+        if (_scan_budget['per_query'] is not None
+                and estimate > _scan_budget['per_query']):
+            problems.append('the per-query limit of %s bytes'
+                            % _scan_budget['per_query'])
+        if (_scan_budget['per_process'] is not None
+                and (_bytes_scanned['estimated'] + estimate
+                     > _scan_budget['per_process'])):
+            problems.append('the per-process limit of %s bytes (%s bytes '
+                            'already used)' % (_scan_budget['per_process'],
+                                               _bytes_scanned['estimated']))
+        if problems:
+            msg = ('Query would scan %s bytes, over %s: %s'
+                   % (estimate, ' and '.join(problems), sql_query[:200]))
+            if _scan_budget['refuse']:
+                raise ScanBudgetExceeded(msg)
+            logging.warning(msg)
+        _bytes_scanned['estimated'] += estimate
+    return estimate
+
+
+def _record_job_stats(project, job_id, job=None):
+    """Record the statistics for a finished query job.
+
+    We log them, append them to _JOB_STATS_LOG, and queue them to be
+    sent to graphite by send_job_stats_to_graphite().  job is the job
+    resource, if the caller already has it.
+    """
+    info = _forget_job(job_id)
+    if info is None:
+        return      # another thread got here first
+    if job is None:
+        job = _execute(_get_service().jobs().get(projectId=project,
+                                                 jobId=job_id))
+    stats = job.get('statistics', {})
+    query_stats = stats.get('query', {})
+    # The times are all in ms since the epoch.
+    created = int(stats.get('creationTime', 0))
+    started = int(stats.get('startTime', created))
+    ended = int(stats.get('endTime', started))
+    record = {
+        'name': info.get('name') or 'unnamed',
+        'project': project,
+        'job_id': job_id,
+        'time_t': int(time.time()),
+        'wall_secs': (ended - created) / 1000.0,
+        'queue_secs': (started - created) / 1000.0,
+        'bytes_estimated': info.get('estimate', 0),
+        'bytes_processed': int(stats.get('totalBytesProcessed') or 0),
+        'bytes_billed': int(query_stats.get('totalBytesBilled') or 0),
+        'slot_ms': int(query_stats.get('totalSlotMs') or 0),
+        'cache_hit': bool(query_stats.get('cacheHit')),
+        'retries': info.get('retries', 0),
+    }
+    with _state_lock:
+        _bytes_scanned['billed'] += record['bytes_billed']
+        _job_stats.append(record)
+
+    logging.info('Job %s:%s (%s): %.1fs (%.1fs queued), estimated %s '
+                 'bytes, billed %s bytes%s',
+                 project, job_id, record['name'], record['wall_secs'],
+                 record['queue_secs'], record['bytes_estimated'],
+                 record['bytes_billed'],
+                 ' (cached)' if record['cache_hit'] else '')
+    if not os.path.isdir(_DATA_DIRECTORY):
+        os.makedirs(_DATA_DIRECTORY)
+    with open(_JOB_STATS_LOG, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+# The per-job statistics we send to graphite.
+_GRAPHITE_JOB_STATS = ('wall_secs', 'queue_secs', 'bytes_processed',
+                       'bytes_billed', 'slot_ms', 'cache_hit', 'retries')
+
+# How many records send_job_stats_to_graphite sends at a time.
+_GRAPHITE_BATCH_SIZE = 500
+
+
+def send_job_stats_to_graphite(graphite_host):
+    """Send the statistics for the query jobs we've run to graphite.
+
+    Each job's statistics go under the keys
+        webapp.gae.dashboard.bigquery_jobs.<name>.<statistic>
+    where <name> is the name the query was run under (see query_bigquery).
+    We send everything recorded since the last call, in batches.
+    graphite_host is as for graphite_util.send_to_graphite; if it's
+    None we just discard the statistics.
+    """
+    with _state_lock:
+        job_stats = _job_stats[:]
+        del _job_stats[:]
+    records = []
+    for record in job_stats:
+        name = re.sub(r'[^A-Za-z0-9_]', '_', record['name'])
+        for field in _GRAPHITE_JOB_STATS:
+            records.append(('webapp.gae.dashboard.bigquery_jobs.%s.%s'
+                            % (name, field),
+                            (record['time_t'], record[field])))
+    for batch in _batches(records, _GRAPHITE_BATCH_SIZE):
+        graphite_util.send_to_graphite(graphite_host, batch)
+
+
+def _api_cancel(flags, positional, project):
+    _execute(_get_service().jobs().cancel(projectId=project,
+                                          jobId=positional[0]))
+
+
+def _api_show(flags, positional, project):
+    (project, dataset, table) = _parse_table_name(positional[0], project)
+    return _execute(_get_service().tables().get(
+        projectId=project, datasetId=dataset, tableId=table))
+
+
+def _wait_for_job(project, job_id, operation):
+    """Poll a job until it's done; raise BQCallError if it failed."""
+    service = _get_service()
+    while True:
+        job = _execute(service.jobs().get(projectId=project, jobId=job_id))
+        if job['status']['state'] == 'DONE':
+            break
+        time.sleep(1)
+    if job['status'].get('errorResult'):
+        raise BQCallError(
+            [job_id], "BigQuery error in %s operation: Error processing "
+            "job '%s:%s': %s"
+            % (operation, project, job_id,
+               job['status']['errorResult']['message']))
+    return job
+
+
+def _api_load(flags, positional, project):
+    """Load a local file into a table: `bq load TABLE FILE [SCHEMA]`."""
+    import apiclient.http
+
+    (dest_project, dataset, table) = _parse_table_name(positional[0], project)
+    load_config = {
+        'destinationTable': {'projectId': dest_project, 'datasetId': dataset,
+                             'tableId': table},
+        'sourceFormat': flags.get('source_format', 'CSV'),
+        'writeDisposition': ('WRITE_TRUNCATE' if flags.get('replace')
+                             else 'WRITE_APPEND'),
+    }
+    if len(positional) > 2:
+        with open(positional[2]) as f:
+            load_config['schema'] = {'fields': json.load(f)}
+    job_id = 'bq_util_load_%s' % random.randint(0, sys.maxint)
+    body = {'jobReference': {'projectId': project, 'jobId': job_id},
+            'configuration': {'load': load_config}}
+    media = apiclient.http.MediaFileUpload(
+        positional[1], mimetype='application/octet-stream', resumable=True)
+    _execute(_get_service().jobs().insert(projectId=project, body=body,
+                                          media_body=media))
+    _wait_for_job(project, job_id, 'load')
+
+
+# The `bq` commands we implement in-process via the API.  Anything else
+# falls back to running the command-line tool.
+_API_COMMANDS = {
+    'query': _api_query,
+    'cancel': _api_cancel,
+    'show': _api_show,
+    'load': _api_load,
+}
+
+
+def _call_bq_api(subcommand_list, project):
+    """Run a `bq`-style command using the in-process API client.
+
+    Raises BQCallError if the API returns an error.
+    """
+    (command, flags, positional) = _parse_bq_args(subcommand_list)
+    return _API_COMMANDS[command](flags, positional, project)
+
+
+def _call_bq_cli(subcommand_list, project, return_output, **kwargs):
+    """Run the `bq` command-line tool as a subprocess."""
+    _BQ = ['bq', '-q', '--headless', '--project_id', project]
+    if return_output:
+        output = subprocess.check_output(_BQ + ['--format=json'] +
+                                         subcommand_list,
+                                         **kwargs)
+        if not output:    # apparently 'bq query' does this when 0 results
+            return None
+        try:
+            return json.loads(output)
+        except ValueError:
+            print 'Unexpected output from BQ call: %s' % output
+            raise
+    else:
+        subprocess.check_call(_BQ + ['--format=none'] + subcommand_list,
+                              **kwargs)
+
+
 def call_bq(subcommand_list, project, return_output=True,
             raise_exception=True, **kwargs):
-    """subcommand_list is, e.g. ['query', '--allow_large_results', ...]."""
-    _BQ = ['bq', '-q', '--headless', '--project_id', project]
+    """subcommand_list is, e.g. ['query', '--allow_large_results', ...].
+
+    The common commands (query, cancel, show and load) are run in-process
+    using the bigquery API, reusing one authenticated connection.  Other
+    commands, calls that need google-drive access, and calls that pass
+    subprocess kwargs, run the `bq` command-line tool instead.  Either
+    way, failures raise (a subclass of) subprocess.CalledProcessError.
+    """
+    (command, flags, _) = _parse_bq_args(subcommand_list)
+    use_api = (command in _API_COMMANDS and not flags.get('enable_gdrive')
+               and not kwargs)
     try:
-        if return_output:
-            output = subprocess.check_output(_BQ + ['--format=json'] +
-                                             subcommand_list,
-                                             **kwargs)
-            if not output:    # apparently 'bq query' does this when 0 results
-                return None
-            try:
-                return json.loads(output)
-            except ValueError as e:
-                print 'Unexpected output from BQ call: %s' % output
-                raise
+        if use_api:
+            output = _call_bq_api(subcommand_list, project)
         else:
-            subprocess.check_call(_BQ + ['--format=none'] + subcommand_list,
+            output = _call_bq_cli(subcommand_list, project, return_output,
                                   **kwargs)
-            return
+        return output if return_output else None
     except subprocess.CalledProcessError as e:
         if raise_exception:
             print 'BQ call failed with this output: %s' % e.output
@@ -46,15 +597,114 @@ def call_bq(subcommand_list, project, return_output=True,
             return e.output
 
 
+# How long (in seconds) we trust our list of a dataset's tables before
+# fetching it again.
+_TABLE_METADATA_TTL = 5 * 60
+
+# (project, dataset) -> (time we fetched it, {table id: metadata dict}).
+_table_metadata_cache = {}
+
+
+def _dataset_tables(project, dataset, billing_project):
+    """Return a dict of table id -> metadata for every table in a dataset.
+
+    We get this with a single query of the dataset's __TABLES__ meta-table,
+    and remember it for _TABLE_METADATA_TTL seconds.  The metadata is a
+    dict with 'row_count', 'size_bytes' and 'last_modified' (ms since the
+    epoch).  A dataset that doesn't exist has no tables.
+    """
+    with _state_lock:
+        (fetch_time, tables) = _table_metadata_cache.get((project, dataset),
+                                                         (0, None))
+    if time.time() - fetch_time < _TABLE_METADATA_TTL:
+        return tables
+
+    query = ('SELECT table_id, row_count, size_bytes, last_modified_time '
+             'FROM [%s:%s.__TABLES__]' % (project, dataset))
+    try:
+        rows = call_bq(['query', query], project=billing_project) or []
+    except subprocess.CalledProcessError as why:
+        if 'Not found: Dataset' not in why.output:
+            raise
+        rows = []
+    tables = {row['table_id']: {
+                  'row_count': int(row['row_count']),
+                  'size_bytes': int(row['size_bytes']),
+                  'last_modified': int(row['last_modified_time'])}
+              for row in rows}
+    with _state_lock:
+        _table_metadata_cache[(project, dataset)] = (time.time(), tables)
+    return tables
+
+
+def get_table_metadata(table_name,
+                       project='khanacademy.org:deductive-jet-827'):
+    """Return the metadata for a table, or None if it doesn't exist.
+
+    table_name is 'dataset.table' or 'project:dataset.table' (project
+    defaults to the given one).  The metadata is a dict with 'row_count',
+    'size_bytes' and 'last_modified' (in ms since the epoch).  This looks
+    at all the tables in the dataset at once, and caches what it finds
+    for a few minutes, so it's cheap to call for many tables.
+    """
+    (table_project, dataset, table) = _parse_table_name(table_name, project)
+    return _dataset_tables(table_project, dataset, project).get(table)
+
+
+# (project, dataset, table) -> (time we checked it, whether rows were
+# still being streamed into it).
+_streaming_buffer_cache = {}
+
+
+def _has_streaming_buffer(table_name, project):
+    """Return whether rows are still being streamed into a table.
+
+    Streamed rows don't reliably move the table's last-modified time
+    while they're in the streaming buffer.  __TABLES__ doesn't say
+    whether there is one, so we ask `bq show`, and remember the answer
+    for _TABLE_METADATA_TTL seconds.
+    """
+    (table_project, dataset, table) = _parse_table_name(table_name, project)
+    cache_key = (table_project, dataset, table)
+    with _state_lock:
+        (check_time, streaming) = _streaming_buffer_cache.get(cache_key,
+                                                              (0, None))
+    if time.time() - check_time < _TABLE_METADATA_TTL:
+        return streaming
+
+    metadata = call_bq(['show', '%s:%s.%s' % cache_key], project=project,
+                       raise_exception=False)
+    streaming = not isinstance(metadata, dict) or 'streamingBuffer' in metadata
+    with _state_lock:
+        _streaming_buffer_cache[cache_key] = (time.time(), streaming)
+    return streaming
+
+
 def does_table_exist(table_name):
     """Takes in a table name and checks if that table exists in BigQuery."""
-    result = call_bq(
-        ['show', table_name], project='khan-academy', raise_exception=False)
+    return get_table_metadata(table_name, project='khan-academy') is not None
 
-    if "Not found: Table" in result:
-        return False
-    else:
-        return True
+
+def daily_tables_in_range(table_prefix, start_date, end_date,
+                          project='khanacademy.org:deductive-jet-827'):
+    """Return which daily tables exist for the dates in a range.
+
+    table_prefix is the table name without the date, e.g.
+    'logs.requestlogs_'; start_date and end_date are datetime.date
+    objects (inclusive).  Returns a sorted list of the YYYYMMDD strings
+    for which a table <table_prefix>YYYYMMDD exists.
+    """
+    (table_project, dataset, prefix) = _parse_table_name(table_prefix,
+                                                         project)
+    tables = _dataset_tables(table_project, dataset, project)
+    retval = []
+    date = start_date
+    while date <= end_date:
+        yyyymmdd = date.strftime("%Y%m%d")
+        if prefix + yyyymmdd in tables:
+            retval.append(yyyymmdd)
+        date += datetime.timedelta(days=1)
+    return retval
 
 
 def _get_data_filename(report, yyyymmdd):
@@ -66,18 +716,241 @@ def _get_data_filename(report, yyyymmdd):
     return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymmdd + '.pickle')
 
 
+def _get_archive_filename(report, yyyymm):
+    """Gets the filename of a month's archive of old data.
+
+    See compact_daily_data.
+    """
+    return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymm + '.zip')
+
+
+# Saved daily data ends with a pickled (_CHECKSUM_TAG, sha1) pair, where
+# the sha1 is of everything before it, so we can tell if a file has been
+# truncated or garbled.  (Files saved before we did this don't have one.)
+_CHECKSUM_TAG = 'bq_util.sha1'
+_CHECKSUM_TRAILER_SIZE = len(cPickle.dumps((_CHECKSUM_TAG, '0' * 40),
+                                           cPickle.HIGHEST_PROTOCOL))
+
+
+def _is_checksum_trailer(record):
+    return (isinstance(record, tuple) and len(record) == 2 and
+            record[0] == _CHECKSUM_TAG)
+
+
+@contextlib.contextmanager
+def _locked(filename, exclusive):
+    """Hold an advisory lock to read (or, if exclusive, write) filename.
+
+    The lock is on a separate lockfile, since writers replace the data
+    file rather than modifying it.
+    """
+    with open(filename + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _checksum_ok(f):
+    """Return False if the open file f fails its checksum.
+
+    Files without a checksum pass, since we can't tell.  Leaves f
+    positioned at the start.
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    trailer = None
+    if size >= _CHECKSUM_TRAILER_SIZE:
+        f.seek(size - _CHECKSUM_TRAILER_SIZE)
+        try:
+            trailer = cPickle.loads(f.read())
+        except Exception:
+            pass
+    f.seek(0)
+    if not _is_checksum_trailer(trailer):
+        return True
+    sha1 = hashlib.sha1()
+    remaining = size - _CHECKSUM_TRAILER_SIZE
+    while remaining > 0:
+        chunk = f.read(min(remaining, 1024 * 1024))
+        sha1.update(chunk)
+        remaining -= len(chunk)
+    f.seek(0)
+    return sha1.hexdigest() == trailer[1]
+
+
+def _discard_corrupt_data(f):
+    """Move aside the corrupt data file f, so it'll get re-fetched.
+
+    We only do so if it's still there: someone may have just replaced
+    it with a good copy.  Corrupt entries in monthly archives are left
+    alone, but since per-day files take precedence over the archives,
+    re-fetching the data will still replace them.
+    """
+    if not isinstance(f, file):
+        logging.warning('Ignoring corrupt archived data %s', f.name)
+        return
+    filename = f.name
+    with _locked(filename, exclusive=True):
+        try:
+            still_there = (os.stat(filename).st_ino ==
+                           os.fstat(f.fileno()).st_ino)
+        except OSError:
+            still_there = False
+        if still_there:
+            logging.warning('Discarding corrupt saved data %s', filename)
+            os.rename(filename, filename + '.corrupt')
+
+
+def _open_archived_data(report, yyyymmdd):
+    """Return a day's data from its monthly archive as a file, or None.
+
+    See compact_daily_data.
+    """
+    archive_filename = _get_archive_filename(report, yyyymmdd[:6])
+    if not os.path.exists(archive_filename):
+        return None
+    member = os.path.basename(_get_data_filename(report, yyyymmdd))
+    with _locked(archive_filename, exclusive=False):
+        try:
+            with zipfile.ZipFile(archive_filename) as archive:
+                f = io.BytesIO(archive.read(member))
+        except (IOError, KeyError):
+            return None
+        except zipfile.BadZipfile as e:
+            logging.warning('Corrupt archive %s: %s', archive_filename, e)
+            return None
+    f.name = '%s:%s' % (archive_filename, member)
+    return f
+
+
+def _open_daily_data(report, yyyymmdd):
+    """Return the open, verified data file for a report, or None.
+
+    We look for the day's own file first, and then in the monthly
+    archive.  A corrupt file is moved aside and treated as missing.
+    """
+    filename = _get_data_filename(report, yyyymmdd)
+    if os.path.exists(filename):
+        with _locked(filename, exclusive=False):
+            try:
+                f = open(filename, 'rb')
+            except IOError:
+                f = None
+    else:
+        f = None
+    if f is None:
+        f = _open_archived_data(report, yyyymmdd)
+        if f is None:
+            return None
+    # Writers replace the file rather than changing it, so what we've
+    # opened won't change under us now that we've let go of the lock.
+    if _checksum_ok(f):
+        return f
+    with f:
+        _discard_corrupt_data(f)
+    return None
+
+
+def _load_records(f):
+    """Yield the pickled records in an open data file.
+
+    Raises IOError, after moving the file aside, if it's corrupt but
+    didn't have a checksum to tell us so up front.
+    """
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+        unpickler = cPickle.Unpickler(f)
+        while True:
+            start = f.tell()
+            try:
+                record = unpickler.load()
+            except EOFError:
+                if start == size:
+                    return
+                # We ran out of file partway through a record.
+                _discard_corrupt_data(f)
+                raise IOError('Truncated saved data %s' % f.name)
+            except Exception as e:
+                _discard_corrupt_data(f)
+                raise IOError('Corrupt saved data %s: %s' % (f.name, e))
+            if _is_checksum_trailer(record):
+                return
+            yield record
+
+
+def has_daily_data(report, yyyymmdd):
+    """Return True if we have (uncorrupted) old data for a report."""
+    f = _open_daily_data(report, yyyymmdd)
+    if f is None:
+        return False
+    f.close()
+    return True
+
+
+def iter_daily_data(report, yyyymmdd):
+    """Yield the rows of old data for a particular report, a batch at a time.
+
+    This is like get_daily_data, but reads the data incrementally (see
+    save_daily_data), and yields nothing if there's no data.
+    """
+    f = _open_daily_data(report, yyyymmdd)
+    if f is None:
+        return
+    for batch in _load_records(f):
+        for row in batch:
+            yield row
+
+
 def get_daily_data(report, yyyymmdd):
     """Gets old data for a particular report.
 
     Returns the data in the format saved (see save_daily_data or the caller),
-    or None if there is no old data for that report on that day.
+    or None if there is no old data for that report on that day.  Data that
+    has been corrupted is discarded, so also gives None.
     """
-    filename = _get_data_filename(report, yyyymmdd)
-    if not os.path.exists(filename):
+    f = _open_daily_data(report, yyyymmdd)
+    if f is None:
         return None
-    else:
-        with open(filename) as f:
-            return cPickle.load(f)
+    try:
+        records = list(_load_records(f))
+    except IOError as e:
+        logging.warning(str(e))
+        return None
+    if len(records) == 1:
+        return records[0]
+    # The data was saved a batch of rows at a time.
+    return [row for batch in records for row in batch]
+
+
+def _batches(rows, batch_size):
+    """Yield lists of up to batch_size items from an iterable."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# How many rows we pickle at a time when saving data.
+_SAVE_BATCH_SIZE = 10000
+
+
+class _ChecksummingFile(object):
+    """A file wrapper that keeps the sha1 of what's written to it."""
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, s):
+        self.sha1.update(s)
+        self.f.write(s)
 
 
 def save_daily_data(data, report, yyyymmdd):
@@ -86,26 +959,260 @@ def save_daily_data(data, report, yyyymmdd):
     This will create the relevant directories if they don't exist, and clobber
     any existing data with the same timestamp.  "data" can be anything
     pickleable, but in general will likely be of the format returned from
-    _query_bigquery, namely a list of dicts fieldname -> value.
+    _query_bigquery, namely a list of dicts fieldname -> value.  It may
+    also be an iterator of rows, such as query_bigquery_iter returns, in
+    which case we save it a batch at a time rather than holding it all in
+    memory.
+
+    We write to a temp file that we rename into place, holding the file's
+    lock, so readers -- even in other processes -- never see partial data,
+    and we append a checksum so get_daily_data can tell if the file gets
+    corrupted anyway.
+
+    For reports listed in bq_history.REPORT_KEY_COLUMNS, we also save the
+    numeric columns to the columnar history store, for use in sparklines.
     """
     filename = _get_data_filename(report, yyyymmdd)
     if not os.path.isdir(os.path.dirname(filename)):
         os.makedirs(os.path.dirname(filename))
-    with open(filename, 'w') as f:
+    tmp_filename = '%s.tmp.%s' % (filename, os.getpid())
+    with _locked(filename, exclusive=True):
+        try:
+            with open(tmp_filename, 'wb') as f:
+                _write_daily_data(_ChecksummingFile(f), data, report,
+                                  yyyymmdd)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+
+
+def _write_daily_data(f, data, report, yyyymmdd):
+    """Pickle data, and a checksum, to f, a _ChecksummingFile."""
+    if not isinstance(data, (list, collections.Iterator)):
         cPickle.dump(data, f)
+    else:
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+
+        def pickled_rows():
+            for batch in _batches(data, _SAVE_BATCH_SIZE):
+                pickler.dump(batch)
+                # Each batch stands alone, so don't memoize across them.
+                pickler.clear_memo()
+                for row in batch:
+                    yield row
+
+        if report in bq_history.REPORT_KEY_COLUMNS:
+            bq_history.save_day(report, yyyymmdd, pickled_rows())
+        else:
+            for _ in pickled_rows():
+                pass
+    f.f.write(cPickle.dumps((_CHECKSUM_TAG, f.sha1.hexdigest()),
+                            cPickle.HIGHEST_PROTOCOL))
+
+
+# How long we keep each report's daily data, in days, and the most disk
+# (in bytes) it may use; see compact_daily_data().  Reports not listed
+# here use _DEFAULT_RETENTION.
+RETENTION_POLICIES = {
+    # email_uptime compares against the last month; keep a year for
+    # the reliability reports.
+    'uptime': {'retention_days': 400, 'max_bytes': 100 * 1024 ** 2},
+    # These are big, and only used for the last two weeks' sparklines.
+    'log_bytes': {'retention_days': 90, 'max_bytes': 2 * 1024 ** 3},
+    'client_api_usage': {'retention_days': 90, 'max_bytes': 2 * 1024 ** 3},
+}
+_DEFAULT_RETENTION = {'retention_days': 400, 'max_bytes': 5 * 1024 ** 3}
+
+# Daily data older than this gets rolled into monthly archives.
+_ARCHIVE_AFTER_DAYS = 35
+
+_DATA_FILENAME_RE = re.compile(r'^(.+)_(\d{8})\.pickle$')
+_ARCHIVE_FILENAME_RE = re.compile(r'^(.+)_(\d{6})\.zip$')
+
+
+def _remove_data_file(filename, expected_stat=None):
+    """Remove a data file, holding its lock.
+
+    If expected_stat is given, only remove the file if it hasn't been
+    replaced since we stat-ed it.  We leave the lockfile: another
+    process may be waiting on it, and if we removed it that process
+    and one that opened a new lockfile could both hold "the" lock.
+    """
+    with _locked(filename, exclusive=True):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return
+        if expected_stat is not None and (
+                (st.st_ino, st.st_mtime) !=
+                (expected_stat.st_ino, expected_stat.st_mtime)):
+            return
+        os.unlink(filename)
+
+
+def _update_archive(report, yyyymm, day_filenames, oldest_yyyymmdd):
+    """Add day files to a month's archive, and drop days that are too old.
+
+    Returns the files that were archived, mapped to their stat results
+    from when we read them.  Corrupt files aren't archived.
+    """
+    archive_filename = _get_archive_filename(report, yyyymm)
+    archived = {}
+    with _locked(archive_filename, exclusive=True):
+        members = {}
+        if os.path.exists(archive_filename):
+            with zipfile.ZipFile(archive_filename) as archive:
+                for name in archive.namelist():
+                    members[name] = archive.read(name)
+        for filename in day_filenames:
+            with _locked(filename, exclusive=False):
+                with open(filename, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    if not _checksum_ok(f):
+                        continue
+                    members[os.path.basename(filename)] = f.read()
+            archived[filename] = st
+        for name in members.keys():
+            if _DATA_FILENAME_RE.match(name).group(2) < oldest_yyyymmdd:
+                del members[name]
+
+        if not members:
+            if os.path.exists(archive_filename):
+                os.unlink(archive_filename)
+            return archived
+        tmp_filename = '%s.tmp.%s' % (archive_filename, os.getpid())
+        try:
+            with zipfile.ZipFile(tmp_filename, 'w',
+                                 zipfile.ZIP_DEFLATED) as archive:
+                for name in sorted(members):
+                    archive.writestr(name, members[name])
+            os.rename(tmp_filename, archive_filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+    return archived
+
+
+def compact_daily_data(today=None, reports=None,
+                       archive_after_days=_ARCHIVE_AFTER_DAYS,
+                       verbose=False):
+    """Archive and expire old daily data saved by save_daily_data.
+
+    Daily data older than archive_after_days is rolled into compressed
+    monthly archives, <report>_<YYYYMM>.zip, which get_daily_data reads
+    from when a day has no file of its own.  We delete data older than
+    the report's retention window, and then, if the report is still
+    using more than its maximum number of bytes, its oldest data until
+    it isn't; see RETENTION_POLICIES.  If reports is given, we only
+    look at those reports.  Returns a dict mapping each report to the
+    number of days archived and the number of files deleted.
+    """
+    today = today or datetime.date.today()
+    archive_before = (today - datetime.timedelta(archive_after_days)
+                      ).strftime("%Y%m%d")
+    if not os.path.isdir(_DATA_DIRECTORY):
+        return {}
+
+    day_files = collections.defaultdict(dict)   # report -> {yyyymmdd: file}
+    archive_files = collections.defaultdict(dict)   # report -> {yyyymm: file}
+    for filename in os.listdir(_DATA_DIRECTORY):
+        m = _DATA_FILENAME_RE.match(filename)
+        if m:
+            day_files[m.group(1)][m.group(2)] = os.path.join(
+                _DATA_DIRECTORY, filename)
+            continue
+        m = _ARCHIVE_FILENAME_RE.match(filename)
+        if m:
+            archive_files[m.group(1)][m.group(2)] = os.path.join(
+                _DATA_DIRECTORY, filename)
+
+    retval = {}
+    for report in sorted(set(day_files) | set(archive_files)):
+        if reports is not None and report not in reports:
+            continue
+        policy = RETENTION_POLICIES.get(report, _DEFAULT_RETENTION)
+        oldest = (today - datetime.timedelta(policy['retention_days'])
+                  ).strftime("%Y%m%d")
+        stats = retval[report] = {'archived': 0, 'deleted': 0}
+
+        # First, expire data that's too old.
+        days = day_files[report]
+        for yyyymmdd in sorted(days):
+            if yyyymmdd < oldest:
+                _remove_data_file(days.pop(yyyymmdd))
+                stats['deleted'] += 1
+        archives = archive_files[report]
+        for yyyymm in sorted(archives):
+            if yyyymm < oldest[:6]:
+                _remove_data_file(archives.pop(yyyymm))
+                stats['deleted'] += 1
+
+        # Then, archive old days, by month.  We also rewrite the archive
+        # for the month the retention window starts in, to expire the
+        # days in it that are too old.
+        to_archive = collections.defaultdict(list)
+        for (yyyymmdd, filename) in days.iteritems():
+            if yyyymmdd < archive_before:
+                to_archive[yyyymmdd[:6]].append(filename)
+        if oldest[:6] in archives:
+            to_archive.setdefault(oldest[:6], [])
+        for (yyyymm, filenames) in sorted(to_archive.iteritems()):
+            archived = _update_archive(report, yyyymm, filenames, oldest)
+            for (filename, st) in archived.iteritems():
+                _remove_data_file(filename, expected_stat=st)
+                del days[_DATA_FILENAME_RE.match(
+                    os.path.basename(filename)).group(2)]
+            stats['archived'] += len(archived)
+            archive_filename = _get_archive_filename(report, yyyymm)
+            if os.path.exists(archive_filename):
+                archives[yyyymm] = archive_filename
+            else:
+                archives.pop(yyyymm, None)
+
+        # Finally, delete the oldest data until we're under the size cap.
+        by_age = sorted([(yyyymmdd, filename)
+                         for (yyyymmdd, filename) in days.iteritems()] +
+                        [(yyyymm + '00', filename)
+                         for (yyyymm, filename) in archives.iteritems()])
+        sizes = [os.path.getsize(filename) for (_, filename) in by_age]
+        total = sum(sizes)
+        for ((_, filename), size) in zip(by_age, sizes):
+            if total <= policy['max_bytes']:
+                break
+            _remove_data_file(filename)
+            stats['deleted'] += 1
+            total -= size
+
+        if verbose and (stats['archived'] or stats['deleted']):
+            print '%s: archived %s days, deleted %s files' % (
+                report, stats['archived'], stats['deleted'])
+    return retval
 
 
 def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
     """Attempts to get the requested data from disk, otherwise querying BQ.
 
     If BigQuery is hit, the result will be cached to disk so that future
-    queries for the same data don't need to go to BigQuery.
+    queries for the same data don't need to go to BigQuery.  (If the
+    query itself has been run recently, query_bigquery will get it from
+    its own cache.)
     """
     daily_data = get_daily_data(report, yyyymmdd)
     if not daily_data:
-        print "-- Running query for %s on %s --" % (report, yyyymmdd)
-        print query
-        daily_data = query_bigquery(query)
+        cache_info = {}
+        daily_data = query_bigquery(query, cache_ttl=QUERY_CACHE_TTL,
+                                    cache_info=cache_info)
+        if cache_info['cached']:
+            print ("-- Using cached query results for %s on %s --"
+                   % (report, yyyymmdd))
+        else:
+            print "-- Ran query for %s on %s --" % (report, yyyymmdd)
+            print query
         save_daily_data(daily_data, report, yyyymmdd)
     else:
         print "-- Using cached data for %s on %s --" % (report, yyyymmdd)
@@ -113,15 +1220,21 @@ def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
     return daily_data
 
 
-def process_past_data(report, end_date, history_length, keyfn):
+def process_past_data(report, end_date, history_length, keyfn,
+                      backfill_query=None):
     """Get and process the past data for a particular report.
 
     Returns a list of dicts, one for each day, in most-recent-first order, with
     keys of the form returned by keyfn(row), and values the same type of rows
     returned by `bq`.  If there is no data, the dict will be empty.
     'history_length' is the number of days of data to include, not counting the
-    current one.
+    current one.  If backfill_query is given, it's a function from YYYYMMDD
+    to the report's query, and we first re-run it for any days we're missing;
+    see backfill_daily_data.
     """
+    if backfill_query is not None:
+        backfill_daily_data({report: backfill_query}, end_date,
+                            history_length)
     historical_data = []
     for i in xrange(history_length + 1):
         old_yyyymmdd = (end_date - datetime.timedelta(i)).strftime("%Y%m%d")
@@ -139,66 +1252,286 @@ def process_past_data(report, end_date, history_length, keyfn):
     return historical_data
 
 
-def query_bigquery(sql_query, gdrive=False, retries=2, job_name=None,
-                   project='khanacademy.org:deductive-jet-827'):
-    """Use the 'bq' tool to run a query, and return the results as
-    a json list (each row is a dict).
+def _missing_days(report, dates):
+    """Return the dates (YYYYMMDD) for which we have no saved report data."""
+    return [yyyymmdd for yyyymmdd in dates
+            if not has_daily_data(report, yyyymmdd)]
 
-    We do naive type conversion to int and float, when possible.
 
-    The bq tool fails every once in a while for flaky reasons, so by default we
-    retry the query a few times.
+def backfill_daily_data(queries, end_date, history_length,
+                        table_prefix='logs.requestlogs_', row_filters={},
+                        dates=None, max_concurrent=5,
+                        project='khanacademy.org:deductive-jet-827'):
+    """Re-run the queries for days whose saved report data is missing.
 
-    This requires 'pip install bigquery' be run on this machine.
+    When a nightly run fails, the reports' sparklines have a hole for
+    that day for as long as it's in the history window.  This fills such
+    holes: queries maps a report name to a function taking a YYYYMMDD
+    string and returning the sql for that report on that day.  We look
+    for missing days in the history_length days before end_date (not
+    counting end_date itself, which the report will fetch), run their
+    queries -- up to max_concurrent at once, for all the reports
+    together -- and save the results, just as the report would have.
 
-    If you'd like to view the results of this query in the bigquery web UI, you
-    may wish to pass a unique string as the `job_name` param. Note that if the
-    first attempt at this query fails, we'll overwrite the job_name with a
-    randomly generated one.
+    Days for which the logs table (table_prefix + YYYYMMDD) doesn't exist
+    are skipped, since there's nothing to query.  row_filters optionally
+    maps a report name to a function saying which of its rows to keep,
+    for reports that drop some rows before saving.  If dates (a list of
+    YYYYMMDD strings in the window) is given, we only look at those days.
+    Returns a dict mapping each report to the list of days we filled in;
+    days whose queries failed are reported and left missing.
     """
-    # We could probably do 'import bq' and call out directly, but
-    # I couldn't figure out an easy way to do this.  Ah well.
-    # To avoid having to deal with paging (which I think the command-line bq is
-    # not very good at anyway), we just get a bunch of rows.  We probably only
-    # want to display the first 100 or so, but the rest may be useful to save.
+    start_date = end_date - datetime.timedelta(history_length)
+    if dates is None:
+        dates = [(end_date - datetime.timedelta(i)).strftime("%Y%m%d")
+                 for i in xrange(history_length, 0, -1)]
+    missing = {report: _missing_days(report, dates) for report in queries}
+    if not any(missing.itervalues()):
+        return {report: [] for report in queries}
 
-    table = None
-    error_msg = None
+    available = set(daily_tables_in_range(
+        table_prefix, start_date, end_date - datetime.timedelta(1),
+        project=project))
+    to_run = {}
+    for (report, days) in missing.iteritems():
+        for yyyymmdd in days:
+            if yyyymmdd in available:
+                name = 'backfill_%s_%s' % (report, yyyymmdd)
+                to_run[name] = (report, yyyymmdd)
+            else:
+                print ("-- Can't backfill %s for %s: no %s%s table --"
+                       % (report, yyyymmdd, table_prefix, yyyymmdd))
+
+    filled = {report: [] for report in queries}
+    results = query_bigquery_many(
+        {name: queries[report](yyyymmdd)
+         for (name, (report, yyyymmdd)) in to_run.iteritems()},
+        project=project, cache_ttl=QUERY_CACHE_TTL,
+        max_concurrent=max_concurrent)
+    for (name, rows) in results:
+        (report, yyyymmdd) = to_run[name]
+        if isinstance(rows, BQException):
+            print '-- Backfilling %s for %s failed: %s --' % (
+                report, yyyymmdd, rows)
+            continue
+        if report in row_filters:
+            rows = [row for row in rows if row_filters[report](row)]
+        print '-- Backfilled %s for %s (%s rows) --' % (report, yyyymmdd,
+                                                      len(rows))
+        save_daily_data(rows, report, yyyymmdd)
+        filled[report].append(yyyymmdd)
+    for days in filled.itervalues():
+        days.sort()
+    return filled
+
+
+# The content-addressed query-result cache used by query_bigquery.
+_QUERY_CACHE_DIRECTORY = os.path.join(_DATA_DIRECTORY, 'query_cache/')
+# How long to cache the results of queries of finished daily tables.
+# Callers opt in to the cache by passing this (or another) cache_ttl.
+QUERY_CACHE_TTL = 7 * 24 * 60 * 60
+# When the cache gets bigger than this, we evict least-recently-used entries.
+_QUERY_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Bump this when what we store in the cache changes, so old entries
+# are ignored (and eventually evicted).
+_QUERY_CACHE_FORMAT = 2
+
+_query_cache_stats = {'hits': 0, 'misses': 0, 'uncacheable': 0,
+                      'evictions': 0}
+
+# Tables in bigquery sql look like [project:dataset.table@decorator],
+# `project.dataset.table`, or (after FROM or JOIN) dataset.table.
+_TABLE_RE = re.compile(r'\[([\w.:-]+\.[\w$]+(?:@[^\]]*)?)\]'
+                       r'|`([\w.:-]+\.[\w$]+(?:@[^`]*)?)`'
+                       r'|\b(?:FROM|JOIN)\s+([\w.:-]+\.[\w$]+)',
+                       re.IGNORECASE)
+# The results of queries using these aren't a function of the tables' data.
+_NONDETERMINISTIC_RE = re.compile(
+    r'\b(NOW|RAND|CURRENT_(DATE|TIME|TIMESTAMP))\b', re.IGNORECASE)
 
-    for i in range(1 + retries):
+
+def _normalize_sql(sql_query):
+    """Strip comments and collapse whitespace outside of string literals."""
+    output = []
+    quote = None
+    i = 0
+    while i < len(sql_query):
+        c = sql_query[i]
+        if quote:
+            output.append(c)
+            if c == '\\':
+                output.append(sql_query[i + 1:i + 2])
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+            output.append(c)
+        elif c == '#' or sql_query.startswith('--', i):
+            while i < len(sql_query) and sql_query[i] != '\n':
+                i += 1
+            continue
+        elif c.isspace():
+            if output and output[-1] != ' ':
+                output.append(' ')
+        else:
+            output.append(c)
+        i += 1
+    return ''.join(output).strip()
+
+
+def _query_cache_key(sql_query, project):
+    """Return the cache key for a query, or None if it's not cacheable.
+
+    The key is a hash of the normalized sql text, the project, and the
+    last-modified time of every table it reads from, so editing the query
+    or updating its input tables automatically invalidates the cache.
+    We get the last-modified times from get_table_metadata, which
+    caches them for a few minutes, so a hit doesn't cost a bigquery
+    call per table.  Queries using table decorators, tables that are
+    still being streamed into, or functions like NOW() aren't
+    cacheable, since their results change over time.
+    """
+    normalized_sql = _normalize_sql(sql_query)
+    if _NONDETERMINISTIC_RE.search(normalized_sql):
+        return None
+    tables = set(''.join(m) for m in _TABLE_RE.findall(normalized_sql))
+    last_modified = {}
+    for table in tables:
+        if '@' in table:
+            return None
+        table = table.replace('`', '')
+        if ':' not in table and table.count('.') == 2:
+            # `project.dataset.table` in standard sql.
+            table = table.replace('.', ':', 1)
+        metadata = get_table_metadata(table, project=project)
+        if metadata is None or _has_streaming_buffer(table, project):
+            return None
+        last_modified[table] = metadata['last_modified']
+    key = json.dumps([_QUERY_CACHE_FORMAT, normalized_sql, project,
+                      sorted(last_modified.items())])
+    return hashlib.sha1(key).hexdigest()
+
+
+def _get_query_cache_filename(key):
+    return os.path.join(_QUERY_CACHE_DIRECTORY, key + '.pickle')
+
+
+def _load_pages(f):
+    """Yield each (fields, columns) page pickled to f, until EOF."""
+    unpickler = cPickle.Unpickler(f)
+    while True:
         try:
-            if not job_name:
-                # We specify the job-name (randomly) so we can cancel it.
-                job_name = 'bq_util_%s' % random.randint(0, sys.maxint)
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
+def _load_batches(f):
+    """Yield the rows of each page pickled to f; see _load_pages."""
+    return _pages_to_rows(_load_pages(f))
+
+
+def _open_query_cache(key):
+    """Return the cache entry for key, opened to its rows, or None.
+
+    Cache entries hold a pickled expiry time followed by the results,
+    pickled a page of columns at a time; see _load_pages.  Returns None
+    if the entry is missing or expired.
+    """
+    filename = _get_query_cache_filename(key)
+    try:
+        f = open(filename)
+        expires = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    if expires < time.time():
+        f.close()
+        os.unlink(filename)
+        return None
+    # Mark the entry as recently used, for LRU eviction.
+    os.utime(filename, None)
+    return f
+
+
+def _read_query_cache(key):
+    """Return the cached result for key, or None if it's missing or expired."""
+    f = _open_query_cache(key)
+    if f is None:
+        return None
+    with f:
+        return list(_load_batches(f))
+
 
-            # call_bq can return None when there are no results for
-            # the query.  We map that to [].
-            table = call_bq(['--job_id', job_name] +
-                            (['--enable_gdrive'] if gdrive else []) +
-                            ['query', '--max_rows=10000', sql_query],
-                            project=project) or []
-            job_name = None     # to indicate the job has finished
+def _evict_from_query_cache(max_bytes):
+    """Delete least-recently-used entries until the cache fits in max_bytes."""
+    entries = []
+    for basename in os.listdir(_QUERY_CACHE_DIRECTORY):
+        if '.tmp.' in basename:
+            continue        # some process's entry, still being written
+        try:
+            st = os.stat(os.path.join(_QUERY_CACHE_DIRECTORY, basename))
+        except OSError:
+            continue        # another process evicted it
+        entries.append((st.st_mtime, st.st_size, basename))
+    total_bytes = sum(size for (_, size, _) in entries)
+    for (_, size, basename) in sorted(entries):
+        if total_bytes <= max_bytes:
             break
-        except subprocess.CalledProcessError as why:
-            print "-- Running query failed with retcode %d --" % why.returncode
-            error_msg = why.output
-        finally:
-            if job_name:
-                try:        # Cancel the job if it's still running
-                    call_bq(['--nosync', 'cancel', job_name],
-                            project=project, return_output=False)
-                except subprocess.CalledProcessError:
-                    print "That's ok, it just means the job canceled itself."
-                    pass    # probably means the job finished already
-
-            # Clear out job_name so it will be regenerated if this query failed
-            job_name = None
-
-    if table is None:
-        raise BQException("-- Query failed after %d retries: %s --"
-                          % (retries, error_msg))
-
-    for row in table:
+        try:
+            os.unlink(os.path.join(_QUERY_CACHE_DIRECTORY, basename))
+        except OSError:
+            pass
+        total_bytes -= size
+        with _state_lock:
+            _query_cache_stats['evictions'] += 1
+
+
+def _cache_pages(key, pages, ttl):
+    """Yield (fields, columns) pages, saving them to the cache as they go by.
+
+    The cache entry is only created once all the pages have been yielded,
+    so a partially consumed iterator doesn't leave a truncated entry.
+    """
+    if not os.path.isdir(_QUERY_CACHE_DIRECTORY):
+        os.makedirs(_QUERY_CACHE_DIRECTORY)
+    filename = _get_query_cache_filename(key)
+    tmp_filename = '%s.tmp.%s' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w') as f:
+            pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+            pickler.dump(time.time() + ttl)
+            for page in pages:
+                pickler.dump(page)
+                pickler.clear_memo()
+                yield page
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+    _evict_from_query_cache(_QUERY_CACHE_MAX_BYTES)
+
+
+def _write_query_cache(key, pages, ttl):
+    for _ in _cache_pages(key, pages, ttl):
+        pass
+
+
+def query_cache_stats():
+    """Return a dict of hit/miss/uncacheable/eviction counts for this run."""
+    with _state_lock:
+        return dict(_query_cache_stats)
+
+
+def _coerce_types(rows):
+    """Do naive type conversion to int and float, in place, when possible.
+
+    We only use this when we don't know the schema of the results, namely
+    for queries run via the command-line tool.  Otherwise we use the much
+    faster (and more accurate) _convert_columns.
+    """
+    for row in rows:
         for key in row:
             if row[key] is None:
                 row[key] = '(None)'
@@ -214,4 +1547,495 @@ def query_bigquery(sql_query, gdrive=False, retries=2, job_name=None,
                     # Row maybe a list
                     pass
 
-    return table
+
+# Maps a column type in the result schema to how we convert its values
+# (which the API gives us as strings).  Other types are left as strings.
+_CONVERTERS = {
+    'INTEGER': int,
+    'INT64': int,
+    'FLOAT': float,
+    'FLOAT64': float,
+    'NUMERIC': float,
+    # The API gives timestamps as (float) seconds since the epoch.
+    'TIMESTAMP': float,
+    'BOOLEAN': lambda v: v == 'true',
+    'BOOL': lambda v: v == 'true',
+}
+
+
+def _convert_columns(fields, api_rows, null='(None)'):
+    """Convert query results from the API to a list of typed columns.
+
+    Rather than guessing the type of every cell, we pick a converter for
+    each column based on its type in the result schema, and apply it to
+    the whole column at once.  NULLs become `null`.  Repeated and record
+    fields are converted to lists and dicts (of strings), like the
+    command-line tool does.
+    """
+    cells = [row['f'] for row in api_rows]
+    columns = []
+    for (i, field) in enumerate(fields):
+        if field.get('mode') == 'REPEATED' or field['type'] in ('RECORD',
+                                                                'STRUCT'):
+            values = [_cell_value(field, row[i]) for row in cells]
+            converter = None
+        else:
+            values = [row[i]['v'] for row in cells]
+            converter = _CONVERTERS.get(field['type'])
+        if None in values:
+            if converter:
+                values = [null if v is None else converter(v) for v in values]
+            else:
+                values = [null if v is None else v for v in values]
+        elif converter:
+            values = map(converter, values)
+        columns.append(values)
+    return columns
+
+
+def _columns_to_rows(fields, columns):
+    names = [field['name'] for field in fields]
+    return [dict(itertools.izip(names, values))
+            for values in itertools.izip(*columns)]
+
+
+def _rows_to_page(rows):
+    """Return a list of row-dicts as a (fields, columns) page.
+
+    This is for results we got as rows, from the command-line tool,
+    so the fields have no types.
+    """
+    names = sorted(rows[0]) if rows else []
+    return ([{'name': name, 'type': None} for name in names],
+            [[row[name] for row in rows] for name in names])
+
+
+def _pages_to_rows(pages):
+    """Yield the rows of an iterable of (fields, columns) pages."""
+    for (fields, columns) in pages:
+        for row in _columns_to_rows(fields, columns):
+            yield row
+
+
+# The array.array typecodes we store columns of these types in.
+_ARRAY_TYPECODES = {
+    'INTEGER': 'l',
+    'INT64': 'l',
+    'FLOAT': 'd',
+    'FLOAT64': 'd',
+    'NUMERIC': 'd',
+    'TIMESTAMP': 'd',
+}
+
+
+def _pages_to_columns(pages):
+    """Concatenate (fields, columns) pages into a dict of name -> values.
+
+    Numeric columns, going by their type in the schema, are stored as
+    array.array's, unless they have NULLs (or an int too big for a
+    long) -- then, like other columns, they're lists.
+    """
+    retval = {}
+    for (fields, columns) in pages:
+        for (field, values) in itertools.izip(fields, columns):
+            name = field['name']
+            column = retval.get(name)
+            if column is None:
+                typecode = (field.get('mode') != 'REPEATED' and
+                            _ARRAY_TYPECODES.get(field['type']))
+                column = retval[name] = (array.array(typecode) if typecode
+                                         else [])
+            if isinstance(column, array.array):
+                try:
+                    column.fromlist(values)     # unchanged if it fails
+                    continue
+                except (TypeError, OverflowError):
+                    column = retval[name] = column.tolist()
+            column.extend(values)
+    return retval
+
+
+def _lookup_query_cache(sql_query, project, cache_ttl):
+    """Return (cache key or None, opened cache entry or None) for a query.
+
+    See _open_query_cache.  This also updates the cache statistics.
+    """
+    if not cache_ttl:
+        return (None, None)
+    cache_key = _query_cache_key(sql_query, project)
+    if cache_key is None:
+        stat = 'uncacheable'
+        f = None
+    else:
+        f = _open_query_cache(cache_key)
+        stat = 'misses' if f is None else 'hits'
+    with _state_lock:
+        _query_cache_stats[stat] += 1
+    return (cache_key, f)
+
+
+# The base delay before resubmitting a failed query; it doubles with each
+# retry, and we pick a random delay up to that (to avoid thundering herds).
+_RETRY_BACKOFF_SECS = 5
+
+
+def _sleep_before_retry(num_retries_so_far):
+    """Sleep for an exponentially growing, jittered amount of time."""
+    time.sleep(random.uniform(
+        0, _RETRY_BACKOFF_SECS * 2 ** num_retries_so_far))
+
+
+def _get_job_or_none(project, job_id):
+    """Return the job resource for job_id, or None if we can't get it."""
+    try:
+        return _execute(_get_service().jobs().get(projectId=project,
+                                                  jobId=job_id))
+    except subprocess.CalledProcessError:
+        return None
+
+
+def _fetch_job_rows(project, job_id, max_rows=None):
+    """Wait for a query job and return up to max_rows of its rows.
+
+    The rows are dicts, just like call_bq returns for a query.
+    """
+    rows = []
+    page_token = None
+    while True:
+        max_results = None if max_rows is None else max_rows - len(rows)
+        (page, page_token) = _get_query_results_page(
+            project, job_id, page_token, max_results)
+        rows.extend(page)
+        if not page_token or (max_rows is not None and len(rows) >= max_rows):
+            return rows
+
+
+def _run_query(sql_query, gdrive, retries, job_name, project, max_rows=None,
+               stats_name=None):
+    """Run a query via call_bq, retrying on failure.
+
+    Returns a pair (the rows call_bq returned, up to max_rows of them; the
+    id of the job that ran the query).  The job's statistics are recorded
+    under stats_name.
+
+    If we lose track of the job -- say the command-line tool or an API
+    call fails -- but the job itself is still running or succeeded, we
+    reattach to it rather than paying for the query again.  We only
+    resubmit the query if the job itself failed (or we can't tell), and
+    then only after an exponential backoff.
+    """
+    error_msg = None
+    num_submits = 0
+    reattach = False     # True if job_name is a job we should reattach to
+
+    for i in xrange(1 + retries):
+        if not reattach:
+            if not job_name:
+                # We specify the job-name (randomly) so we can find it again.
+                job_name = 'bq_util_%s' % random.randint(0, sys.maxint)
+            if not gdrive:      # gdrive queries don't go through the API
+                _track_job(job_name, stats_name, num_submits)
+            num_submits += 1
+
+        try:
+            if reattach:
+                print "-- Reattaching to job %s --" % job_name
+                table = _fetch_job_rows(
+                    project, job_name,
+                    max_rows if max_rows is not None or gdrive else None)
+            else:
+                if max_rows is not None:
+                    max_rows_flags = ['--max_rows=%d' % max_rows]
+                elif gdrive:
+                    # The command-line tool defaults to 100 rows.
+                    max_rows_flags = ['--max_rows=%d' % (2 ** 31 - 1)]
+                else:
+                    max_rows_flags = []
+                # call_bq can return None when there are no results for
+                # the query.  We map that to [].
+                table = call_bq(['--job_id', job_name] +
+                                (['--enable_gdrive'] if gdrive else []) +
+                                ['query'] + max_rows_flags + [sql_query],
+                                project=project) or []
+            return (table, job_name)
+        except subprocess.CalledProcessError as why:
+            print "-- Running query failed with retcode %d --" % why.returncode
+            error_msg = why.output
+        except BaseException:
+            # Including ScanBudgetExceeded: we're not going to retry.
+            _forget_job(job_name)
+            raise
+
+        job = _get_job_or_none(project, job_name)
+        if job is not None and not job['status'].get('errorResult'):
+            # The job is fine, it's just that we lost track of it.
+            reattach = True
+            continue
+
+        # The job failed (or we can't find out how it's doing), so we'll
+        # have to start again with a new job.
+        _forget_job(job_name)
+        if job is None:
+            try:        # Cancel the job in case it's still running
+                call_bq(['--nosync', 'cancel', job_name],
+                        project=project, return_output=False)
+            except subprocess.CalledProcessError:
+                print "That's ok, it just means the job canceled itself."
+                pass    # probably means the job finished already
+        job_name = None
+        reattach = False
+        if i < retries:
+            _sleep_before_retry(num_submits - 1)
+
+    if reattach:
+        # We never managed to get the results, so stop paying for them.
+        _forget_job(job_name)
+        try:
+            call_bq(['--nosync', 'cancel', job_name],
+                    project=project, return_output=False)
+        except subprocess.CalledProcessError:
+            pass    # probably means the job finished already
+
+    raise BQException("-- Query failed after %d retries: %s --"
+                      % (retries, error_msg))
+
+
+def query_bigquery(sql_query, gdrive=False, retries=2, job_name=None,
+                   project='khanacademy.org:deductive-jet-827',
+                   cache_ttl=0, columnar=False,
+                   stats_name=None, cache_info=None):
+    """Run a query via call_bq, and return the results as a json list
+    (each row is a dict).
+
+    We convert values to int, float or bool based on the types in the
+    result schema (or for gdrive queries, where we don't know the schema,
+    we do naive type conversion to int and float, when possible).  NULLs
+    become the string '(None)'.
+
+    If columnar is True, we instead return a dict mapping each column name
+    to a list of its values -- or, for int and float columns, an
+    array.array -- which is more compact for big results.
+
+    BigQuery fails every once in a while for flaky reasons, so by default we
+    retry the query a few times.
+
+    This requires 'pip install google-api-python-client' be run on this
+    machine (or, for gdrive queries, 'pip install bigquery').
+
+    If you'd like to view the results of this query in the bigquery web UI, you
+    may wish to pass a unique string as the `job_name` param. Note that if the
+    first attempt at this query fails, we'll overwrite the job_name with a
+    randomly generated one.
+
+    If cache_ttl is set, results are cached on disk for that many seconds
+    (usually QUERY_CACHE_TTL), keyed on the query text and the state of
+    the tables it reads; see _query_cache_key.  Only ask for this when
+    the tables aren't going to change under you in ways the key can't
+    see, e.g. a past day's logs.  If you pass a dict as `cache_info`, we
+    set its 'cached' key to whether the results came from the cache.
+
+    Queries are checked against the scan budget before they're run, if
+    one has been set; see set_scan_budget().  Statistics about the job
+    that ran the query (time taken, bytes billed, etc.) are recorded
+    under `stats_name`, which should say what the query is for, e.g.
+    the name of a report; see send_job_stats_to_graphite.
+
+    This returns every row of the result, however many there are; for big
+    results, consider query_bigquery_iter instead.
+    """
+    pages = _iter_query_pages(sql_query, gdrive, retries, job_name, project,
+                              cache_ttl, _DEFAULT_PAGE_SIZE, stats_name,
+                              cache_info)
+    if columnar:
+        return _pages_to_columns(pages)
+    return list(_pages_to_rows(pages))
+
+
+# How many rows query_bigquery_iter fetches at a time.
+_DEFAULT_PAGE_SIZE = 10000
+
+
+def query_bigquery_iter(sql_query, gdrive=False, retries=2, job_name=None,
+                        project='khanacademy.org:deductive-jet-827',
+                        cache_ttl=0,
+                        page_size=_DEFAULT_PAGE_SIZE, stats_name=None):
+    """Like query_bigquery, but yields the rows a page at a time.
+
+    This fetches results in pages of page_size rows, so it works on
+    results of any size while only holding one page in memory at a time.
+    Rows have had the same type conversion query_bigquery does.  If
+    cache_ttl is set, results are read from, and saved to, the same
+    cache query_bigquery uses (though they're only saved if you read all
+    of them).
+    """
+    return _pages_to_rows(_iter_query_pages(
+        sql_query, gdrive, retries, job_name, project, cache_ttl, page_size,
+        stats_name))
+
+
+def _iter_query_pages(sql_query, gdrive, retries, job_name, project,
+                      cache_ttl, page_size, stats_name, cache_info=None):
+    """Yield the results of a query as (fields, columns) pages.
+
+    The columns are as converted by _convert_columns.  Pages come from,
+    and are saved to, the query cache; cache_info is as for query_bigquery.
+    """
+    (cache_key, cached) = _lookup_query_cache(sql_query, project, cache_ttl)
+    if cache_info is not None:
+        cache_info['cached'] = cached is not None
+    if cached is not None:
+        with cached:
+            for page in _load_pages(cached):
+                yield page
+        return
+
+    if gdrive:
+        # We need the command-line tool for these, which can't page.
+        (rows, _) = _run_query(sql_query, gdrive, retries, job_name, project,
+                               stats_name=stats_name)
+        _coerce_types(rows)
+        pages = [_rows_to_page(rows)]
+    else:
+        # Wait for the job to finish, but don't fetch any rows yet.
+        (_, job_id) = _run_query(sql_query, gdrive, retries, job_name,
+                                 project, max_rows=0, stats_name=stats_name)
+        pages = _iter_job_pages(project, job_id, page_size)
+
+    if cache_key:
+        pages = _cache_pages(cache_key, pages, cache_ttl)
+    for page in pages:
+        yield page
+
+
+def _iter_job_pages(project, job_id, page_size):
+    """Yield a finished query job's results as (fields, columns) pages."""
+    page_token = None
+    while True:
+        reply = _get_query_results_reply(project, job_id, page_token,
+                                         page_size)
+        fields = reply['schema']['fields']
+        yield (fields, _convert_columns(fields, reply.get('rows', [])))
+        page_token = reply.get('pageToken')
+        if not page_token:
+            return
+
+
+# How long query_bigquery_many waits between checking on its jobs.
+_POLL_INTERVAL_SECS = 1
+
+
+def query_bigquery_many(queries, retries=2,
+                        project='khanacademy.org:deductive-jet-827',
+                        cache_ttl=0,
+                        max_concurrent=10):
+    """Run several queries concurrently, yielding results as they finish.
+
+    queries is a dict mapping a name of your choosing to the sql to run.
+    We start up to max_concurrent jobs at once, and then poll them all
+    together; each time one finishes we yield a pair (name, result),
+    where result is a list of rows just like query_bigquery returns.  If
+    a query fails (even after retrying it), or is over the scan budget,
+    result is a BQException instead, and the other queries carry on
+    regardless.
+
+    Like query_bigquery, if we have trouble talking to a job we keep
+    checking on it rather than starting again, and only resubmit queries
+    whose jobs actually failed, after an exponential backoff.
+
+    Job statistics are recorded under each query's name.  If cache_ttl
+    is set, results are read from and saved to the query_bigquery cache.
+    """
+    to_submit = sorted(queries.iteritems())
+    running = {}      # job id -> (name, sql, cache key, number of attempts)
+    # Failed queries waiting to be resubmitted:
+    # (when to resubmit, name, sql, cache key, number of attempts)
+    backing_off = []
+    num_flakes = collections.Counter()    # job id -> failed polls
+
+    def submit(name, sql, cache_key, attempts):
+        """Start a job; return the exception to yield if we couldn't."""
+        job_id = 'bq_util_%s' % random.randint(0, sys.maxint)
+        _track_job(job_id, str(name), attempts)
+        try:
+            _insert_query_job(sql, project, job_id)
+        except BQCallError as e:
+            _forget_job(job_id)
+            return BQException("-- Query failed to start: %s --" % e.output)
+        except ScanBudgetExceeded as e:
+            _forget_job(job_id)
+            return e
+        running[job_id] = (name, sql, cache_key, attempts + 1)
+
+    while to_submit or running or backing_off:
+        for retry in sorted(backing_off):
+            if retry[0] <= time.time() and len(running) < max_concurrent:
+                backing_off.remove(retry)
+                (_, name, sql, cache_key, attempts) = retry
+                failure = submit(name, sql, cache_key, attempts)
+                if failure:
+                    yield (name, failure)
+
+        while to_submit and len(running) < max_concurrent:
+            (name, sql) = to_submit.pop(0)
+            (cache_key, cached) = _lookup_query_cache(sql, project,
+                                                      cache_ttl)
+            if cached is not None:
+                with cached:
+                    yield (name, list(_load_batches(cached)))
+                continue
+            failure = submit(name, sql, cache_key, 0)
+            if failure:
+                yield (name, failure)
+
+        any_finished = False
+        for (job_id, (name, sql, cache_key, attempts)) in running.items():
+            try:
+                job = _execute(_get_service().jobs().get(projectId=project,
+                                                         jobId=job_id))
+                if job['status']['state'] != 'DONE':
+                    continue
+                error = job['status'].get('errorResult')
+                if job_id in _pending_jobs:
+                    _record_job_stats(project, job_id, job)
+                if not error:
+                    pages = list(_iter_job_pages(project, job_id,
+                                                 _DEFAULT_PAGE_SIZE))
+            except BQCallError as e:
+                # We couldn't talk to the job, but it may well be fine,
+                # so we'll just check on it again next time around.
+                num_flakes[job_id] += 1
+                if num_flakes[job_id] <= retries:
+                    print ("-- Checking on query %s failed, will reattach: "
+                           "%s --" % (name, e.output))
+                    continue
+                error = {'message': e.output}
+            any_finished = True
+            del running[job_id]
+            _forget_job(job_id)
+
+            if error:
+                print ("-- Running query %s failed (attempt %d): %s --"
+                       % (name, attempts, error['message']))
+                if attempts <= retries:
+                    # Resubmit it after an exponential (jittered) backoff.
+                    backoff = random.uniform(
+                        0, _RETRY_BACKOFF_SECS * 2 ** (attempts - 1))
+                    backing_off.append((time.time() + backoff, name, sql,
+                                        cache_key, attempts))
+                else:
+                    yield (name, BQException(
+                        "-- Query failed after %d retries: %s --"
+                        % (attempts - 1, error['message'])))
+                continue
+
+            if cache_key:
+                _write_query_cache(cache_key, pages, cache_ttl)
+            yield (name, list(_pages_to_rows(pages)))
+
+        if (running or backing_off) and not any_finished:
+            time.sleep(_POLL_INTERVAL_SECS)
+
+
+if os.environ.get('BQ_UTIL_LOCAL_DB'):
+    # Now, before anything reads or writes the real ~/bq_data.
+    use_local_backend(os.environ['BQ_UTIL_LOCAL_DB'])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for bq_util's handling of query results.
+
+These don't talk to bigquery: they time the python side of things on
+synthetic results shaped like what the API returns.  Run as
+    ./bq_util_benchmark.py [--rows N]
+"""
+
+import argparse
+import random
+import timeit
+
+import bq_util
+
+
+_FIELDS = [
+    {'name': 'url_route', 'type': 'STRING'},
+    {'name': 'kaid', 'type': 'STRING'},
+    {'name': 'count_', 'type': 'INTEGER'},
+    {'name': 'instance_hours', 'type': 'FLOAT'},
+    {'name': 'module_id', 'type': 'STRING'},
+    {'name': 'latency', 'type': 'FLOAT'},
+]
+
+
+def _api_rows(num_rows):
+    """Return num_rows of fake getQueryResults rows matching _FIELDS."""
+    rng = random.Random(0)
+    modules = ['default', 'batch', 'highmem', None]
+    rows = []
+    for i in xrange(num_rows):
+        rows.append({'f': [
+            {'v': 'main:/route/%s' % (i % 5000)},
+            # A string column that looks like a number.
+            {'v': '%020d' % rng.randint(0, 10 ** 18)},
+            {'v': str(rng.randint(1, 100000))},
+            {'v': repr(rng.random() * 100)},
+            {'v': rng.choice(modules)},
+            {'v': repr(rng.random())},
+        ]})
+    return rows
+
+
+def benchmark_coercion(num_rows, repeat=3):
+    """Compare per-cell try/except coercion with schema-driven columns."""
+    api_rows = _api_rows(num_rows)
+
+    def per_cell():
+        rows = [bq_util._row_to_dict(_FIELDS, row) for row in api_rows]
+        bq_util._coerce_types(rows)
+        return rows
+
+    def by_column():
+        columns = bq_util._convert_columns(_FIELDS, api_rows)
+        return bq_util._columns_to_rows(_FIELDS, columns)
+
+    def by_column_columnar():
+        return bq_util._convert_columns(_FIELDS, api_rows)
+
+    for (name, fn) in (('per-cell try/except', per_cell),
+                       ('schema-driven, rows', by_column),
+                       ('schema-driven, columns', by_column_columnar)):
+        secs = min(timeit.repeat(fn, number=1, repeat=repeat))
+        print '%-25s %8.3fs  (%d rows)' % (name, secs, num_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Number of rows in the fixture (default '
+                             '%(default)s)')
+    args = parser.parse_args()
+    benchmark_coercion(args.rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,813 @@
+import array
+import cPickle
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import bq_util
+
+
+class _FakeRequest(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class FakeBigQueryService(object):
+    """Just enough of the bigquery v2 API to run bq_util against.
+
+    `results` maps a query string to a (schema fields, rows) pair, where
+    each row is a list of string-or-None cell values.  `failures` maps a
+    query string to the number of its jobs that should fail, `flakes` to
+    the number of times fetching its results should fail even though the
+    job is fine, and `bytes_processed` to how many bytes it scans.
+    """
+    def __init__(self, results=None, tables=None):
+        self.results = results or {}
+        self.tables_by_id = tables or {}
+        self.failures = {}
+        self.flakes = {}
+        self.bytes_processed = {}
+        self.jobs_by_id = {}
+        self.failed_job_ids = set()
+        self.calls = []
+
+    # The `jobs` and `tables` resources are both just this object.
+    def jobs(self):
+        return self
+
+    def tables(self):
+        return self
+
+    def insert(self, projectId, body, media_body=None):
+        if body['configuration'].get('dryRun'):
+            query = body['configuration']['query']['query']
+            self.calls.append(('dryRun', None))
+            return _FakeRequest(lambda: {'statistics': {
+                'totalBytesProcessed': str(self.bytes_processed.get(query,
+                                                                    0))}})
+        self.calls.append(('insert', body['jobReference']['jobId']))
+
+        def fn():
+            job_id = body['jobReference']['jobId']
+            self.jobs_by_id[job_id] = body
+            query = body['configuration']['query']['query']
+            if self.failures.get(query):
+                self.failures[query] -= 1
+                self.failed_job_ids.add(job_id)
+            return {'jobReference': body['jobReference'],
+                    'status': {'state': 'RUNNING'}}
+        return _FakeRequest(fn)
+
+    def getQueryResults(self, projectId, jobId, timeoutMs=None,
+                        maxResults=None, pageToken=None):
+        self.calls.append(('getQueryResults', jobId))
+
+        def fn():
+            query = self.jobs_by_id[jobId]['configuration']['query']['query']
+            if jobId in self.failed_job_ids:
+                raise bq_util.BQCallError(['getQueryResults'], 'oops')
+            if self.flakes.get(query):
+                self.flakes[query] -= 1
+                raise bq_util.BQCallError(['getQueryResults'], 'flaky')
+            (fields, rows) = self.results[query]
+            start = int(pageToken or 0)
+            end = len(rows) if maxResults is None else start + maxResults
+            reply = {'jobComplete': True,
+                     'schema': {'fields': fields},
+                     'rows': [{'f': [{'v': v} for v in row]}
+                              for row in rows[start:end]]}
+            if end < len(rows):
+                reply['pageToken'] = str(end)
+            return reply
+        return _FakeRequest(fn)
+
+    def cancel(self, projectId, jobId):
+        self.calls.append(('cancel', jobId))
+        return _FakeRequest(lambda: {})
+
+    def get(self, projectId, datasetId=None, tableId=None, jobId=None):
+        self.calls.append(('get', jobId or tableId))
+
+        def fn():
+            if jobId is None:
+                return self.tables_by_id[(datasetId, tableId)]
+            if jobId not in self.jobs_by_id:
+                raise bq_util.BQCallError(['get'], 'Not found: Job')
+            query = self.jobs_by_id[jobId]['configuration']['query']['query']
+            if jobId in self.failed_job_ids:
+                return {'status': {'state': 'DONE',
+                                   'errorResult': {'message': 'oops'}}}
+            num_bytes = str(self.bytes_processed.get(query, 0))
+            return {'status': {'state': 'DONE'},
+                    'statistics': {'creationTime': '1000',
+                                   'startTime': '1500',
+                                   'endTime': '4000',
+                                   'totalBytesProcessed': num_bytes,
+                                   'query': {'totalBytesBilled': num_bytes,
+                                             'totalSlotMs': '300',
+                                             'cacheHit': False}}}
+        return _FakeRequest(fn)
+
+
+class BQTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        self.service = FakeBigQueryService()
+        self.mock(bq_util, '_get_service', lambda: self.service)
+        self.mock(bq_util, '_execute', lambda request: request.execute())
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(cache_dir))
+        self.mock(bq_util, '_QUERY_CACHE_DIRECTORY', cache_dir)
+        self.mock(bq_util, '_query_cache_stats',
+                  dict.fromkeys(bq_util._query_cache_stats, 0))
+        self.mock(bq_util, '_scan_budget', dict(bq_util._scan_budget))
+        self.mock(bq_util, '_bytes_scanned', {'estimated': 0, 'billed': 0})
+        self.mock(bq_util, '_pending_jobs', {})
+        self.mock(bq_util, '_RETRY_BACKOFF_SECS', 0)
+        self.mock(bq_util, '_job_stats', [])
+        self.mock(bq_util, '_streaming_buffer_cache', {})
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(log_dir))
+        self.mock(bq_util, '_JOB_STATS_LOG',
+                  os.path.join(log_dir, 'job_stats.jsonl'))
+
+    def mock(self, container, var_str, new_value):
+        if hasattr(container, var_str):
+            oldval = getattr(container, var_str)
+            self.mock_origs[(container, var_str)] = oldval
+            self.addCleanup(lambda: setattr(container, var_str, oldval))
+        else:
+            self.mock_origs[(container, var_str)] = None
+            self.addCleanup(lambda: delattr(container, var_str))
+        setattr(container, var_str, new_value)
+
+
+class TestParseBqArgs(unittest.TestCase):
+    def test_global_and_command_flags(self):
+        self.assertEqual(
+            ('query', {'job_id': 'j1', 'max_rows': '10', 'sync': False,
+                       'use_legacy_sql': False},
+             ['SELECT 1']),
+            bq_util._parse_bq_args(['--job_id', 'j1', '--nosync', 'query',
+                                    '--max_rows=10', '--nouse_legacy_sql',
+                                    'SELECT 1']))
+
+
+class TestCallBq(BQTestCase):
+    def test_query_converts_rows_like_the_cli(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'route', 'type': 'STRING'},
+             {'name': 'count', 'type': 'INTEGER'},
+             {'name': 'tags', 'type': 'STRING', 'mode': 'REPEATED'}],
+            [['/a', '3', [{'v': 't1'}, {'v': 't2'}]],
+             ['/b', None, []]])
+        self.assertEqual(
+            [{'route': '/a', 'count': '3', 'tags': ['t1', 't2']},
+             {'route': '/b', 'count': None, 'tags': []}],
+            bq_util.call_bq(['query', 'SELECT x'], project='p'))
+
+    def test_query_follows_pages_up_to_max_rows(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'n', 'type': 'INTEGER'}],
+            [[str(i)] for i in xrange(5)])
+        rows = bq_util.call_bq(['query', '--max_rows=4', 'SELECT x'],
+                               project='p')
+        self.assertEqual(['0', '1', '2', '3'], [r['n'] for r in rows])
+
+    def test_show(self):
+        self.service.tables_by_id[('logs', 'requestlogs_20190101')] = {
+            'id': 'logs.requestlogs_20190101'}
+        self.assertEqual(
+            {'id': 'logs.requestlogs_20190101'},
+            bq_util.call_bq(['show', 'p:logs.requestlogs_20190101'],
+                            project='p'))
+
+    def test_failures_are_called_process_errors(self):
+        def fail(subcommand_list, project):
+            raise bq_util.BQCallError(subcommand_list, 'Not found: Table')
+        self.mock(bq_util, '_call_bq_api', fail)
+
+        self.assertEqual('Not found: Table',
+                         bq_util.call_bq(['show', 'logs.foo'], project='p',
+                                         raise_exception=False))
+        with self.assertRaises(subprocess.CalledProcessError):
+            bq_util.call_bq(['show', 'logs.foo'], project='p')
+
+
+class TestQueryBigquery(BQTestCase):
+    def test_type_conversion(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'route', 'type': 'STRING'},
+             {'name': 'zip', 'type': 'STRING'},
+             {'name': 'count', 'type': 'INTEGER'},
+             {'name': 'cost', 'type': 'FLOAT'},
+             {'name': 'ok', 'type': 'BOOLEAN'}],
+            [['/a', '02139', '3', '1.5', 'true'],
+             [None, '94041', '4', None, 'false']])
+        self.assertEqual(
+            [{'route': '/a', 'zip': '02139', 'count': 3, 'cost': 1.5,
+              'ok': True},
+             {'route': '(None)', 'zip': '94041', 'count': 4,
+              'cost': '(None)', 'ok': False}],
+            bq_util.query_bigquery('SELECT x', project='p'))
+
+    def test_columnar(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'route', 'type': 'STRING'},
+             {'name': 'count', 'type': 'INTEGER'},
+             {'name': 'cost', 'type': 'FLOAT'}],
+            [['/a', '3', '1.5'], ['/b', '4', None]])
+        columns = bq_util.query_bigquery('SELECT x', project='p',
+                                         columnar=True)
+        self.assertEqual(['/a', '/b'], columns['route'])
+        self.assertEqual(array.array('l', [3, 4]), columns['count'])
+        self.assertEqual([1.5, '(None)'], columns['cost'])
+
+        # The types come from the schema, not the values.
+        self.service.results['SELECT y'] = (
+            [{'name': 'n', 'type': 'FLOAT'}, {'name': 's', 'type': 'STRING'}],
+            [['1', '1'], ['2', '2']])
+        columns = bq_util.query_bigquery('SELECT y', project='p',
+                                         columnar=True)
+        self.assertEqual(array.array('d', [1.0, 2.0]), columns['n'])
+        self.assertEqual(['1', '2'], columns['s'])
+        # Including when they come from the cache.
+        self.assertEqual(columns, bq_util.query_bigquery(
+            'SELECT y', project='p', columnar=True))
+
+    def test_retries_with_a_new_job(self):
+        self.service.results['SELECT x'] = ([], [])
+        attempts = []
+        orig_call_bq = bq_util.call_bq
+
+        def flaky_call_bq(subcommand_list, project, **kwargs):
+            attempts.append(subcommand_list)
+            if len(attempts) == 1:
+                raise bq_util.BQCallError(subcommand_list, 'flaky')
+            return orig_call_bq(subcommand_list, project, **kwargs)
+        self.mock(bq_util, 'call_bq', flaky_call_bq)
+
+        self.assertEqual([], bq_util.query_bigquery('SELECT x', project='p'))
+        # The failed query, its cancel, and the successful retry.
+        self.assertEqual(['query', 'cancel', 'query'],
+                         [bq_util._parse_bq_args(args)[0]
+                          for args in attempts])
+
+    def test_reattaches_to_a_job_that_succeeded(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'n', 'type': 'INTEGER'}], [['1']])
+        self.service.flakes['SELECT x'] = 2
+        self.assertEqual([{'n': 1}],
+                         bq_util.query_bigquery('SELECT x', project='p'))
+        self.assertEqual(1, len([c for c in self.service.calls
+                                 if c[0] == 'insert']))
+        self.assertNotIn('cancel', [c[0] for c in self.service.calls])
+
+    def test_resubmits_failed_jobs_with_backoff(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'n', 'type': 'INTEGER'}], [['1']])
+        self.service.failures['SELECT x'] = 2
+        sleeps = []
+        self.mock(bq_util, '_sleep_before_retry', sleeps.append)
+        self.assertEqual([{'n': 1}],
+                         bq_util.query_bigquery('SELECT x', project='p'))
+        self.assertEqual(3, len([c for c in self.service.calls
+                                 if c[0] == 'insert']))
+        self.assertEqual([0, 1], sleeps)
+
+    def test_iter_pages_through_all_rows(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'n', 'type': 'INTEGER'}],
+            [[str(i)] for i in xrange(25)])
+        rows = bq_util.query_bigquery_iter('SELECT x', project='p',
+                                           cache_ttl=60, page_size=10)
+        self.assertEqual(range(25), [r['n'] for r in rows])
+        # One call to wait for the job, and then three pages.
+        self.assertEqual(4, len([c for c in self.service.calls
+                                 if c[0] == 'getQueryResults']))
+        # And now it's cached.
+        self.assertEqual(range(25), [r['n'] for r in
+                                     bq_util.query_bigquery_iter(
+                                         'SELECT x', project='p',
+                                         cache_ttl=60)])
+        self.assertEqual(1, len([c for c in self.service.calls
+                                 if c[0] == 'insert']))
+
+    def test_partially_read_results_are_not_cached(self):
+        self.service.results['SELECT x'] = (
+            [{'name': 'n', 'type': 'INTEGER'}],
+            [[str(i)] for i in xrange(25)])
+        rows = bq_util.query_bigquery_iter('SELECT x', project='p',
+                                           cache_ttl=60, page_size=10)
+        rows.next()
+        rows.close()
+        self.assertEqual([], os.listdir(bq_util._QUERY_CACHE_DIRECTORY))
+
+
+class TestDailyData(BQTestCase):
+    def setUp(self):
+        super(TestDailyData, self).setUp()
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+
+    def test_save_iterator_in_batches(self):
+        self.mock(bq_util, '_SAVE_BATCH_SIZE', 2)
+        rows = ({'route': '/%s' % i} for i in xrange(5))
+        bq_util.save_daily_data(rows, 'report', '20190101')
+        self.assertEqual(['/0', '/1', '/2', '/3', '/4'],
+                         [r['route'] for r in
+                          bq_util.get_daily_data('report', '20190101')])
+        self.assertEqual(['/0', '/1', '/2', '/3', '/4'],
+                         [r['route'] for r in
+                          bq_util.iter_daily_data('report', '20190101')])
+
+    def test_save_other_data(self):
+        bq_util.save_daily_data({'a': 1}, 'report', '20190101')
+        self.assertEqual({'a': 1},
+                         bq_util.get_daily_data('report', '20190101'))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190102'))
+
+    def test_atomic_save(self):
+        bq_util.save_daily_data([{'a': 1}], 'report', '20190101')
+
+        def bad_rows():
+            yield {'a': 2}
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            bq_util.save_daily_data(bad_rows(), 'report', '20190101')
+        self.assertEqual([{'a': 1}],
+                         bq_util.get_daily_data('report', '20190101'))
+        self.assertEqual(['report_20190101.pickle',
+                          'report_20190101.pickle.lock'],
+                         sorted(os.listdir(bq_util._DATA_DIRECTORY)))
+
+    def test_corrupt_data(self):
+        bq_util.save_daily_data([{'a': 'x' * 100}], 'report', '20190101')
+        filename = bq_util._get_data_filename('report', '20190101')
+        with open(filename, 'r+b') as f:
+            contents = f.read()
+            f.seek(0)
+            f.write(contents.replace('xxx', 'xyx'))
+        self.assertFalse(bq_util.has_daily_data('report', '20190101'))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190101'))
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(os.path.exists(filename + '.corrupt'))
+
+    def test_truncated_data_without_checksum(self):
+        filename = bq_util._get_data_filename('report', '20190101')
+        with open(filename, 'wb') as f:
+            f.write(cPickle.dumps([{'a': 1}] * 10,
+                                  cPickle.HIGHEST_PROTOCOL)[:-10])
+        self.assertIsNone(bq_util.get_daily_data('report', '20190101'))
+        self.assertTrue(os.path.exists(filename + '.corrupt'))
+
+
+class TestCompaction(BQTestCase):
+    def setUp(self):
+        super(TestCompaction, self).setUp()
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+
+    def save_days(self, report, days):
+        for day in days:
+            bq_util.save_daily_data([{'day': day}], report,
+                                    '201901%02d' % day)
+
+    def test_archive(self):
+        self.save_days('report', [1, 2, 30])
+        bq_util.save_daily_data([{'day': 31}], 'report', '20181231')
+        self.assertEqual(
+            {'report': {'archived': 3, 'deleted': 0}},
+            bq_util.compact_daily_data(datetime.date(2019, 2, 15),
+                                       archive_after_days=20))
+        self.assertEqual(['report_201812.zip', 'report_201901.zip',
+                          'report_20190130.pickle'],
+                         sorted(f for f in os.listdir(bq_util._DATA_DIRECTORY)
+                                if not f.endswith('.lock')))
+        # The archived days' lockfiles stay, since someone may be
+        # waiting on them.
+        self.assertTrue(os.path.exists(
+            bq_util._get_data_filename('report', '20190101') + '.lock'))
+        self.assertEqual([{'day': 2}],
+                         bq_util.get_daily_data('report', '20190102'))
+        self.assertEqual([{'day': 31}],
+                         list(bq_util.iter_daily_data('report', '20181231')))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190103'))
+
+        # A re-fetched day takes precedence over the archived one, and
+        # gets archived in its place.
+        bq_util.save_daily_data([{'day': 'new'}], 'report', '20190102')
+        self.assertEqual([{'day': 'new'}],
+                         bq_util.get_daily_data('report', '20190102'))
+        bq_util.compact_daily_data(datetime.date(2019, 2, 15),
+                                   archive_after_days=20)
+        self.assertEqual([{'day': 'new'}],
+                         bq_util.get_daily_data('report', '20190102'))
+
+    def test_retention(self):
+        self.mock(bq_util, 'RETENTION_POLICIES', {
+            'report': {'retention_days': 30, 'max_bytes': 10 ** 9}})
+        self.save_days('report', [1, 2, 20, 30])
+        bq_util.save_daily_data([{'day': 31}], 'report', '20181231')
+        bq_util.save_daily_data([{'day': 31}], 'other', '20181231')
+        bq_util.compact_daily_data(datetime.date(2019, 1, 15),
+                                   archive_after_days=100)
+        bq_util.compact_daily_data(datetime.date(2019, 2, 1),
+                                   archive_after_days=10)
+        self.assertIsNone(bq_util.get_daily_data('report', '20181231'))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190101'))
+        self.assertEqual([{'day': 2}],
+                         bq_util.get_daily_data('report', '20190102'))
+        self.assertEqual([{'day': 31}],
+                         bq_util.get_daily_data('other', '20181231'))
+
+    def test_size_cap(self):
+        self.save_days('report', [1, 2, 3])
+        size = os.path.getsize(
+            bq_util._get_data_filename('report', '20190103'))
+        self.mock(bq_util, 'RETENTION_POLICIES', {
+            'report': {'retention_days': 100, 'max_bytes': size * 2}})
+        bq_util.compact_daily_data(datetime.date(2019, 1, 15))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190101'))
+        self.assertEqual([{'day': 2}],
+                         bq_util.get_daily_data('report', '20190102'))
+
+
+class TestQueryCache(BQTestCase):
+    def setUp(self):
+        super(TestQueryCache, self).setUp()
+        self.tables = {'logs.requestlogs_20190101': {
+            'row_count': 1, 'size_bytes': 10, 'last_modified': 1000}}
+        self.mock(bq_util, 'get_table_metadata',
+                  lambda table, project: self.tables.get(table))
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+        self.service.tables_by_id[('logs', 'requestlogs_20190101')] = {
+            'id': 'logs.requestlogs_20190101'}
+        self.query = 'SELECT n FROM [logs.requestlogs_20190101]'
+        self.service.results[self.query] = (
+            [{'name': 'n', 'type': 'INTEGER'}], [['1']])
+
+    def num_queries(self):
+        return len([c for c in self.service.calls if c[0] == 'insert'])
+
+    def run_query(self, sql_query, **kwargs):
+        return bq_util.query_bigquery(sql_query, cache_ttl=60, **kwargs)
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            "SELECT a, '# not -- a comment' FROM t",
+            bq_util._normalize_sql("SELECT a,  # comment\n"
+                                   "  '# not -- a comment'\n"
+                                   "FROM t  -- another"))
+
+    def test_hit_ignores_comments_and_whitespace(self):
+        self.assertEqual([{'n': 1}], self.run_query(self.query))
+        self.assertEqual([{'n': 1}], self.run_query(
+            '-- the same query\n' + self.query.replace(' ', '\n  ')))
+        self.assertEqual(1, self.num_queries())
+        self.assertEqual(1, bq_util.query_cache_stats()['hits'])
+
+    def test_cache_info(self):
+        cache_info = {}
+        self.run_query(self.query, cache_info=cache_info)
+        self.assertEqual({'cached': False}, cache_info)
+        self.run_query(self.query, cache_info=cache_info)
+        self.assertEqual({'cached': True}, cache_info)
+
+    def test_table_modification_invalidates(self):
+        self.run_query(self.query)
+        self.tables['logs.requestlogs_20190101']['last_modified'] = 2000
+        self.run_query(self.query)
+        self.assertEqual(2, self.num_queries())
+
+    def test_expired_entries_are_ignored(self):
+        bq_util.query_bigquery(self.query, cache_ttl=-1)
+        self.run_query(self.query)
+        self.assertEqual(2, self.num_queries())
+
+    def test_decorated_tables_are_not_cached(self):
+        query = 'SELECT n FROM [logs.requestlogs_20190101@-3600000-]'
+        self.service.results[query] = self.service.results[self.query]
+        self.run_query(query)
+        self.run_query(query)
+        self.assertEqual(2, self.num_queries())
+        self.assertEqual(2, bq_util.query_cache_stats()['uncacheable'])
+
+    def test_streaming_tables_are_not_cached(self):
+        self.service.tables_by_id[('logs', 'requestlogs_20190101')][
+            'streamingBuffer'] = {'estimatedRows': '10'}
+        self.run_query(self.query)
+        self.run_query(self.query)
+        self.assertEqual(2, self.num_queries())
+        self.assertEqual(2, bq_util.query_cache_stats()['uncacheable'])
+
+    def test_cache_is_opt_in(self):
+        bq_util.query_bigquery(self.query)
+        bq_util.query_bigquery(self.query)
+        self.assertEqual(2, self.num_queries())
+        self.assertEqual([], os.listdir(bq_util._QUERY_CACHE_DIRECTORY))
+
+    def test_lru_eviction(self):
+        fields = [{'name': 'x', 'type': 'STRING'}]
+        bq_util._write_query_cache('old', [(fields, [['x' * 100]])], 60)
+        bq_util._write_query_cache('new', [(fields, [['y' * 100]])], 60)
+        # Reading 'old' makes it the most recently used entry.
+        os.utime(bq_util._get_query_cache_filename('new'), (1, 1))
+        bq_util._read_query_cache('old')
+        # Room for one of them.
+        bq_util._evict_from_query_cache(os.path.getsize(
+            bq_util._get_query_cache_filename('old')) + 10)
+        self.assertIsNotNone(bq_util._read_query_cache('old'))
+        self.assertIsNone(bq_util._read_query_cache('new'))
+
+    def test_eviction_skips_entries_being_written(self):
+        tmp_filename = bq_util._get_query_cache_filename('new') + '.tmp.1'
+        with open(tmp_filename, 'w') as f:
+            f.write('x' * 100)
+        os.utime(tmp_filename, (1, 1))
+        bq_util._evict_from_query_cache(0)
+        self.assertTrue(os.path.exists(tmp_filename))
+        self.assertEqual(0, bq_util.query_cache_stats()['evictions'])
+
+    def test_daily_data_comes_from_disk(self):
+        bq_util.save_daily_data([{'n': 2}], 'report', '20190101')
+        self.assertEqual([{'n': 2}], bq_util.get_daily_data_from_disk_or_bq(
+            self.query, 'report', '20190101'))
+        self.assertEqual(0, self.num_queries())
+        self.assertEqual([{'n': 1}], bq_util.get_daily_data_from_disk_or_bq(
+            self.query, 'report', '20190102'))
+        self.assertEqual([{'n': 1}],
+                         bq_util.get_daily_data('report', '20190102'))
+
+
+class TestQueryBigqueryMany(BQTestCase):
+    def setUp(self):
+        super(TestQueryBigqueryMany, self).setUp()
+        self.mock(bq_util, '_POLL_INTERVAL_SECS', 0)
+        for n in xrange(3):
+            self.service.results['SELECT %d' % n] = (
+                [{'name': 'n', 'type': 'INTEGER'}], [[str(n)]])
+
+    def test_runs_all_queries_at_once(self):
+        results = dict(bq_util.query_bigquery_many(
+            {'q%d' % n: 'SELECT %d' % n for n in xrange(3)}))
+        self.assertEqual({'q0': [{'n': 0}], 'q1': [{'n': 1}],
+                          'q2': [{'n': 2}]}, results)
+        inserts = [i for (i, c) in enumerate(self.service.calls)
+                   if c[0] == 'insert']
+        fetches = [i for (i, c) in enumerate(self.service.calls)
+                   if c[0] == 'getQueryResults']
+        self.assertEqual(3, len(inserts))
+        self.assertLess(max(inserts), min(fetches))
+
+    def test_max_concurrent(self):
+        results = dict(bq_util.query_bigquery_many(
+            {'q%d' % n: 'SELECT %d' % n for n in xrange(3)},
+            max_concurrent=1))
+        self.assertEqual(3, len(results))
+        calls = [c[0] for c in self.service.calls if c[0] != 'dryRun']
+        self.assertEqual('insert', calls[0])
+        self.assertNotEqual('insert', calls[1])
+
+    def test_retries_and_failures_are_per_query(self):
+        self.service.failures = {'SELECT 0': 1, 'SELECT 1': 10}
+        results = dict(bq_util.query_bigquery_many(
+            {'q0': 'SELECT 0', 'q1': 'SELECT 1', 'q2': 'SELECT 2'},
+            retries=1))
+        self.assertEqual([{'n': 0}], results['q0'])
+        self.assertIsInstance(results['q1'], bq_util.BQException)
+        self.assertEqual([{'n': 2}], results['q2'])
+
+    def test_reattaches_after_flaky_polls(self):
+        self.service.flakes['SELECT 1'] = 2
+        self.assertEqual([('q1', [{'n': 1}])],
+                         list(bq_util.query_bigquery_many({'q1': 'SELECT 1'})))
+        self.assertEqual(1, len([c for c in self.service.calls
+                                 if c[0] == 'insert']))
+
+    def test_uses_the_query_cache(self):
+        bq_util.query_bigquery('SELECT 0', cache_ttl=60)
+        self.assertEqual([('q0', [{'n': 0}])],
+                         list(bq_util.query_bigquery_many({'q0': 'SELECT 0'},
+                                                          cache_ttl=60)))
+        self.assertEqual(1, bq_util.query_cache_stats()['hits'])
+
+
+class TestScanBudget(BQTestCase):
+    def setUp(self):
+        super(TestScanBudget, self).setUp()
+        self.mock(bq_util, '_POLL_INTERVAL_SECS', 0)
+        for n in (1, 2):
+            query = 'SELECT %d' % n
+            self.service.results[query] = (
+                [{'name': 'n', 'type': 'INTEGER'}], [[str(n)]])
+            self.service.bytes_processed[query] = n * 1000
+
+    def test_estimate(self):
+        self.assertEqual(2000, bq_util.estimate_query_bytes('SELECT 2'))
+        self.assertEqual([('dryRun', None)], self.service.calls)
+
+    def test_bytes_are_tallied(self):
+        bq_util.query_bigquery('SELECT 1', cache_ttl=0)
+        bq_util.query_bigquery('SELECT 2', cache_ttl=0)
+        self.assertEqual({'estimated': 3000, 'billed': 3000},
+                         bq_util.bytes_scanned())
+
+    def test_per_query_budget(self):
+        bq_util.set_scan_budget(per_query=1500)
+        self.assertEqual([{'n': 1}], bq_util.query_bigquery('SELECT 1'))
+        with self.assertRaises(bq_util.ScanBudgetExceeded):
+            bq_util.query_bigquery('SELECT 2')
+        self.assertEqual(1, len([c for c in self.service.calls
+                                 if c[0] == 'insert']))
+
+    def test_per_process_budget(self):
+        bq_util.set_scan_budget(per_process=2500)
+        bq_util.query_bigquery('SELECT 1', cache_ttl=0)
+        bq_util.query_bigquery('SELECT 1', cache_ttl=0)
+        with self.assertRaises(bq_util.ScanBudgetExceeded):
+            bq_util.query_bigquery('SELECT 1', cache_ttl=0)
+
+    def test_per_process_budget_across_threads(self):
+        bq_util.set_scan_budget(per_process=2500)
+
+        def slow_execute(request):
+            time.sleep(0.05)
+            return request.execute()
+        self.mock(bq_util, '_execute', slow_execute)
+
+        failures = []
+
+        def run():
+            try:
+                bq_util.query_bigquery('SELECT 1', cache_ttl=0)
+            except bq_util.ScanBudgetExceeded as e:
+                failures.append(e)
+        threads = [threading.Thread(target=run) for _ in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(failures))
+        self.assertEqual({'estimated': 2000, 'billed': 2000},
+                         bq_util.bytes_scanned())
+
+    def test_warn_only(self):
+        bq_util.set_scan_budget(per_query=1500, refuse=False)
+        self.assertEqual([{'n': 2}], bq_util.query_bigquery('SELECT 2'))
+
+    def test_many(self):
+        bq_util.set_scan_budget(per_query=1500)
+        results = dict(bq_util.query_bigquery_many({'q1': 'SELECT 1',
+                                                    'q2': 'SELECT 2'}))
+        self.assertEqual([{'n': 1}], results['q1'])
+        self.assertIsInstance(results['q2'], bq_util.ScanBudgetExceeded)
+        self.assertEqual({'estimated': 1000, 'billed': 1000},
+                         bq_util.bytes_scanned())
+
+
+class TestJobStats(BQTestCase):
+    def setUp(self):
+        super(TestJobStats, self).setUp()
+        self.mock(bq_util, '_POLL_INTERVAL_SECS', 0)
+        self.service.results['SELECT 1'] = (
+            [{'name': 'n', 'type': 'INTEGER'}], [['1']])
+        self.service.bytes_processed['SELECT 1'] = 1000
+
+    def test_stats_are_recorded_and_logged(self):
+        self.service.failures['SELECT 1'] = 1
+        bq_util.query_bigquery('SELECT 1', stats_name='my_report')
+        self.assertEqual(1, len(bq_util._job_stats))
+        stats = bq_util._job_stats[0]
+        self.assertEqual('my_report', stats['name'])
+        self.assertEqual(1, stats['retries'])
+        self.assertEqual(3.0, stats['wall_secs'])
+        self.assertEqual(0.5, stats['queue_secs'])
+        self.assertEqual(1000, stats['bytes_billed'])
+        self.assertEqual(300, stats['slot_ms'])
+        self.assertFalse(stats['cache_hit'])
+        with open(bq_util._JOB_STATS_LOG) as f:
+            self.assertEqual(stats, json.loads(f.readlines()[-1]))
+        self.assertEqual({}, bq_util._pending_jobs)
+
+    def test_send_to_graphite(self):
+        bq_util.query_bigquery('SELECT 1', stats_name='my report')
+        list(bq_util.query_bigquery_many({'other': 'SELECT 1'},
+                                         cache_ttl=0))
+        sent = []
+        self.mock(bq_util, '_GRAPHITE_BATCH_SIZE', 10)
+        self.mock(bq_util.graphite_util, 'send_to_graphite',
+                  lambda host, records: sent.append(records))
+        bq_util.send_job_stats_to_graphite('localhost:2004')
+        self.assertEqual([10, 4], [len(batch) for batch in sent])
+        keys = [k for batch in sent for (k, _) in batch]
+        self.assertIn('webapp.gae.dashboard.bigquery_jobs.my_report.slot_ms',
+                      keys)
+        self.assertIn('webapp.gae.dashboard.bigquery_jobs.other.retries',
+                      keys)
+        self.assertEqual([], bq_util._job_stats)
+
+
+class TestTableMetadata(BQTestCase):
+    def setUp(self):
+        super(TestTableMetadata, self).setUp()
+        self.mock(bq_util, '_table_metadata_cache', {})
+        self.service.results[
+            'SELECT table_id, row_count, size_bytes, last_modified_time '
+            'FROM [p:logs.__TABLES__]'] = (
+                [{'name': 'table_id', 'type': 'STRING'},
+                 {'name': 'row_count', 'type': 'INTEGER'},
+                 {'name': 'size_bytes', 'type': 'INTEGER'},
+                 {'name': 'last_modified_time', 'type': 'INTEGER'}],
+                [['requestlogs_20190101', '10', '1000', '1546300800000'],
+                 ['requestlogs_20190103', '20', '2000', '1546473600000'],
+                 ['other_20190102', '30', '3000', '1546387200000']])
+
+    def num_queries(self):
+        return len([c for c in self.service.calls if c[0] == 'insert'])
+
+    def test_metadata(self):
+        self.assertEqual({'row_count': 10, 'size_bytes': 1000,
+                          'last_modified': 1546300800000},
+                         bq_util.get_table_metadata(
+                             'logs.requestlogs_20190101', project='p'))
+        self.assertIsNone(bq_util.get_table_metadata(
+            'p:logs.requestlogs_20190102', project='other-project'))
+        self.assertEqual(1, self.num_queries())
+
+    def test_daily_tables_in_range(self):
+        self.assertEqual(
+            ['20190101', '20190103'],
+            bq_util.daily_tables_in_range(
+                'logs.requestlogs_', datetime.date(2018, 12, 25),
+                datetime.date(2019, 1, 5), project='p'))
+        self.assertEqual(
+            ['20190103'],
+            bq_util.daily_tables_in_range(
+                'logs.requestlogs_', datetime.date(2019, 1, 2),
+                datetime.date(2019, 1, 3), project='p'))
+        self.assertEqual(1, self.num_queries())
+
+    def test_ttl(self):
+        bq_util.get_table_metadata('p:logs.requestlogs_20190101')
+        self.mock(bq_util, '_TABLE_METADATA_TTL', -1)
+        bq_util.get_table_metadata('p:logs.requestlogs_20190101')
+        self.assertEqual(2, self.num_queries())
+
+
+class TestBackfill(TestTableMetadata):
+    def setUp(self):
+        super(TestBackfill, self).setUp()
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+        self.service.results['SELECT 20190103'] = (
+            [{'name': 'route', 'type': 'STRING'}], [['/a'], ['/b']])
+
+    def query(self, yyyymmdd):
+        return 'SELECT %s' % yyyymmdd
+
+    def test_backfill(self):
+        bq_util.save_daily_data([{'route': '/old'}], 'report', '20190101')
+        # 20190101 is already saved, and 20190102 has no logs table.
+        self.assertEqual(
+            {'report': ['20190103']},
+            bq_util.backfill_daily_data(
+                {'report': self.query}, datetime.date(2019, 1, 4), 3,
+                row_filters={'report': lambda row: row['route'] != '/b'},
+                project='p'))
+        self.assertEqual([{'route': '/a'}],
+                         bq_util.get_daily_data('report', '20190103'))
+        self.assertEqual([{'route': '/old'}],
+                         bq_util.get_daily_data('report', '20190101'))
+        self.assertIsNone(bq_util.get_daily_data('report', '20190102'))
+        # One query for the table metadata, and one to backfill.
+        self.assertEqual(2, self.num_queries())
+
+    def test_nothing_missing(self):
+        for yyyymmdd in ('20190101', '20190102', '20190103'):
+            bq_util.save_daily_data([], 'report', yyyymmdd)
+        self.assertEqual(
+            {'report': []},
+            bq_util.backfill_daily_data(
+                {'report': self.query}, datetime.date(2019, 1, 4), 3,
+                project='p'))
+        self.assertEqual(0, self.num_queries())
+
+
+if __name__ == '__main__':
+    unittest.main()
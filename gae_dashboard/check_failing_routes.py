@@ -14,8 +14,8 @@ import datetime
 import logging
 
 import alertlib
-import bq_util
 import initiatives
+import requestlogs_facts
 
 # Report on the previous day by default
 _DEFAULT_DAY = datetime.datetime.utcnow() - datetime.timedelta(1)
@@ -30,37 +30,6 @@ ROUTES_EXPECTED_TO_FAIL = frozenset((
 ))
 
 
-QUERY = """\
-SELECT
-  route,
-  ok_reqs,
-  bot_reqs,
-  num_ips,
-  total_reqs
-FROM (
-  SELECT
-    elog_url_route AS route,
-    SUM((status >= 200 AND status < 400) OR status IN (401, 404, 405, 501))
-        AS ok_reqs,
-    SUM(elog_device_type is NULL or elog_device_type = "bot/dev")
-        AS bot_reqs,
-    COUNT(distinct IP) AS num_ips,
-    SUM(1) AS total_reqs
-  FROM
-    [khanacademy.org:deductive-jet-827:logs.requestlogs_{}]
-  GROUP BY
-    route)
-WHERE
-  ok_reqs = 0
-  AND total_reqs > 0
-  -- We ignore errors that are just from bots
-  AND total_reqs > bot_reqs
-  -- If it's just one bad IP, it's likely just a bad client of some
-  -- sort, so we ignore it.
-  AND num_ips > 1
-"""
-
-
 def _plural(s, num):
     # Totally skeezy, but works for our purposes.
     return s if num == 1 else s + 's'
@@ -68,7 +37,8 @@ def _plural(s, num):
 
 def _errors(route_data):
     return [
-        '`{}` owned by {} ({} {} total, {} of them bots, {} unique {})'.format(
+        '`{}` owned by {} ({} {} total, {} of them bots, '
+        'at least {} unique {})'.format(
             d['route'],
             ', '.join(d['owners']),
             d['total_reqs'], _plural('request', d['total_reqs']),
@@ -88,9 +58,10 @@ def notify(route_data, date):
 
 def check(date, dry_run=False):
     yyyymmdd = date.strftime("%Y%m%d")
-    q = QUERY.format(yyyymmdd)
-    data = bq_util.query_bigquery(q)
-    route_data = [row for row in data
+    # This reads the daily summary of the request logs that
+    # email_bq_data's reports use too, so we only scan the logs once.
+    facts = requestlogs_facts.get_facts(yyyymmdd)
+    route_data = [row for row in requestlogs_facts.failing_routes(facts)
                   if not row['route'] in ROUTES_EXPECTED_TO_FAIL]
 
     for row in route_data:
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""Archive and expire the old report data in ~/bq_data.
+
+The reports save a file per report per day there (see
+bq_util.save_daily_data), which adds up.  This rolls days older than a
+few weeks into compressed monthly archives -- which bq_util can still
+read from -- and deletes data that's older than each report's retention
+window, or that puts it over its size cap; see
+bq_util.RETENTION_POLICIES.  It also expires old days from the columnar
+history store in ~/bq_data/history, and the keys they alone used; see
+bq_history.compact.  It's meant to be run daily from cron.
+"""
+
+import argparse
+import datetime
+
+import bq_history
+import bq_util
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report', action='append',
+                        help=('Report to compact (may be repeated; '
+                              'default: all)'))
+    parser.add_argument('--archive-after-days', type=int,
+                        default=bq_util._ARCHIVE_AFTER_DAYS,
+                        help=('Archive daily data older than this many days '
+                              '(default %(default)s)'))
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Show more information about what we're doing.")
+    args = parser.parse_args()
+    today = datetime.date.today()
+    bq_util.compact_daily_data(today, reports=args.report,
+                               archive_after_days=args.archive_after_days,
+                               verbose=args.verbose)
+    for report in sorted(bq_history.REPORT_KEY_COLUMNS):
+        if args.report and report not in args.report:
+            continue
+        (num_days, num_keys) = bq_history.compact(report, today)
+        if args.verbose and (num_days or num_keys):
+            print '%s history: deleted %s days, dropped %s keys' % (
+                report, num_days, num_keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,12 @@ MAX_REQS_SEC = 4
 # The size of the period of time to query.
 PERIOD = 5 * 60
 
+# Since this runs every 5 minutes, a query that scans too much gets
+# expensive fast; see _fastly_log_tables.  We refuse to run queries that
+# would scan more than this.
+MAX_BYTES_PER_QUERY = 10 * 1024 ** 3
+MAX_BYTES_PER_RUN = 2 * MAX_BYTES_PER_QUERY
+
 TABLE_FORMAT = '%Y%m%d'
 TS_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -188,6 +194,8 @@ def main():
     end = datetime.datetime.utcnow()
     start = end - datetime.timedelta(seconds=PERIOD)
 
+    bq_util.set_scan_budget(per_query=MAX_BYTES_PER_QUERY,
+                            per_process=MAX_BYTES_PER_RUN)
     dos_detect(start, end)
     scratchpad_detect(start, end)
 
@@ -18,14 +18,19 @@ import email
 import email.mime.text
 import email.utils
 import hashlib
-import smtplib
-import subprocess
-import textwrap
+import sys
 import time
 
+import bq_history
 import bq_util
 import cloudmonitoring_util
 import initiatives
+import lru_cache
+import mail_dispatcher
+import report_runner
+import report_table
+import requestlogs_facts
+import sparkline
 
 
 # Report on the previous day by default
@@ -47,47 +52,40 @@ def _pretty_date(yyyymmdd):
     return '%s-%s-%s' % (yyyymmdd[0:4], yyyymmdd[4:6], yyyymmdd[6:8])
 
 
-def _by_initiative(data, key='url_route', by_package=False):
-    """Return a sequence of (id, data) tuples given a table.
-
-    Table rows are expected to be dicts.
+def _by_initiative(table, key='url_route', by_package=False):
+    """Return a sequence of (id, table) tuples given a report_table.Table.
 
     Rows are assigned to initiatives based on their routes or packages. Routes
-    or packages are found in rows using the key.
+    or packages are found in the column named by key.
     """
     if by_package:
         f = initiatives.file_owner
     else:
         f = initiatives.route_owners
     rows = collections.defaultdict(list)
-    for row in data:
-        teams = f(row[key])
+    for (i, value) in enumerate(table[key]):
+        teams = f(value)
         # We may get a single team or a list.
         if type(teams) != list:
             teams = [teams]
         for team in teams:
-            rows[team].append(row)
-    return rows.items()
+            rows[team].append(i)
+    return [(team, table.take(indices)) for (team, indices) in rows.items()]
 
 
-def _convert_table_rows_to_lists(table, order):
-    """Given a table where rows are dicts, convert them to lists.
+# Rendered sparklines and table rows, keyed by a hash of their contents.
+# The per-initiative emails are mostly made of rows from the "All" email,
+# so we render each row -- and each sparkline -- just once, and assemble
+# the emails from these.  Reports run in threads, so these are locked,
+# and bounded so a long-running process doesn't keep every row it has
+# ever rendered.
+_RENDER_CACHE_SIZE = 5000
+_SPARKLINE_CACHE = lru_cache.LRUCache(_RENDER_CACHE_SIZE)
+_ROW_CACHE = lru_cache.LRUCache(_RENDER_CACHE_SIZE)
 
-    Each dict (each row in the table) must have the same set of keys.
-    Those keys are then listed in the list 'order', which lists the
-    keys in the order we want them to be in the table.  We then go
-    through the table and convert each dict to a list.  Finally, we
-    add a row to the top of the table that has the key-names
-    (csv-style).
-    """
-    retval = []
-    for row in table:
-        row_contents = row.items()
-        row_contents.sort(key=lambda (k, v): order.index(k))
-        retval.append([v for (k, v) in row_contents])
 
-    retval.insert(0, list(order))
-    return retval
+def _content_key(value):
+    return hashlib.sha1(repr(value)).digest()
 
 
 def _render_sparkline(data, width=100, height=20):
@@ -95,52 +93,67 @@ def _render_sparkline(data, width=100, height=20):
 
     This takes in a list of numbers, and returns the contents of a PNG as a
     string.  A datapoint may be None if it should be omitted.  It will return
-    None if there are not enough datapoints to make a plot.  It requires that
-    gnuplot be installed.
+    None if there are not enough datapoints to make a plot.  See sparkline.py.
     """
-    existing_data = [datum for datum in data if datum is not None]
-    if len(existing_data) < 3:
-        return None
-    data_lines = []
-    for i, datum in enumerate(data):
-        if datum is None:
-            data_lines.append("")
+    def render(key):
+        existing_data = [datum for datum in data if datum is not None]
+        if len(existing_data) < 3:
+            return None
+        return sparkline.render_png(data, width, height)
+    return _SPARKLINE_CACHE.get(_content_key((data, width, height)), render)
+
+
+def _render_row(row):
+    """Given a table row (a tuple), return its HTML and its images.
+
+    The HTML has a %s placeholder for each image, which is a PNG of a
+    sparkline; see _embed_images_to_mime().  Other % signs are escaped.
+    """
+    return _ROW_CACHE.get(_content_key(row), lambda key: _row_html(row))
+
+
+def _row_html(row):
+    """Render a row for _render_row, which remembers the result."""
+    html = ['<tr>']
+    images = []
+    for col in row:
+        style = 'padding: 3px 5px 3px 8px;'
+        # If the column isn't a string, convert it to one.
+        if isinstance(col, (int, long)):
+            style += 'text-align: right;'
+        elif isinstance(col, float):
+            style += 'text-align: right;'
+            col = '%.2f' % col     # make the output reasonable
+        elif isinstance(col, list):
+            # If we get a list, plot it as a sparkline.
+            style = 'padding: 0px; text-align: center;'
+            # Just put in a placeholder for the datum, we'll fill
+            # in the image in _embed_images_to_mime().
+            image = _render_sparkline(col)
+            if image:
+                images.append(image)
+                col = '%s'
+            else:
+                # If the image didn't render due to insufficient
+                # data, say so rather than leaving it out.
+                col = '(insufficient data)'
         else:
-            data_lines.append("%s %s" % (i, datum))
-    gnuplot_script = textwrap.dedent(
-        """\
-        unset border
-        unset xtics
-        unset ytics
-        unset key
-        set lmargin 0
-        set rmargin 0
-        set tmargin 0
-        set bmargin 0
-        set yrange [%(ymin)s:%(ymax)s]
-        set xrange [%(xmin)s:%(xmax)s]
-        set terminal pngcairo size 100,20
-        plot "-" using 1:2 notitle with lines linetype rgb "black"
-        %(data)s
-        e
-        """
-    ) % {
-        'data': '\n'.join(data_lines),
-        # The bottom of the plot looks better if it has a bit of buffer around
-        # the top and bottom data points.  We force the min to be near zero so
-        # small increases to something that started out large are viewed in
-        # context.
-        'ymax': 1.05 * max(existing_data),
-        'ymin': -0.05 * max(existing_data),
-        # To make the width per time fixed, set the min and max x value so that
-        # the plot will include space for any missing data.
-        'xmin': 1,
-        'xmax': len(data),
-    }
-    gnuplot_proc = subprocess.Popen(['gnuplot'], stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE)
-    png, _ = gnuplot_proc.communicate(gnuplot_script)
-    return png
+            # The column was a regular string, and might have
+            # HTML-like characters, so escape those.
+            # We also need to escape %'s, since all of `body`
+            # will be subject to string-interpolation in a bit.
+            col = cgi.escape(col)
+            col = col.replace('%', '%%')
+        html.append('<td style="%s">%s</td>' % (style, col))
+    html.append('</tr>')
+    return ('\n'.join(html), images)
+
+
+_TABLE_ATTRIBUTES = ('cellspacing="1" cellpadding="3" border="1"'
+                     '       style="table-layout:fixed;font-size:13px;'
+                     '              font-family:arial,sans,sans-serif;'
+                     '              border-collapse:collapse;border:1px '
+                     '              solid rgb(204,204,204)"')
 
 
 def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None,
@@ -148,10 +161,10 @@ def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None,
     """Send an email with the given table and graph.
 
     Arguments:
-       tables: a dict, with headings as keys, and values lists of lists of the
-           form: [[1A, 1B], [2A, 2B], ...].  Can be None.  If the heading is
-           the empty string, it won't be displayed.  If a table cell value is
-           itself a list, it will be plotted as a sparkline.
+       tables: a dict, with headings as keys, and values report_table.Table
+           objects.  Can be None.  If the heading is the empty string, it
+           won't be displayed.  If a table cell value is itself a list, it
+           will be plotted as a sparkline.
        graph: TODO(csilvers).  Can be None.
        to: a list of email addresses
        cc: an optional list of email addresses
@@ -163,60 +176,21 @@ def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None,
     if preamble:
         body.append('<p>%s</p>' % preamble)
 
-    if not isinstance(tables, dict):
+    if tables is None:
+        tables = {}
+    elif not isinstance(tables, dict):
         tables = {'': tables}
 
     images = []
     for heading, table in sorted(tables.iteritems()):
         if heading:
             body.append('<h3>%s</h3>' % heading)
-        if table and table[0]:
-            body.append('<table cellspacing="1" cellpadding="3" border="1"'
-                        '       style="table-layout:fixed;font-size:13px;'
-                        '              font-family:arial,sans,sans-serif;'
-                        '              border-collapse:collapse;border:1px '
-                        '              solid rgb(204,204,204)">')
-            body.append('<thead>')
-            body.append('<tr>')
-            for header in table[0]:
-                body.append('<th>%s</th>' % header)
-            body.append('</tr>')
-            body.append('</thead>')
-            body.append('<tbody>')
-            for row in table[1:]:
-                body.append('<tr>')
-                for col in row:
-                    style = 'padding: 3px 5px 3px 8px;'
-                    # If the column isn't a string, convert it to one.
-                    if isinstance(col, (int, long)):
-                        style += 'text-align: right;'
-                    elif isinstance(col, float):
-                        style += 'text-align: right;'
-                        col = '%.2f' % col     # make the output reasonable
-                    elif isinstance(col, list):
-                        # If we get a list, plot it as a sparkline.
-                        style = 'padding: 0px; text-align: center;'
-                        # Just put in a placeholder for the datum, we'll fill
-                        # in the image in _embed_images_to_mime().
-                        image = _render_sparkline(col)
-                        if image:
-                            images.append(image)
-                            col = '%s'
-                        else:
-                            # If the image didn't render due to insufficient
-                            # data, say so rather than leaving it out.
-                            col = '(insufficient data)'
-                    else:
-                        # The column was a regular string, and might have
-                        # HTML-like characters, so escape those.
-                        # We also need to escape %'s, since all of `body`
-                        # will be subject to string-interpolation in a bit.
-                        col = cgi.escape(col)
-                        col = col.replace('%', '%%')
-                    body.append('<td style="%s">%s</td>' % (style, col))
-                body.append('</tr>')
-            body.append('</tbody>')
-            body.append('</table>')
+        if table.names:
+            (table_html, table_images) = table.to_html(
+                _render_row,
+                attributes=_TABLE_ATTRIBUTES)
+            body.append(table_html)
+            images.extend(table_images)
 
     if graph:
         pass
@@ -232,9 +206,24 @@ def _send_email(tables, graph, to, cc=None, subject='bq data', preamble=None,
         print msg.as_string()
         print "--------------------------------------------------"
     else:
-        s = smtplib.SMTP('localhost')
-        s.sendmail('toby-admin+bq-cron@khanacademy.org', to, msg.as_string())
-        s.quit()
+        # This just queues the message; see mail_dispatcher.py.
+        mail_dispatcher.default_dispatcher().send(
+            'toby-admin+bq-cron@khanacademy.org', to, msg)
+
+
+def _query_all(queries):
+    """Run a list of (name, query) pairs concurrently.
+
+    Returns a list of the results, in the same order.  The names are
+    what the job statistics get recorded under.  Raises the BQException
+    for the first query that failed, if any.
+    """
+    results = dict(bq_util.query_bigquery_many(
+        dict(queries), cache_ttl=bq_util.QUERY_CACHE_TTL))
+    for (name, _) in queries:
+        if isinstance(results[name], bq_util.BQException):
+            raise results[name]
+    return [results[name] for (name, _) in queries]
 
 
 def _send_table_to_stackdriver(table, metric_name, metric_label_name,
@@ -248,10 +237,7 @@ def _send_table_to_stackdriver(table, metric_name, metric_label_name,
     and metric-label.
 
     Arguments:
-       table: A list of lists of the form:
-              [[HEADING_A, HEADING_B], [1A, 1B], [2A, 2B], ...].
-           If a table cell value is itself a list, it is interpreted
-           as a sparkline.
+       table: A report_table.Table.
        metric_name: The name of the metric to use in stackdriver,
            e.g. "webapp.routes.daily_cost".  Think of it as the name
            of a graph in stackdriver.
@@ -259,11 +245,9 @@ def _send_table_to_stackdriver(table, metric_name, metric_label_name,
            metric, e.g. "url_route".  Think of it as a description of
            what the lines in the stackdriver graph represent.
        metric_label_col: the column of the table that holds the
-           label value for a particular row, e.g. "url_route".  This
-           should be a string that matches one of the HEADING_X fields.
+           label value for a particular row, e.g. "url_route".
        data_col: the column of the table that holds the sparkline
            historical data for this row, e.g. "last 2 weeks (per request)".
-           This should be a string that matches one of the HEADING_X fields.
        dry_run: if True, say what we would send to stackdriver but don't
            actually send it.
     """
@@ -274,16 +258,9 @@ def _send_table_to_stackdriver(table, metric_name, metric_label_name,
     # time each day.
     time_t = int(time.time() / 3600) * 3600   # round down to the hour
 
-    headings = table[0]
-    rows = table[1:]
-
-    metric_label_index = headings.index(metric_label_col)
-    data_index = headings.index(data_col)
-
     stackdriver_input = []
-    for row in rows:
-        metric_label_value = row[metric_label_index]
-        data = row[data_index]
+    for (metric_label_value, data) in zip(table[metric_label_col],
+                                          table[data_col]):
         if data[-1] is None or data[0] is None:
             continue      # we don't have historical data, just bail
         num = data[-1] / data[0]
@@ -320,9 +297,15 @@ def _embed_images_to_mime(html, images):
     image_tag_template = '<img src="cid:%s" alt=""/>'
     image_tags = []
     image_mimes = []
+    seen_image_ids = set()
     for image in images:
         image_id = "%s@khanacademy.org" % hashlib.sha1(image).hexdigest()
         image_tags.append(image_tag_template % image_id)
+        # The same image may appear more than once (say, two rows with
+        # the same history); we only need to attach it once.
+        if image_id in seen_image_ids:
+            continue
+        seen_image_ids.add(image_id)
         image_mime = email.MIMEImage.MIMEImage(image)
         image_mime.add_header('Content-ID', '<%s>' % image_id)
         # Cause the images to only render inline, not as attachments
@@ -389,51 +372,21 @@ _MODULE_CPU_COUNT = {
 def email_instance_hours(date, dry_run=False):
     """Email instance hours report for the given datetime.date object."""
     yyyymmdd = date.strftime("%Y%m%d")
-    cost_fn = '\n'.join("WHEN module_id == '%s' THEN latency * %s" % kv
-                        for kv in _MODULE_CPU_COUNT.iteritems())
-    query = """\
-SELECT COUNT(1) as count_,
-elog_url_route as url_route,
-SUM(CASE %s ELSE 0 END) / 3600 as instance_hours
-FROM (
-  -- When logs get split into multiple entries, each has latency calculated
-  -- from the start of the request to the point where the log line was emitted.
-  -- This means the total latency is the maximum value that appears, not the
-  -- sum.
-  SELECT FIRST(elog_url_route) AS elog_url_route,
-         IFNULL(FIRST(module_id), 'default') AS module_id,
-         MAX(latency) AS latency,
-         FIRST(url_map_entry) AS url_map_entry
-  FROM [logs.requestlogs_%s]
-  WHERE LEFT(version_id, 3) != 'znd' # ignore znds
-  GROUP BY request_id
-)
-WHERE url_map_entry != "" # omit static files
-GROUP BY url_route
-ORDER BY instance_hours DESC
-""" % (cost_fn, yyyymmdd)
-    data = bq_util.query_bigquery(query)
+    data = requestlogs_facts.instance_hours(
+        requestlogs_facts.get_facts(yyyymmdd), _MODULE_CPU_COUNT)
     bq_util.save_daily_data(data, "instance_hours", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "instance_hours", date, 14, lambda row: row['url_route'])
+    history = bq_history.get_history(
+        "instance_hours", date, 14, ['instance_hours', 'count_'])
 
     # Munge the table by adding a few columns.
-    total_instance_hours = 0.0
-    for row in data:
-        total_instance_hours += row['instance_hours']
-
-    for row in data:
-        row['%% of total'] = row['instance_hours'] / total_instance_hours * 100
-        row['per 1k requests'] = row['instance_hours'] / row['count_'] * 1000
-        sparkline_data = []
-        for old_data in historical_data:
-            old_row = old_data.get(row['url_route'])
-            if old_row:
-                sparkline_data.append(
-                    old_row['instance_hours'] / old_row['count_'])
-            else:
-                sparkline_data.append(None)
-        row['last 2 weeks (per request)'] = sparkline_data
+    table = report_table.Table.from_rows(
+        data, ['url_route', 'instance_hours', 'count_'])
+    table.percent_of_total('%% of total', 'instance_hours')
+    table.ratio('per 1k requests', 'instance_hours', 'count_', scale=1000)
+    table.set_column('last 2 weeks (per request)', [
+        history.series(url_route, lambda instance_hours, count: (
+            instance_hours / count))
+        for url_route in table['url_route']])
 
     _ORDER = ('%% of total', 'instance_hours', 'count_', 'per 1k requests',
               'last 2 weeks (per request)', 'url_route')
@@ -441,29 +394,34 @@ ORDER BY instance_hours DESC
     subject = 'Instance Hours by Route - '
     heading = 'Cost-normalized instance hours by route for %s' % (
         _pretty_date(yyyymmdd))
-    all_data = _convert_table_rows_to_lists(data, _ORDER)
+    all_data = table.select(_ORDER)
     # Let's just send the top most expensive routes, not all of them.
-    _send_email({heading: all_data[:50]}, None,
+    _send_email({heading: all_data.top(50)}, None,
                 to=[initiatives.email('infrastructure')],
                 subject=subject + 'All',
                 dry_run=dry_run)
 
     # Per-initiative reports
-    for initiative_id, initiative_data in _by_initiative(data):
-        table = _convert_table_rows_to_lists(initiative_data, _ORDER)
-        _send_email({heading: table[:50]}, None,
+    for initiative_id, initiative_data in _by_initiative(all_data):
+        _send_email({heading: initiative_data.top(50)}, None,
                     to=[initiatives.email(initiative_id)],
                     subject=subject + initiatives.title(initiative_id),
                     dry_run=dry_run)
 
     # We'll also send the most-most expensive ones to stackdriver.
-    _send_table_to_stackdriver(all_data[:20],
+    _send_table_to_stackdriver(all_data.top(20),
                                'webapp.routes.instance_hours.week_over_week',
                                'url_route', metric_label_col='url_route',
                                data_col='last 2 weeks (per request)',
                                dry_run=dry_run)
 
 
+# The names of the RPCs we report on, e.g. 'Get' for the rpc_Get column.
+_RPC_FIELDS = tuple(column[len('rpc_'):]
+                    for column in requestlogs_facts.RPC_STATS
+                    if column != 'rpc_cost')
+
+
 def email_rpcs(date, dry_run=False):
     """Email RPCs-per-route report for the given datetime.date object.
 
@@ -471,93 +429,52 @@ def email_rpcs(date, dry_run=False):
     This indicates a bug that is costing us money.
     """
     yyyymmdd = date.strftime("%Y%m%d")
-    rpc_fields = ('Get', 'Put', 'Next', 'RunQuery', 'Delete', 'Commit')
-
-    inits = ["IFNULL(INTEGER(t%s.rpc_%s), 0) AS rpc_%s" % (name, name, name)
-             for name in rpc_fields]
-    inits.append("IFNULL(tcost.rpc_cost, 0) AS rpc_cost")
-    joins = ["LEFT OUTER JOIN ( "
-             "SELECT elog_url_route AS url_route, "
-             "       SUM(elog_stats_rpc_ops.value) as rpc_%s "
-             "FROM [logs.requestlogs_%s] "
-             "WHERE elog_stats_rpc_ops.key = 'stats.rpc_ops.%s.count' "
-             "GROUP BY url_route) AS t%s "
-             "ON t1.url_route = t%s.url_route"
-             % (name, yyyymmdd, name, name, name)
-             for name in rpc_fields]
-    joins.append("LEFT OUTER JOIN ( "
-                 "SELECT elog_url_route AS url_route, "
-                 "       SUM(elog_stats_rpc_ops.value) AS rpc_cost "
-                 "FROM [logs.requestlogs_%s] "
-                 "WHERE elog_stats_rpc_ops.key = 'stats.rpc_ops.cost' "
-                 "GROUP BY url_route) AS tcost "
-                 "ON t1.url_route = tcost.url_route"
-                 % yyyymmdd)
-    query = """\
-SELECT t1.url_route AS url_route,
-t1.url_requests AS requests,
-%s
-FROM (
-    SELECT elog_url_route AS url_route, COUNT(1) AS url_requests
-    FROM (
-        SELECT FIRST(elog_url_route) AS elog_url_route
-        FROM [logs.requestlogs_%s]
-        WHERE LEFT(version_id, 3) != 'znd' # ignore znds
-        GROUP BY request_id
-    )
-    GROUP BY url_route
-) AS t1
-%s
-ORDER BY tcost.rpc_cost DESC;
-""" % (',\n'.join(inits), yyyymmdd, '\n'.join(joins))
-    data = bq_util.query_bigquery(query)
+
+    # The RPC stats are pivoted into columns as part of the single scan
+    # that makes the fact table (see requestlogs_facts.facts_query), so
+    # this costs nothing if another report already got the facts.
+    data = requestlogs_facts.rpcs(requestlogs_facts.get_facts(yyyymmdd))
     bq_util.save_daily_data(data, "rpcs", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "rpcs", date, 14, lambda row: row['url_route'])
+    history = bq_history.get_history(
+        "rpcs", date, 14, ['rpc_cost', 'requests'])
 
     # Munge the table by getting per-request counts for every RPC stat.
     micropennies = '&mu;&cent;'
-    for row in data:
-        for stat in rpc_fields:
-            row['%s/req' % stat] = row['rpc_%s' % stat] * 1.0 / row['requests']
-        row[micropennies + '/req'] = row['rpc_cost'] * 1.0 / row['requests']
-        row['$'] = row['rpc_cost'] * 1.0e-8
-        sparkline_data = []
-        for old_data in historical_data:
-            old_row = old_data.get(row['url_route'])
-            if old_row and 'rpc_cost' in old_row:
-                sparkline_data.append(
-                    old_row['rpc_cost'] * 1.0 / old_row['requests'])
-            else:
-                sparkline_data.append(None)
-        row['last 2 weeks (%s/req)' % micropennies] = sparkline_data
-
-        del row['rpc_cost']
-
-    # Convert each row from a dict to a list, in a specific order.
+    rpc_columns = ['rpc_%s' % stat for stat in _RPC_FIELDS]
+    table = report_table.Table.from_rows(
+        data, ['url_route', 'requests', 'rpc_cost'] + rpc_columns)
+    for stat in _RPC_FIELDS:
+        table.ratio('%s/req' % stat, 'rpc_%s' % stat, 'requests')
+    table.ratio(micropennies + '/req', 'rpc_cost', 'requests')
+    table.derive('$', lambda rpc_cost: rpc_cost * 1.0e-8, 'rpc_cost')
+    table.set_column('last 2 weeks (%s/req)' % micropennies, [
+        history.series(url_route,
+                       lambda rpc_cost, requests: rpc_cost / requests)
+        for url_route in table['url_route']])
+
+    # Put the columns in a specific order (and leave out rpc_cost).
     _ORDER = (['url_route', 'requests', '$', micropennies + '/req',
                'last 2 weeks (%s/req)' % micropennies] +
-              ['rpc_%s' % f for f in rpc_fields] +
-              ['%s/req' % f for f in rpc_fields])
-    all_data = _convert_table_rows_to_lists(data, _ORDER)
+              rpc_columns +
+              ['%s/req' % f for f in _RPC_FIELDS])
+    all_data = table.select(_ORDER)
     subject = 'RPC calls by route - '
     heading = 'RPC calls by route for %s' % _pretty_date(yyyymmdd)
-    _send_email({heading: all_data[:75]}, None,
+    _send_email({heading: all_data.top(75)}, None,
                 to=[initiatives.email('infrastructure')],
                 subject=subject + 'All',
                 dry_run=dry_run)
 
     # Per-initiative reports
-    for initiative_id, initiative_data in _by_initiative(data):
-        table = _convert_table_rows_to_lists(initiative_data, _ORDER)
+    for initiative_id, initiative_data in _by_initiative(all_data):
         # Let's just send the top most expensive routes, not all of them.
-        _send_email({heading: table[:75]}, None,
+        _send_email({heading: initiative_data.top(75)}, None,
                     to=[initiatives.email(initiative_id)],
                     subject=subject + initiatives.title(initiative_id),
                     dry_run=dry_run)
 
     # We'll also send the most-most expensive ones to stackdriver.
-    _send_table_to_stackdriver(all_data[:20],
+    _send_table_to_stackdriver(all_data.top(20),
                                'webapp.routes.rpc_cost.week_over_week',
                                'url_route', metric_label_col='url_route',
                                data_col='last 2 weeks (%s/req)' % micropennies,
@@ -567,8 +484,8 @@ ORDER BY tcost.rpc_cost DESC;
     # day.  More than $750 a day and we should be very suspcious.
     # TODO(csilvers): do this check more frequently.
     # TODO(csilvers): send to slack and/or 911 as well as emailing
-    if any(row[2] > 750 for row in all_data[1:]):    # ignore the header line
-        _send_email({heading: all_data[:75]}, None,
+    if any(dollars > 750 for dollars in all_data['$']):
+        _send_email({heading: all_data.top(75)}, None,
                     to=['infrastructure@khanacademy.org'],
                     subject=('WARNING: some very expensive RPC calls on %s!'
                              % _pretty_date(yyyymmdd)),
@@ -581,128 +498,71 @@ def email_out_of_memory_errors(date, dry_run=False):
     yyyymmdd = date.strftime("%Y%m%d")
     subject = 'OOM errors - '
 
-    # Out-of-memory errors for python look like:
-    #   Exceeded soft memory limit of 2048 MB with 2078 MB after servicing 1497 requests total. Consider setting a larger instance class in app.yaml.  #@Nolint
-    # Out-of-memory errors for kotlin look like:
-    #   java.lang.OutOfMemoryError: <reason>
-    #   (where <reason> is some text that may take on a number of values
-    #   depending on whether the problem is lack of heap space, the garbage
-    #   collector taking too long to stay ahead of garbage accumulation, etc.)
-    # Note that older messages (before the gVisor sandboxs) started with
-    # "Exceeded soft private memory limit" instead.
-    numreqs = r"REGEXP_EXTRACT(app_logs.message, r'servicing (\d+) requests')"
-    query = """\
-SELECT COUNT(1) AS count_,
-       IFNULL(module_id, 'default') AS module_id,
-       NTH(10, QUANTILES(INTEGER(%s), 101)) as numserved_10th,
-       NTH(50, QUANTILES(INTEGER(%s), 101)) as numserved_50th,
-       NTH(90, QUANTILES(INTEGER(%s), 101)) as numserved_90th
-FROM [logs.requestlogs_%s]
-WHERE (app_logs.message CONTAINS 'Exceeded soft memory limit'
-       OR app_logs.message CONTAINS 'OutOfMemoryError')
-  AND LEFT(version_id, 3) != 'znd' # ignore znds
-GROUP BY module_id
-ORDER BY count_ DESC
-""" % (numreqs, numreqs, numreqs, yyyymmdd)
-    data = bq_util.query_bigquery(query)
-    bq_util.save_daily_data(data, "out_of_memory_errors_by_module", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "out_of_memory_errors_by_module", date, 14,
-        lambda row: row['module_id'])
-
-    for row in data:
-        sparkline_data = []
-        for old_data in historical_data:
-            old_row = old_data.get(row['module_id'])
-            if old_row:
-                sparkline_data.append(old_row['count_'])
-            elif old_data:
-                # If we have data, just not on this module, then it just didn't
-                # OOM.
-                sparkline_data.append(0)
-            else:
-                # On the other hand, if we don't have data at all, we should
-                # show a gap.
-                sparkline_data.append(None)
-        row['last 2 weeks'] = sparkline_data
+    facts = requestlogs_facts.get_facts(yyyymmdd)
+    module_data = requestlogs_facts.oom_by_module(facts)
+    route_data = requestlogs_facts.oom_by_route(facts)
+    bq_util.save_daily_data(module_data, "out_of_memory_errors_by_module",
+                            yyyymmdd)
+    history = bq_history.get_history(
+        "out_of_memory_errors_by_module", date, 14, ['count_'])
+
+    module_table = report_table.Table.from_rows(
+        module_data, ['count_', 'module_id', 'numserved_10th',
+                      'numserved_50th', 'numserved_90th'])
+    # If we have data, just not on this module, then it just didn't
+    # OOM.  On the other hand, if we don't have data at all, we should
+    # show a gap (series() gives None for those days).
+    module_table.derive(
+        'last 2 weeks',
+        lambda module_id: history.series(module_id, lambda count: count,
+                                         absent=0),
+        'module_id')
 
     _ORDER = ['count_', 'last 2 weeks', 'module_id',
               'numserved_10th', 'numserved_50th', 'numserved_90th']
-    data = _convert_table_rows_to_lists(data, _ORDER)
-
     heading = 'OOM errors by module for %s' % _pretty_date(yyyymmdd)
-    email_content = {heading: data}
-
-    query = """\
-SELECT COUNT(1) AS count_,
-       module_id,
-       elog_url_route AS url_route
-FROM (
-    SELECT IFNULL(FIRST(module_id), 'default') AS module_id,
-           FIRST(elog_url_route) AS elog_url_route,
-           SUM(IF(
-               app_logs.message CONTAINS 'Exceeded soft memory limit'
-               OR app_logs.message CONTAINS 'OutOfMemoryError',
-               1, 0)) AS oom_message_count
-    FROM [logs.requestlogs_%s]
-    WHERE LEFT(version_id, 3) != 'znd' # ignore znds
-    GROUP BY request_id
-    HAVING oom_message_count > 0
-)
-GROUP BY module_id, url_route
-ORDER BY count_ DESC
-""" % yyyymmdd
-    data = bq_util.query_bigquery(query)
-    bq_util.save_daily_data(data, "out_of_memory_errors_by_route", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "out_of_memory_errors_by_route", date, 14,
-        lambda row: (row['module_id'], row['url_route']))
-
-    for row in data:
-        sparkline_data = []
-        for old_data in historical_data:
-            old_row = old_data.get((row['module_id'], row['url_route']))
-            if old_row:
-                sparkline_data.append(old_row['count_'])
-            elif old_data:
-                # If we have data, just not on this route/module, then it just
-                # didn't OOM.
-                sparkline_data.append(0)
-            else:
-                # On the other hand, if we don't have data at all, we should
-                # show a gap.
-                sparkline_data.append(None)
-        row['last 2 weeks'] = sparkline_data
+    email_content = {heading: module_table.select(_ORDER)}
+
+    bq_util.save_daily_data(route_data, "out_of_memory_errors_by_route",
+                            yyyymmdd)
+    history = bq_history.get_history(
+        "out_of_memory_errors_by_route", date, 14, ['count_'])
+
+    route_table = report_table.Table.from_rows(
+        route_data, ['count_', 'module_id', 'url_route'])
+    # As above, routes missing from a day's data just didn't OOM.
+    route_table.derive(
+        'last 2 weeks',
+        lambda module_id, url_route: history.series(
+            (module_id, url_route), lambda count: count, absent=0),
+        'module_id', 'url_route')
 
     _ORDER = ['count_', 'last 2 weeks', 'module_id', 'url_route']
     heading = 'OOM errors by route for %s' % _pretty_date(yyyymmdd)
 
-    email_content[heading] = _convert_table_rows_to_lists(data, _ORDER)
+    route_table = route_table.select(_ORDER)
+    email_content[heading] = route_table
     _send_email(email_content, None,
                 to=[initiatives.email('infrastructure')],
                 subject=subject + 'All',
                 dry_run=dry_run)
 
     # Per-initiative reports
-    for initiative_id, initiative_data in _by_initiative(data):
-        table = _convert_table_rows_to_lists(initiative_data, _ORDER)
-        email_content = {heading: table}
+    for initiative_id, initiative_data in _by_initiative(route_table):
+        email_content = {heading: initiative_data}
         _send_email(email_content, None,
                     to=[initiatives.email(initiative_id)],
                     subject=subject + initiatives.title(initiative_id),
                     dry_run=dry_run)
 
 
-def email_client_api_usage(date, dry_run=False):
-    """Emails a report of API usage, segmented by client and build version."""
-    yyyymmdd = date.strftime("%Y%m%d")
-
+def _client_api_usage_query(yyyymmdd):
     ios_user_agent_regex = '^Khan%20Academy\.(.*)/(.*) CFNetwork/([.0-9]*)' \
                            ' Darwin/([.0-9]*)$'
 
     # We group all non-ios user agents into a single bucket to keep this
     # report down to a reasonable size.
-    query = """\
+    return """\
 SELECT IF(REGEXP_MATCH(user_agent, r'%(ios_user_agent_regex)s'),
       REGEXP_REPLACE(user_agent, r'%(ios_user_agent_regex)s', r'iOS \1'),
       'Web Browsers/other') as client,
@@ -719,11 +579,19 @@ WHERE REGEXP_MATCH(elog_url_route, '^api.main:/api/internal')
 GROUP BY client, build, route
 ORDER BY client DESC, build DESC, request_count DESC;
 """ % {'ios_user_agent_regex': ios_user_agent_regex, 'date_format': yyyymmdd}
-    data = bq_util.query_bigquery(query)
+
+
+def email_client_api_usage(date, dry_run=False):
+    """Emails a report of API usage, segmented by client and build version."""
+    yyyymmdd = date.strftime("%Y%m%d")
+
+    data = bq_util.query_bigquery(_client_api_usage_query(yyyymmdd),
+                                  cache_ttl=bq_util.QUERY_CACHE_TTL,
+                                  stats_name='client_api_usage')
     bq_util.save_daily_data(data, "client_api_usage", yyyymmdd)
 
     _ORDER = ('client', 'build', 'route', 'request_count')
-    all_data = _convert_table_rows_to_lists(data, _ORDER)
+    all_data = report_table.Table.from_rows(data, _ORDER)
 
     subject = 'API usage by client - '
     heading = 'API usage by client for %s' % _pretty_date(yyyymmdd)
@@ -733,26 +601,16 @@ ORDER BY client DESC, build DESC, request_count DESC;
                 dry_run=dry_run)
 
     # Per-initiative reports
-    for initiative_id, initiative_data in _by_initiative(data,
+    for initiative_id, initiative_data in _by_initiative(all_data,
                                                          key='route'):
-        table = _convert_table_rows_to_lists(initiative_data, _ORDER)
-        _send_email({heading: table}, None,
+        _send_email({heading: initiative_data}, None,
                     to=[initiatives.email(initiative_id)],
                     subject=subject + initiatives.title(initiative_id),
                     dry_run=dry_run)
 
 
-def email_rrs_stats(date, dry_run=False):
-    """Emails stats about rrs requests that are too slow or have errors.
-
-    rrs == React Render Server.
-
-    Requests that take longer than one second are timed out and thus simply add
-    a second to the reponse, rather than speeding it up.
-    """
-    yyyymmdd = date.strftime("%Y%m%d")
-
-    latency_q = """
+def _rrs_latency_query(yyyymmdd):
+    return """
 SELECT
   REPLACE(REGEXP_EXTRACT(
     httpRequest.requestUrl, r'/render\?path=\.(.*)'), '%2F', '/') AS url,
@@ -772,7 +630,9 @@ ORDER BY
   timeout_percent DESC
 """.format(yyyymmdd)
 
-    error_q = """
+
+def _rrs_error_query(yyyymmdd):
+    return """
 SELECT
   REPLACE(REGEXP_EXTRACT(
     httpRequest.requestUrl, r'/render\?path=\.(.*)'), '%2F', '/') AS url,
@@ -786,8 +646,20 @@ ORDER BY
   error_percent DESC
 """.format(yyyymmdd)
 
+
+def email_rrs_stats(date, dry_run=False):
+    """Emails stats about rrs requests that are too slow or have errors.
+
+    rrs == React Render Server.
+
+    Requests that take longer than one second are timed out and thus simply add
+    a second to the reponse, rather than speeding it up.
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+
     latency_data = bq_util.get_daily_data('rrs_latency', yyyymmdd)
-    if latency_data is None:
+    error_data = bq_util.get_daily_data('rrs_errors', yyyymmdd)
+    if latency_data is None or error_data is None:
         table_name = ("khan-academy:react_render_logs" +
                       ".appengine_googleapis_com_nginx_request_{}"
                       ).format(yyyymmdd)
@@ -796,12 +668,10 @@ ORDER BY
             print "The RRS logs were not generated. No email will be sent."
             print "Returning..."
             return
-        latency_data = bq_util.query_bigquery(latency_q)
+        (latency_data, error_data) = _query_all([
+            ('rrs_latency', _rrs_latency_query(yyyymmdd)),
+            ('rrs_errors', _rrs_error_query(yyyymmdd))])
         bq_util.save_daily_data(latency_data, 'rrs_latency', yyyymmdd)
-
-    error_data = bq_util.get_daily_data('rrs_errors', yyyymmdd)
-    if error_data is None:
-        error_data = bq_util.query_bigquery(error_q)
         bq_util.save_daily_data(error_data, 'rrs_errors', yyyymmdd)
 
     subject = 'React render server errors and timeouts - '
@@ -810,17 +680,17 @@ ORDER BY
     error_order = ('url', 'error_count', 'error_percent')
     latency_order = ('url', 'average_latency', 'count', 'timeouts',
                      'timeout_percent')
+    error_table = report_table.Table.from_rows(error_data, error_order)
+    latency_table = report_table.Table.from_rows(latency_data, latency_order)
     tables = collections.defaultdict(dict)
 
     # Put data in tables by initiative
     for initiative_id, initiative_data in _by_initiative(
-            error_data, key='url', by_package=True):
-        tables[initiative_id][error_heading] = _convert_table_rows_to_lists(
-            initiative_data, error_order)
+            error_table, key='url', by_package=True):
+        tables[initiative_id][error_heading] = initiative_data
     for initiative_id, initiative_data in _by_initiative(
-            latency_data, key='url', by_package=True):
-        tables[initiative_id][latency_heading] = _convert_table_rows_to_lists(
-            initiative_data, latency_order)
+            latency_table, key='url', by_package=True):
+        tables[initiative_id][latency_heading] = initiative_data
 
     # Send email to initiatives
     for initiative_id, initiative_tables in tables.items():
@@ -831,26 +701,14 @@ ORDER BY
 
     # Send all data to infra
     tables = {}
-    tables[error_heading] = _convert_table_rows_to_lists(error_data,
-                                                         error_order)
-    tables[latency_heading] = _convert_table_rows_to_lists(latency_data,
-                                                           latency_order)
+    tables[error_heading] = error_table
+    tables[latency_heading] = latency_table
     _send_email(tables, graph=None, to=[initiatives.email('infrastructure')],
                 subject=subject + 'All', dry_run=dry_run)
 
 
-def email_applog_sizes(date, dry_run=False):
-    """Email app-log report for the given datetime.date object.
-
-    This report says how much we are logging (via logging.info()
-    and friends), grouped by the first word of the log message.
-    (Which usually, but not always, is a good proxy for a single
-    log-message in our app.)  Since we pay per byte logged, we
-    want to make sure we're not accidentally logging a single
-    log message a ton, which is really easy to do.
-    """
-    yyyymmdd = date.strftime("%Y%m%d")
-    query = """\
+def _applog_sizes_query(yyyymmdd):
+    return """\
 SELECT
   REGEXP_EXTRACT(app_logs.message, r'^([a-zA-Z0-9_-]*)') AS firstword,
   FIRST(app_logs.message) as sample_logline,
@@ -868,30 +726,37 @@ GROUP BY
 ORDER BY
   cost_usd DESC
 """ % (yyyymmdd)
-    data = bq_util.query_bigquery(query)
-    data = [row for row in data if row['firstword'] not in (None, '(None)')]
+
+
+def email_applog_sizes(date, dry_run=False):
+    """Email app-log report for the given datetime.date object.
+
+    This report says how much we are logging (via logging.info()
+    and friends), grouped by the first word of the log message.
+    (Which usually, but not always, is a good proxy for a single
+    log-message in our app.)  Since we pay per byte logged, we
+    want to make sure we're not accidentally logging a single
+    log message a ton, which is really easy to do.
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    data = [row for row in bq_util.query_bigquery_iter(
+                _applog_sizes_query(yyyymmdd),
+                cache_ttl=bq_util.QUERY_CACHE_TTL, stats_name='applog_sizes')
+            if row['firstword'] not in (None, '(None)')]
     bq_util.save_daily_data(data, "log_bytes", yyyymmdd)
-    historical_data = bq_util.process_past_data(
-        "log_bytes", date, 14, lambda row: row['firstword'])
+    history = bq_history.get_history("log_bytes", date, 14, ['size_mb'])
 
     # Munge the table by adding a few columns.
-    total_bytes = 0.0
-    for row in data:
-        total_bytes += row['size_mb']
-
-    for row in data:
-        row['%% of total'] = row['size_mb'] / total_bytes * 100
-        sparkline_data = []
-        for old_data in historical_data:
-            old_row = old_data.get(row['firstword'])
-            if old_row:
-                sparkline_data.append(old_row['size_mb'])
-            else:
-                sparkline_data.append(None)
-        row['last 2 weeks'] = sparkline_data
-        # While we're here, truncate the sample-logline, since it can get
-        # really long.
-        row['sample_logline'] = row['sample_logline'][:80]
+    table = report_table.Table.from_rows(
+        data, ['size_mb', 'cost_usd', 'firstword', 'sample_logline'])
+    table.percent_of_total('%% of total', 'size_mb')
+    table.derive('last 2 weeks',
+                 lambda firstword: history.series(firstword,
+                                                  lambda size_mb: size_mb),
+                 'firstword')
+    # While we're here, truncate the sample-logline, since it can get
+    # really long.
+    table.derive('sample_logline', lambda line: line[:80], 'sample_logline')
 
     _ORDER = ('%% of total', 'size_mb', 'cost_usd',
               'last 2 weeks', 'firstword', 'sample_logline')
@@ -899,17 +764,17 @@ ORDER BY
     subject = 'Log-bytes by first word of log-message - '
     heading = 'Cost-normalized log-bytes by firstword for %s' % (
         _pretty_date(yyyymmdd))
-    all_data = _convert_table_rows_to_lists(data, _ORDER)
+    all_data = table.select(_ORDER)
     # Let's just send the top most expensive routes, not all of them.
-    _send_email({heading: all_data[:50]}, None,
+    _send_email({heading: all_data.top(50)}, None,
                 to=[initiatives.email('infrastructure')],
                 subject=subject + 'All',
                 dry_run=dry_run)
 
     # As of 1 Jun 2018, the most expensive firstword costs about
     # $2/day.  More than $20 a day and we should be very suspicious.
-    if any(row[2] > 20 for row in all_data[1:]):    # ignore the header line
-        _send_email({heading: all_data[:75]}, None,
+    if any(cost > 20 for cost in all_data['cost_usd']):
+        _send_email({heading: all_data.top(75)}, None,
                     to=['infrastructure@khanacademy.org'],
                     subject=('WARNING: some very expensive loglines on %s!'
                              % _pretty_date(yyyymmdd)),
@@ -918,45 +783,156 @@ ORDER BY
     # TODO(csilvers): also send the most-expensive firstwords to stackdriver.
 
 
+def _backfill_history(date, max_concurrent=5):
+    """Re-run the queries for days missing from the sparklines' history.
+
+    The sparklines cover the two weeks before `date`; if a nightly run
+    failed, re-running its queries now fills the hole in them.
+    """
+    requestlogs_facts.backfill(
+        {'instance_hours': lambda facts: requestlogs_facts.instance_hours(
+            facts, _MODULE_CPU_COUNT),
+         'rpcs': requestlogs_facts.rpcs,
+         'out_of_memory_errors_by_module': requestlogs_facts.oom_by_module,
+         'out_of_memory_errors_by_route': requestlogs_facts.oom_by_route},
+        date, 14, max_concurrent=max_concurrent)
+    bq_util.backfill_daily_data(
+        {'log_bytes': _applog_sizes_query}, date, 14,
+        # email_applog_sizes drops these rows before saving its data.
+        row_filters={'log_bytes': lambda row: (
+            row['firstword'] not in (None, '(None)'))},
+        max_concurrent=max_concurrent)
+
+
+def _compute_requestlogs_facts(date, dry_run=False):
+    """Compute (and save) the fact table several of the reports use."""
+    requestlogs_facts.get_facts(date.strftime("%Y%m%d"))
+
+
+_REQUESTLOGS_TABLE = 'logs.requestlogs_%(yyyymmdd)s'
+_FACTS = requestlogs_facts.FACTS_REPORT
+
+# The reports we send, and what they read and write; see report_runner.
+REPORTS = [
+    report_runner.Report(
+        _FACTS, _compute_requestlogs_facts,
+        queries=lambda yyyymmdd: {
+            _FACTS: requestlogs_facts.facts_query(yyyymmdd)},
+        tables=[_REQUESTLOGS_TABLE],
+        outputs=[_FACTS]),
+    report_runner.Report(
+        'email_instance_hours', email_instance_hours,
+        reads=[_FACTS],
+        history=[('instance_hours', 14)],
+        outputs=['instance_hours']),
+    report_runner.Report(
+        'email_rpcs', email_rpcs,
+        reads=[_FACTS],
+        history=[('rpcs', 14)],
+        outputs=['rpcs']),
+    report_runner.Report(
+        'email_out_of_memory_errors', email_out_of_memory_errors,
+        reads=[_FACTS],
+        history=[('out_of_memory_errors_by_module', 14),
+                 ('out_of_memory_errors_by_route', 14)],
+        outputs=['out_of_memory_errors_by_module',
+                 'out_of_memory_errors_by_route']),
+    report_runner.Report(
+        'email_client_api_usage', email_client_api_usage,
+        queries=lambda yyyymmdd: {
+            'client_api_usage': _client_api_usage_query(yyyymmdd)},
+        tables=[_REQUESTLOGS_TABLE],
+        outputs=['client_api_usage']),
+    # The rrs queries aren't prefetched: that report only runs them when
+    # the rrs logs exist.
+    report_runner.Report(
+        'email_rrs_stats', email_rrs_stats,
+        tables=['khan-academy:react_render_logs.'
+                'appengine_googleapis_com_nginx_request_%(yyyymmdd)s'],
+        outputs=['rrs_latency', 'rrs_errors']),
+    report_runner.Report(
+        'email_applog_sizes', email_applog_sizes,
+        queries=lambda yyyymmdd: {
+            'applog_sizes': _applog_sizes_query(yyyymmdd)},
+        tables=[_REQUESTLOGS_TABLE],
+        history=[('log_bytes', 14)],
+        outputs=['log_bytes']),
+]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--date', metavar='YYYYMMDD',
                         default=_DEFAULT_DAY.strftime("%Y%m%d"),
                         help=('Date to get reports for, specified as YYYYMMDD '
                               '(default "%(default)s")'))
-    reports = [k for k, v in globals().iteritems() if
-               k.startswith('email') and hasattr(v, '__call__')]
-    parser.add_argument('--report', metavar='NAME', required=False,
-                        help='The function name of a specific report to run.  '
+    reports = [report.name for report in REPORTS]
+    parser.add_argument('--report', metavar='NAME', action='append',
+                        help='A specific report to run (may be repeated); '
+                             'the reports it depends on are run too.  '
                              'Available reports: %s' % ', '.join(reports),
                         choices=reports)
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help=('How many reports to run at once '
+                              '(default %(default)s)'))
+    parser.add_argument('--changed-only', action='store_true',
+                        help=("Skip reports whose inputs haven't changed "
+                              "since they last succeeded for this date."))
+    parser.add_argument('--graphite_host',
+                        default='carbon.hostedgraphite.com:2004',
+                        help=('host:port to send bigquery job stats to '
+                              'graphite (using the pickle protocol). '
+                              '(Default: %(default)s)'))
+    parser.add_argument('--backfill', action='store_true',
+                        help=('First re-run the queries for any days missing '
+                              'from the last two weeks of history, so the '
+                              'sparklines have no holes.'))
     parser.add_argument('--dry-run', '-n', action='store_true',
                         help="Say what we would do but don't actually do it.")
     args = parser.parse_args()
     date = datetime.datetime.strptime(args.date, "%Y%m%d")
 
-    if args.report:
-        report_method = globals()[args.report]
-        print 'Emailing %s info' % args.report
-        report_method(date, dry_run=args.dry_run)
-    else:
-        print 'Emailing instance hour info'
-        email_instance_hours(date, dry_run=args.dry_run)
-
-        print 'Emailing rpc stats info'
-        email_rpcs(date, dry_run=args.dry_run)
-
-        print 'Emailing out-of-memory info'
-        email_out_of_memory_errors(date, dry_run=args.dry_run)
+    # Check for new ownership data while the queries run, rather than
+    # when the first report needs it.
+    initiatives.refresh_in_background()
 
-        print 'Emailing client API usage info'
-        email_client_api_usage(date, dry_run=args.dry_run)
+    if args.backfill:
+        print 'Backfilling missing history'
+        _backfill_history(date)
 
-        print 'Emailing react render server info'
-        email_rrs_stats(date, dry_run=args.dry_run)
-
-        print 'Emailing app-log sizes'
-        email_applog_sizes(date, dry_run=args.dry_run)
+    if args.report:
+        reports = report_runner.with_dependencies(REPORTS, args.report)
+    else:
+        reports = REPORTS
+    if not args.changed_only:
+        report_runner.prefetch_queries(reports, date.strftime("%Y%m%d"))
+    dispatcher = mail_dispatcher.default_dispatcher()
+
+    def deliver():
+        """Wait for the emails to go out; return the reports whose didn't."""
+        dispatcher.close()
+        return dispatcher.failed_senders
+
+    results = report_runner.run_reports(reports, date, dry_run=args.dry_run,
+                                        max_workers=args.max_workers,
+                                        changed_only=args.changed_only,
+                                        deliver=deliver)
+    for result in results:
+        print '%-30s %-9s %7.1fs' % (result.name, result.status,
+                                     result.seconds)
+
+    # run_reports already waited for the emails; this just gets the list
+    # of the ones that failed.
+    mail_failures = dispatcher.close()
+    print ('Query cache: %(hits)s hits, %(misses)s misses, '
+           '%(uncacheable)s uncacheable' % bq_util.query_cache_stats())
+    print ('Bytes scanned: %(estimated)s estimated, %(billed)s billed'
+           % bq_util.bytes_scanned())
+    bq_util.send_job_stats_to_graphite(
+        None if args.dry_run else args.graphite_host)
+    if (mail_failures
+            or any(result.status == 'failed' for result in results)):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -12,9 +12,10 @@ hours after UTC-midnight, to ensure all the logs have made it to BQ.
 """
 import datetime
 import email.mime.text
-import smtplib
+import sys
 
 import bq_util
+import mail_dispatcher
 
 
 # See get_uptime_for_day for what these mean, and how they were chosen.
@@ -201,15 +202,17 @@ def send_uptime_email(end_date):
     msg['Subject'] = "Weekly uptime report"
     msg['From'] = '"bq-cron-reporter" <toby-admin+bq-cron@khanacademy.org>'
     msg['To'] = to
-    s = smtplib.SMTP('localhost')
-    s.sendmail('toby-admin+bq-cron@khanacademy.org', to, msg.as_string())
-    s.quit()
+    mail_dispatcher.default_dispatcher().send(
+        'toby-admin+bq-cron@khanacademy.org', to, msg)
 
 
 def main():
     # TODO(benkraft): allow specifying a date and overriding the default
     # parameters
     send_uptime_email(datetime.datetime.utcnow().date())
+    if mail_dispatcher.default_dispatcher().close():
+        # It already said what failed; make sure cron notices.
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
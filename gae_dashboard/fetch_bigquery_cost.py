@@ -35,6 +35,11 @@ import graphite_util
 # Report on today by default
 _DEFAULT_DAY = datetime.datetime.utcnow().strftime("%Y%m%d")
 
+# The audit-log tables we query grow through the day, but should never
+# get near this big; if they do we want to hear about it, but still
+# report the cost.
+_MAX_BYTES_PER_QUERY = 10 * 1024 ** 3
+
 # Bigquery query cost is $5 per TB processed
 # see: https://cloud.google.com/bigquery/pricing#queries
 # TODO(nabil): scrape the cost from the pricing page instead of hardcoding
@@ -83,7 +88,8 @@ def get_bigquery_costs(date, projects=['khanacademy.org:deductive-jet-827',
                                  table_name)
 
         try:
-            raw_data = bq_util.query_bigquery(query, project=project)
+            raw_data = bq_util.query_bigquery(query, project=project,
+                                              stats_name='bigquery_cost')
         except bq_util.BQException as e:
             # This particular error is sometimes expected when we haven't had a
             # successful query yet today (see comment above on
@@ -144,6 +150,7 @@ def format_for_graphite(project_to_cost_so_far):
 
 
 def main(graphite_host, date, verbose=False, dry_run=False):
+    bq_util.set_scan_budget(per_query=_MAX_BYTES_PER_QUERY, refuse=False)
     project_to_cost_so_far = get_bigquery_costs(date)
     graphite_data = format_for_graphite(project_to_cost_so_far)
 
@@ -157,9 +164,12 @@ def main(graphite_host, date, verbose=False, dry_run=False):
         else:
             print "--> Would send to graphite:"
         print graphite_data
+        print ("--> Bigquery bytes: %(estimated)s estimated, "
+               "%(billed)s billed" % bq_util.bytes_scanned())
 
     if not dry_run:
         graphite_util.send_to_graphite(graphite_host, graphite_data)
+        bq_util.send_job_stats_to_graphite(graphite_host)
 
 
 if __name__ == '__main__':
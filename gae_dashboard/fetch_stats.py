@@ -613,6 +613,12 @@ def main(project_id, graphite_host, interval_in_seconds=300,
                    % (_time_t_of_latest_record(), last_time_t_seen))
             _write_time_t_of_latest_record(last_time_t_seen)
 
+    if graphite_host and not dry_run:
+        sender = graphite_util.sender(graphite_host)
+        print ("Sent %s records to graphite in %s frames "
+               "(%s bytes, %s reconnects)"
+               % (sender.records_sent, sender.frames_sent,
+                  sender.bytes_sent, sender.reconnects))
     print "Done!"
 
 
@@ -4,14 +4,17 @@ Graphite is our timeseries-graphing tool.  We send statistics from
 the GAE admin dashboard to graphite in order to graph them.
 """
 
+import atexit
 import cPickle
 import datetime
 import httplib
 import json
 import logging
 import os
+import select
 import socket
 import struct
+import threading
 import urllib
 import urllib2
 
@@ -86,12 +89,167 @@ def fetch(graphite_host, targets, from_str=None):
         raise
 
 
+# carbon's pickle receiver drops connections that send a frame bigger
+# than 1M, so we keep well under that.
+_MAX_FRAME_BYTES = 512 * 1024
+
+
+class GraphiteSender(object):
+    """Sends records to graphite, over a connection it keeps open.
+
+    We read the api key and look up the host just once, and send all
+    the records over one connection, reconnecting if graphite hangs up
+    on us.  Big lists of records are split into several frames, each
+    at most max_frame_bytes long.  We keep count of what we've sent:
+    see bytes_sent, frames_sent, records_sent, and reconnects.
+    """
+    def __init__(self, graphite_host, api_key=None,
+                 max_frame_bytes=_MAX_FRAME_BYTES, timeout=60):
+        """graphite_host is as for send_to_graphite().
+
+        api_key is the hostedgraphite API key; by default we read it
+        from $HOME/hostedgraphite_secret when we first send something.
+        """
+        self.graphite_host = graphite_host
+        self.max_frame_bytes = max_frame_bytes
+        self.timeout = timeout
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.records_sent = 0
+        self.reconnects = 0
+        self._api_key = api_key
+        self._address = None
+        self._socket = None
+        self._connections = 0
+        # Reports may send from several threads at once.
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_api_key(self):
+        if self._api_key is None:
+            # This will (properly) raise an exception if this file isn't
+            # installed (based on the contents of webapp secrets.py).
+            with open(os.path.expanduser('~/hostedgraphite_secret')) as f:
+                self._api_key = f.read().strip()
+        return self._api_key
+
+    def _connect(self):
+        if self._address is None:
+            (hostname, port_string) = self.graphite_host.split(':')
+            self._address = (socket.gethostbyname(hostname),
+                             int(port_string))
+        graphite_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        graphite_socket.settimeout(self.timeout)
+        try:
+            graphite_socket.connect(self._address)
+        except socket.error:
+            graphite_socket.close()
+            # Maybe the host moved; look it up again next time.
+            self._address = None
+            raise
+        return graphite_socket
+
+    def _connection(self):
+        if self._socket is not None:
+            # carbon never sends us anything, so if the socket is
+            # readable, it's because graphite hung up.  We'd rather
+            # find that out now than by losing the next frame.
+            (readable, _, _) = select.select([self._socket], [], [], 0)
+            if readable:
+                self._disconnect()
+        if self._socket is None:
+            self._socket = _retry(self._connect, 'connecting to graphite',
+                                  (socket.error,))
+            if self._connections:
+                self.reconnects += 1
+            self._connections += 1
+        return self._socket
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _frames(self, records):
+        """Yield pickle-protocol frames of records, splitting as needed."""
+        pickled_data = cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
+        if len(pickled_data) > self.max_frame_bytes and len(records) > 1:
+            middle = len(records) // 2
+            for frame in self._frames(records[:middle]):
+                yield frame
+            for frame in self._frames(records[middle:]):
+                yield frame
+        else:
+            yield (len(records),
+                   struct.pack("!L", len(pickled_data)) + pickled_data)
+
+    def _send_frame(self, frame):
+        """Send a frame, reconnecting once if graphite hung up on us."""
+        for attempt in (1, 2):
+            try:
+                self._connection().sendall(frame)
+                return
+            except socket.error:
+                # We don't know how much of the frame got through, so
+                # we send it all again on a new connection.
+                self._disconnect()
+                if attempt == 2:
+                    raise
+
+    def send(self, records):
+        """Send records, a list of (key, (time_t, value)) pairs.
+
+        See send_to_graphite() for details.
+        """
+        if not self.graphite_host or not records:
+            return
+        with self._lock:
+            api_key = self._get_api_key()
+            # We need to prepend the api-key to each record we're sending.
+            records = [('%s.%s' % (api_key, k), v) for (k, v) in records]
+            for (num_records, frame) in self._frames(records):
+                self._send_frame(frame)
+                self.bytes_sent += len(frame)
+                self.frames_sent += 1
+                self.records_sent += num_records
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+# The GraphiteSender for each host that send_to_graphite() has sent to.
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def sender(graphite_host):
+    """Return a GraphiteSender for graphite_host, shared and closed at exit.
+
+    This is what send_to_graphite() uses, so you can look at its
+    counters to see how much we've sent.
+    """
+    with _senders_lock:
+        if graphite_host not in _senders:
+            _senders[graphite_host] = GraphiteSender(graphite_host)
+            atexit.register(_senders[graphite_host].close)
+        return _senders[graphite_host]
+
+
 def send_to_graphite(graphite_host, records):
     """Sends the given records to the graphite host.
 
     The format of the pickle-protocol data is described at:
     http://graphite.readthedocs.org/en/latest/feeding-carbon.html#the-pickle-protocol
 
+    We keep a connection to each host open between calls; see
+    GraphiteSender.
+
     Arguments:
         graphite_host: hostname:port (port should be the port for the
             pickle protocol, probably 2004), or '' or None to avoid
@@ -102,32 +260,7 @@ def send_to_graphite(graphite_host, records):
     """
     if not graphite_host or not records:
         return
-
-    # Load the api key that we need to send data to graphite.
-    # This will (properly) raise an exception if this file isn't installed
-    # (based on the contents of webapp secrets.py).
-    with open(os.path.expanduser('~/hostedgraphite_secret')) as f:
-        api_key = f.read().strip()
-
-    # We need to prepend the api-key to each record we're sending.
-    records = [('%s.%s' % (api_key, k), v) for (k, v) in records]
-
-    (hostname, port_string) = graphite_host.split(':')
-    host_ip = socket.gethostbyname(hostname)
-    port = int(port_string)
-
-    pickled_data = cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL)
-    payload = struct.pack("!L", len(pickled_data)) + pickled_data
-
-    def _connect_to_graphite():
-        graphite_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        graphite_socket.connect((host_ip, port))
-        return graphite_socket
-
-    graphite_socket = _retry(_connect_to_graphite, 'connecting to graphite',
-                             (socket.error,))
-    graphite_socket.send(payload)
-    graphite_socket.close()
+    sender(graphite_host).send(records)
 
 
 def maybe_send_to_graphite(graphite_host, category, records, module=None):
@@ -0,0 +1,110 @@
+import cPickle
+import socket
+import struct
+import threading
+import unittest
+
+import graphite_util
+
+
+class FakeCarbon(object):
+    """A pickle-protocol server on localhost that records what it gets.
+
+    If hang_up_after is set, it closes each connection after reading
+    that many frames.
+    """
+    def __init__(self):
+        self.frames = []
+        self.connections = 0
+        self.hang_up_after = None
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(5)
+        self.host = '127.0.0.1:%s' % self._listener.getsockname()[1]
+        self._received = threading.Condition()
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, conn, size):
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _serve(self):
+        while True:
+            (conn, _) = self._listener.accept()
+            self.connections += 1
+            frames_on_connection = 0
+            while frames_on_connection != self.hang_up_after:
+                header = self._read(conn, 4)
+                if header is None:
+                    break
+                (size,) = struct.unpack('!L', header)
+                frame = cPickle.loads(self._read(conn, size))
+                frames_on_connection += 1
+                if frames_on_connection == self.hang_up_after:
+                    # Before the sender hears we got it.
+                    conn.close()
+                with self._received:
+                    self.frames.append(frame)
+                    self._received.notify_all()
+            conn.close()
+
+    def records(self, count):
+        """Wait until we've gotten count records, and return them all."""
+        with self._received:
+            while sum(len(frame) for frame in self.frames) < count:
+                self._received.wait(5)
+            return [record for frame in self.frames for record in frame]
+
+
+def _records(start, count):
+    return [('webapp.gae.dashboard.test.stat%d' % i, (1500000000, i))
+            for i in xrange(start, start + count)]
+
+
+class TestGraphiteSender(unittest.TestCase):
+    def setUp(self):
+        self.carbon = FakeCarbon()
+        self.sender = graphite_util.GraphiteSender(
+            self.carbon.host, api_key='key', max_frame_bytes=4096)
+        self.addCleanup(self.sender.close)
+
+    def test_frames(self):
+        self.sender.send(_records(0, 1000))
+        self.sender.send(_records(1000, 10))
+        received = self.carbon.records(1010)
+        self.assertEqual([('key.%s' % key, value)
+                          for (key, value) in _records(0, 1010)], received)
+        self.assertEqual(1, self.carbon.connections)
+        self.assertEqual(len(self.carbon.frames), self.sender.frames_sent)
+        self.assertGreater(self.sender.frames_sent, 2)
+        self.assertTrue(all(len(cPickle.dumps(frame, 2)) <= 4096
+                            for frame in self.carbon.frames))
+        self.assertEqual(1010, self.sender.records_sent)
+        self.assertEqual(0, self.sender.reconnects)
+
+    def test_reconnect(self):
+        self.carbon.hang_up_after = 1
+        for i in xrange(3):
+            self.sender.send(_records(i, 1))
+            self.carbon.records(i + 1)
+        self.assertEqual(_records(0, 3), [
+            (key.replace('key.', '', 1), value)
+            for (key, value) in self.carbon.records(3)])
+        self.assertEqual(3, self.carbon.connections)
+        self.assertEqual(2, self.sender.reconnects)
+
+    def test_no_host(self):
+        sender = graphite_util.GraphiteSender(None)
+        sender.send(_records(0, 10))
+        self.assertEqual(0, sender.frames_sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
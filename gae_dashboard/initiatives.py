@@ -1,15 +1,27 @@
 """Initiatives information including route and file ownership.
 
-The data is generated by webapp/dev/owership and stored in GCS.
+The data is generated by webapp/dev/owership and stored in GCS.  We
+check for a new version once a day, in the background, and only
+download it when it's changed; meanwhile, we use the copy we have.  When
+we fetch it, we also save a snapshot of the lookup tables we build from
+it, in sections that we load only as they're needed; most scripts only
+want a team's name, say, and shouldn't have to parse all of the JSON
+and compile every url regexp to get it.
 """
 import json
+import marshal
 import os
 import os.path
 import re
+import struct
 import subprocess
+import tempfile
+import threading
 import time
 import urlparse
 
+import lru_cache
+
 # TODO(amos): Maybe eventully move these email addresses to
 # dev.ownership._TEAMS. The issue is that some of these aren't general purpose
 # email addresses, rather they are the ones that teams want the bq cron
@@ -36,7 +48,18 @@ DAY = 60 * 60 * 24
 GS_PATH = '~/google-cloud-sdk/bin/gsutil'
 GS_DATA = 'gs://webapp-artifacts/ownership_data.json'
 
+# Bump this when what's in the snapshot of the data, or its layout,
+# changes.
+_SNAPSHOT_VERSION = 1
+
 _data_cache = None
+# Reports may run concurrently (see email_bq_data), so only one thread
+# should fetch and parse the data.
+_data_lock = threading.Lock()
+
+# The thread fetching new data from GCS, if any.
+_refresh_thread = None
+_refresh_lock = threading.Lock()
 
 
 def email(id):
@@ -51,35 +74,289 @@ def slack_channel(id):
     return _load_data()['teams'][id]['slack_channel']
 
 
-# From dev/ownership.py
-def _owner_by_prefix(owners, name, sep='.'):
-    while name:
-        owner = owners.get(name)
-        if owner is not None:
-            return owner
+# The most results of each kind of lookup (files, urls, routes) to
+# remember.  The reports look up the same few thousand routes over and
+# over, once per row of each report.
+_MEMO_SIZE = 10000
+
+# Python's re module allows at most 100 groups in a pattern.
+_MAX_GROUPS_PER_PATTERN = 99
+
+_ROUTE_EXTRA_RE = re.compile(r'([\w-]+)(\+[\w-]+)*\]')
+
+_MISSING = object()
+
+
+class _PathTrie(object):
+    """Owners of paths, looked up by their longest owned prefix.
+
+    The prefixes are whole components: 'a/b' owns 'a/b/c.py' but not
+    'a/bc.py'.  This gives the same answers as dev/ownership.py's
+    _owner_by_prefix, which tries the path, then its parent, and so on,
+    but walks the path once rather than rebuilding a string per level.
+    """
+    def __init__(self, root, sep='/'):
+        # root is as returned by _path_trie().
+        self.sep = sep
+        self._root = root
+
+    def owner(self, name):
+        if not name:
+            return None
+        owner = None
+        node = self._root
+        for part in name.split(self.sep):
+            node = node[0].get(part)
+            if node is None:
+                break
+            if node[1] is not None:
+                owner = node[1]
+        return owner
+
+
+def _path_trie(owners, sep='/'):
+    """Return the root of a trie for a _PathTrie, from a dict of owners.
+
+    Each node is [children-by-component, owner-or-None].  It's all
+    plain lists and dicts, so we can snapshot it.
+    """
+    root = [{}, None]
+    for (name, owner) in owners.iteritems():
+        if not name:
+            continue        # _owner_by_prefix never looks up ''
+        node = root
+        for part in name.split(sep):
+            node = node[0].setdefault(part, [{}, None])
+        node[1] = owner
+    return root
+
+
+class _UrlMatcher(object):
+    """Finds the owner of the first (regexps, owner) all of whose match.
+
+    This gives the same answers as dev/ownership.py's _owner_by_regexps,
+    which tries each entry's regexps in turn, in python.  Instead, we
+    join the first regexp of up to 99 entries at a time into one
+    pattern, '(regexp1)|(regexp2)|...', so the re module can reject a
+    whole run of entries, or find the first one that might match, in a
+    single call.  Only that entry (and, if its other regexps don't
+    match, the rest of its run) is then checked one by one.  Regexps
+    that wouldn't mean the same thing inside a bigger pattern -- those
+    with groups of their own, or flags such as (?i) -- are checked on
+    their own.
+
+    Only the combined patterns are compiled up front; the entries'
+    own regexps are compiled the first time they're needed, which for
+    most entries is never.
+    """
+    def __init__(self, runs):
+        # runs is as returned by _url_runs().
+        self._runs = []
+        for (combined, entries) in runs:
+            if combined is not None:
+                try:
+                    combined = re.compile(combined)
+                except (re.error, OverflowError, RuntimeError):
+                    combined = None     # we'll try them one by one
+            self._runs.append((combined, entries))
+        self._compiled = {}
+
+    def _matches(self, patterns, string):
+        for pattern in patterns:
+            regexp = self._compiled.get(pattern)
+            if regexp is None:
+                regexp = self._compiled[pattern] = re.compile(pattern)
+            if not regexp.match(string):
+                return False
+        return True
+
+    def owner(self, string):
+        for (combined, entries) in self._runs:
+            first = 0
+            if combined is not None:
+                match = combined.match(string)
+                if match is None:
+                    continue
+                first = match.lastindex - 1
+                # We know the candidate's first regexp matches.
+                (patterns, owner) = entries[first]
+                if self._matches(patterns[1:], string):
+                    return owner
+                first += 1
+            for i in xrange(first, len(entries)):
+                (patterns, owner) = entries[i]
+                if self._matches(patterns, string):
+                    return owner
+        return None
+
+
+def _url_runs(owners):
+    """Group (patterns, owner) url entries into runs for a _UrlMatcher.
+
+    Returns a list of (combined pattern or None, [(patterns, owner), ...]),
+    all plain strings and lists, so we can snapshot it.
+    """
+    runs = []
+    run = []
+
+    def add_run():
+        if not run:
+            return
+        combined = '|'.join('(%s)' % patterns[0] for (patterns, _) in run)
+        try:
+            re.compile(combined)
+        except (re.error, OverflowError, RuntimeError):
+            # Too big or too odd to combine; we'll try them one by one.
+            combined = None
+        runs.append((combined, list(run)))
+        del run[:]
+
+    for (patterns, owner) in owners:
+        entry = (list(patterns), owner)
+        if patterns:
+            regexp = re.compile(patterns[0])
+        if not (patterns and regexp.groups == 0
+                and regexp.flags == re.compile('').flags):
+            add_run()
+            runs.append((None, [entry]))
+            continue
+        run.append(entry)
+        if len(run) == _MAX_GROUPS_PER_PATTERN:
+            add_run()
+    add_run()
+    return runs
+
+
+# What to make of each section of the snapshot, if not to use it as is.
+_SECTION_TYPES = {'files': _PathTrie, 'urls': _UrlMatcher}
+
+
+class _OwnershipData(object):
+    """The ownership data, built a section at a time as it's needed.
+
+    The sections are 'files', 'urls', 'routes', 'queues',
+    'graphql-queries' and 'teams'; data['teams'] loads just the teams.
+    """
+    def __init__(self, load_section):
+        # load_section(name) returns the section as snapshotted.
+        self._load_section = load_section
+        self._sections = {}
+        self._lock = threading.Lock()
+        # Memos of lookup results; they go away along with the data they
+        # were computed from.
+        self.memos = {kind: lru_cache.LRUCache(_MEMO_SIZE)
+                      for kind in ('files', 'urls', 'routes')}
+
+    def __getitem__(self, name):
+        section = self._sections.get(name, _MISSING)
+        if section is _MISSING:
+            with self._lock:
+                if name not in self._sections:
+                    make = _SECTION_TYPES.get(name, lambda value: value)
+                    self._sections[name] = make(self._load_section(name))
+                section = self._sections[name]
+        return section
+
+
+def _data_path():
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), DATA_FILE))
+
+
+def _generation_path(path):
+    # Holds the GCS generation of the JSON at path; we touch it each
+    # time we check GCS for a new one.
+    return os.path.splitext(path)[0] + '.generation'
 
-        if sep in name:
-            name, _ = name.rsplit(sep, 1)
-        else:
-            break
-    return None
 
+def _is_stale(path):
+    """True if we haven't checked GCS for new data in the last day."""
+    for filename in (_generation_path(path), path):
+        if os.path.exists(filename):
+            return os.path.getmtime(filename) <= time.time() - DAY
+    return True
 
-# from dev/ownership.py
-def _owner_by_regexps(owners, string):
-    for regexps, owner in owners:
-        if all(regexp.match(string) for regexp in regexps):
-            return owner
-    return None
+
+def _gcs_generation():
+    """Return the generation of the ownership data in GCS, as a string."""
+    output = subprocess.check_output(
+        [os.path.expanduser(GS_PATH), 'stat', GS_DATA])
+    match = re.search(r'^\s*Generation:\s*(\d+)\s*$', output, re.MULTILINE)
+    if match is None:
+        raise ValueError('No generation for %s in:\n%s' % (GS_DATA, output))
+    return match.group(1)
 
 
 def _refresh_data(path):
-    "Reload ownership data from GCS if it's stale."
-    if os.path.exists(path):
-        if os.path.getmtime(path) > time.time() - DAY:
-            # File has already been updated today, don't refresh
+    """Fetch the ownership data from GCS to path, if it's changed.
+
+    We only download it if its generation in GCS differs from the one
+    we have.  Returns True if we fetched new data.
+    """
+    generation = _gcs_generation()
+    generation_file = _generation_path(path)
+    if os.path.exists(path) and os.path.exists(generation_file):
+        with open(generation_file) as f:
+            if f.read().strip() == generation:
+                os.utime(generation_file, None)     # we've checked
+                return False
+
+    # We download to a temporary file, so that other processes (and
+    # threads) keep seeing the old data until the new data is all in.
+    (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                          prefix='.ownership_data')
+    os.close(fd)
+    try:
+        # The generation we looked at, even if there's a newer one now.
+        subprocess.check_call([os.path.expanduser(GS_PATH), 'cp',
+                               '%s#%s' % (GS_DATA, generation), tmp_filename])
+        os.rename(tmp_filename, path)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+    _write_snapshot(path)
+    with open(generation_file, 'w') as f:
+        f.write(generation)
+    return True
+
+
+def _refresh_and_swap(path):
+    global _data_cache
+    try:
+        if not _refresh_data(path):
             return
-    subprocess.check_call([os.path.expanduser(GS_PATH), 'cp', GS_DATA, path])
+    except Exception as e:
+        # We catch everything, since there's no one to raise it to;
+        # we'll try again next time.
+        print 'Could not refresh the ownership data: %s' % e
+        return
+    # Lookups from now on use the new data.  We don't take _data_lock,
+    # since _parse_data() may hold it while it waits for us.
+    if _data_cache:
+        _data_cache = _open_data(path)
+
+
+def refresh_in_background():
+    """Start fetching new ownership data from GCS, if ours is stale.
+
+    Until the new data is in, lookups keep using the data we have; if
+    fetching fails, we keep the data we have.  Scripts can call this
+    when they start, to get the check done off their critical path.
+    Returns the thread doing the fetching, or None if there's no need.
+    """
+    global _refresh_thread
+    path = _data_path()
+    with _refresh_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return _refresh_thread
+        if not _is_stale(path):
+            return None
+        _refresh_thread = threading.Thread(target=_refresh_and_swap,
+                                           args=(path,),
+                                           name='ownership refresh')
+        # We don't want to hold up exiting if GCS is slow.
+        _refresh_thread.daemon = True
+        _refresh_thread.start()
+        return _refresh_thread
 
 
 def _load_data():
@@ -87,57 +364,178 @@ def _load_data():
 
     Loads from:
     - Memory if present
-    - Local filesystem if fresher than 24 hours
-    - GCS otherwise
+    - The snapshot of the local JSON, if it's up to date
+    - The local JSON otherwise
+    - GCS, if we have no local JSON
+    If we haven't checked GCS for new data today, we do so in the
+    background (see refresh_in_background).
     """
     global _data_cache
     if _data_cache:
         return _data_cache
-    path = os.path.abspath(os.path.join(os.path.dirname(__file__), DATA_FILE))
-    _refresh_data(path)
+    with _data_lock:
+        if not _data_cache:
+            _data_cache = _parse_data()
+    return _data_cache
+
+
+def _parse_data():
+    path = _data_path()
+    thread = refresh_in_background()
+    if not os.path.exists(path):
+        # We have nothing to fall back on, so we have to wait for it.
+        thread.join()
+        if not os.path.exists(path):
+            raise IOError('Could not fetch the ownership data from %s'
+                          % GS_DATA)
+    return _open_data(path)
+
+
+def _open_data(path):
+    load_section = _open_snapshot(path)
+    if load_section is None:
+        load_section = _write_snapshot(path).__getitem__
+    return _OwnershipData(load_section)
+
+
+def _snapshot_sections(raw_data):
+    """Return the sections of the snapshot, given the ownership JSON."""
+    return {
+        'files': _path_trie({path: team_id
+                             for path, team_id in raw_data['files']}),
+        'urls': _url_runs(raw_data['urls']),
+        'queues': {queue: teams for queue, teams in raw_data['queues']},
+        'graphql-queries': {query: teams
+                            for query, teams in raw_data['graphql-queries']},
+        'routes': {route: team_id
+                   for route, _, team_id in raw_data['server-routes']},
+        'teams': {team['id']: team for team in raw_data['teams']},
+    }
+
+
+def _build_data(raw_data):
+    """Build the indexes we look owners up in from the ownership JSON."""
+    return _OwnershipData(_snapshot_sections(raw_data).__getitem__)
+
+
+def _snapshot_path(path):
+    return os.path.splitext(path)[0] + '.snapshot'
+
+
+def _write_snapshot(path):
+    """Snapshot the sections built from the JSON at path, and return them.
+
+    The snapshot is a header -- which JSON it's of, and where each
+    section is -- followed by each section, marshalled on its own so
+    that we can load them one at a time.  If we can't save it, we can
+    still use the sections; we'll just build them again next time.
+    """
+    json_stat = os.stat(path)
     with open(path) as f:
-        raw_data = json.load(f)
-    data = {}
-    data['files'] = {path: team_id for path, team_id in raw_data['files']}
-    data['urls'] = [([re.compile(pattern) for pattern in patterns], team_id)
-                    for patterns, team_id in raw_data['urls']]
-    data['queues'] = {queue: teams
-                      for queue, teams in raw_data['queues']}
-    data['graphql-queries'] = {query: teams
-                               for query, teams in raw_data['graphql-queries']}
-    data['routes'] = {route: team_id
-                      for route, _, team_id in raw_data['server-routes']}
-    data['teams'] = {team['id']: team for team in raw_data['teams']}
-    _data_cache = data
-    return data
+        sections = _snapshot_sections(json.load(f))
+
+    blobs = []
+    offsets = {}
+    offset = 0
+    for (name, section) in sorted(sections.iteritems()):
+        blobs.append(marshal.dumps(section))
+        offsets[name] = (offset, len(blobs[-1]))
+        offset += len(blobs[-1])
+    header = marshal.dumps({'version': _SNAPSHOT_VERSION,
+                            'marshal_version': marshal.version,
+                            'json_mtime': json_stat.st_mtime,
+                            'json_size': json_stat.st_size,
+                            'sections': offsets})
+
+    snapshot = _snapshot_path(path)
+    (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(snapshot),
+                                          prefix='.ownership_snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.writelines(blobs)
+        # Atomically, so other processes see the old one or the new one.
+        os.rename(tmp_filename, snapshot)
+    except (IOError, OSError) as e:
+        print 'Not saving a snapshot of the ownership data: %s' % e
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+    return sections
+
+
+def _open_snapshot(path):
+    """Return a function to load sections of path's snapshot, or None.
+
+    We return None if there's no snapshot, or it's not of the JSON at
+    path as it is now.
+    """
+    try:
+        f = open(_snapshot_path(path), 'rb')
+    except IOError:
+        return None
+    try:
+        (header_size,) = struct.unpack('<I', f.read(4))
+        header = marshal.loads(f.read(header_size))
+        json_stat = os.stat(path)
+    except (struct.error, EOFError, ValueError, TypeError, OSError):
+        header = None
+    if not (isinstance(header, dict)
+            and header.get('version') == _SNAPSHOT_VERSION
+            and header.get('marshal_version') == marshal.version
+            and header.get('json_mtime') == json_stat.st_mtime
+            and header.get('json_size') == json_stat.st_size):
+        f.close()
+        return None
+
+    def load_section(name):
+        (offset, size) = header['sections'][name]
+        # We keep the file open, so even if the snapshot is replaced
+        # we're still reading the one the header is from.
+        f.seek(4 + header_size + offset)
+        try:
+            return marshal.loads(f.read(size))
+        except (EOFError, ValueError, TypeError):
+            # The snapshot is corrupt; rebuild it.
+            return _write_snapshot(path)[name]
+
+    return load_section
 
 
 def file_owner(path):
     "Owning team id."
     if path.startswith('/'):
         path = path[1:]
-    data = _load_data()['files']
-    return _owner_by_prefix(data, path, sep='/')
+    data = _load_data()
+    return data.memos['files'].get(path, data['files'].owner)
 
 
 def url_owner(url):
     "Owning team id."
-    data = _load_data()['urls']
-    return _owner_by_regexps(data, urlparse.urlsplit(url).path)
+    data = _load_data()
+    return data.memos['urls'].get(urlparse.urlsplit(url).path,
+                                     data['urls'].owner)
 
 
 def route_owners(route):
     "All owning team ids."
+    data = _load_data()
+    owners = data.memos['routes'].get(
+        route, lambda route: tuple(_route_owners(data, route)))
+    # A new list each time, since callers may modify it.
+    return list(owners)
+
+
+def _route_owners(data, route):
     # Based on dev/ownership.py
     parts = route.strip().split(' [')
     route = parts[0]
-    data = _load_data()
     routes = data['routes']
     queues = data['queues']
     queries = data['graphql-queries']
     owners = []
     for extra in parts[1:]:
-        match = re.match(r'([\w-]+)(\+[\w-]+)*\]', extra)
+        match = _ROUTE_EXTRA_RE.match(extra)
         # We can have multiple names in an extra in the case of multiple
         # graphql queries, e.g. `getFoo+getBar`.
         if match is None:
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Time looking up route, url, and file owners, old way versus indexed.
+
+This classifies a day's worth of distinct routes -- each by its route
+owners and by the owner of its url -- along with a set of file paths,
+first the way initiatives used to (walking the list of url regexps, and
+trying each parent of a path in turn), then with its indexes, cold and
+with the memos warm.  It checks that both ways give the same answers.
+
+By default the ownership data and the routes are synthetic.  Pass
+--data to use a real ownership_data.json, and --routes for a file of
+routes, one per line, such as the output of
+    SELECT elog_url_route FROM [logs.requestlogs_YYYYMMDD] GROUP BY 1
+Run as
+    ./initiatives_benchmark.py [--data FILE] [--routes FILE] [--count N]
+"""
+
+import argparse
+import json
+import random
+import re
+import time
+import urlparse
+
+import initiatives
+
+
+# From dev/ownership.py, as initiatives used to do it.
+def _owner_by_prefix(owners, name, sep='.'):
+    while name:
+        owner = owners.get(name)
+        if owner is not None:
+            return owner
+
+        if sep in name:
+            name, _ = name.rsplit(sep, 1)
+        else:
+            break
+    return None
+
+
+def _owner_by_regexps(owners, string):
+    for regexps, owner in owners:
+        if all(regexp.match(string) for regexp in regexps):
+            return owner
+    return None
+
+
+def _old_route_owners(raw, route):
+    parts = route.strip().split(' [')
+    route = parts[0]
+    owners = []
+    for extra in parts[1:]:
+        match = re.match(r'([\w-]+)(\+[\w-]+)*\]', extra)
+        if match is None:
+            break
+        for name in match.groups():
+            if not name:
+                continue
+            if name.startswith('+'):
+                name = name[1:]
+            if name in raw['queues']:
+                owners += raw['queues'][name]
+            if name in raw['graphql-queries']:
+                owners += raw['graphql-queries'][name]
+    if owners:
+        return list(set(owners))
+    if route in raw['routes']:
+        return [raw['routes'][route]]
+    return ['unknown']
+
+
+def _old_classify(raw, routes, paths):
+    return ([_old_route_owners(raw, route) for route in routes],
+            [_owner_by_regexps(raw['urls'], urlparse.urlsplit(route).path)
+             for route in routes],
+            [_owner_by_prefix(raw['files'], path, sep='/')
+             for path in paths])
+
+
+def _new_classify(routes, paths):
+    return ([initiatives.route_owners(route) for route in routes],
+            [initiatives.url_owner(route) for route in routes],
+            [initiatives.file_owner(path) for path in paths])
+
+
+def _synthetic_data(rng, teams):
+    """Return ownership JSON shaped like webapp's, and routes and paths."""
+    areas = ['api/internal/%s' % word for word in (
+        'user', 'coach', 'content', 'exercises', 'missions', 'scratchpads',
+        'translate', 'districts', 'test-prep', 'profile')] + [
+        'math', 'science', 'computing', 'coach', 'teacher', 'admin']
+    server_routes = ['/%s/%s_%d' % (area, rng.choice(['get', 'set', 'list']),
+                                    i)
+                     for i in xrange(3000)
+                     for area in [rng.choice(areas)]]
+    queries = ['get%sQuery%d' % (rng.choice(['Course', 'User', 'Class']), i)
+               for i in xrange(800)]
+    queues = ['queue-%d' % i for i in xrange(50)]
+    files = ['%s/%s_%d.py' % (rng.choice(areas).replace('api/internal/', ''),
+                              rng.choice(['models', 'handlers', 'util']), i)
+             for i in xrange(2000)]
+    urls = []
+    for route in rng.sample(server_routes, 400):
+        if rng.random() < 0.2:
+            urls.append([['^' + re.escape(route), r'.*\d$'],
+                         rng.choice(teams)])
+        else:
+            urls.append([['^' + re.escape(route)], rng.choice(teams)])
+    urls += [[['^/%s/' % area], rng.choice(teams)] for area in areas]
+    raw_data = {
+        'files': ([[path, rng.choice(teams)] for path in files[:1500]] +
+                  [[area.replace('api/internal/', ''), rng.choice(teams)]
+                   for area in areas[:8]]),
+        'urls': urls,
+        'queues': [[queue, [rng.choice(teams)]] for queue in queues],
+        'graphql-queries': [[query, [rng.choice(teams)]]
+                            for query in queries],
+        'server-routes': [[route, 'GET', rng.choice(teams)]
+                          for route in server_routes],
+        'teams': [{'id': team, 'readable_name': team, 'slack_channel': ''}
+                  for team in teams],
+    }
+
+    routes = list(server_routes)
+    routes += ['/api/internal/graphql/%s [POST] [%s]' % (query, query)
+               for query in queries]
+    routes += ['/_ah/queue/deferred [%s]' % queue for queue in queues]
+    routes += ['/spam/%d [wp-login.php' % i for i in xrange(500)]
+    rng.shuffle(routes)
+    paths = files + ['%s/new_%d.py' % (rng.choice(areas), i)
+                     for i in xrange(500)]
+    return (raw_data, routes, paths)
+
+
+def _raw_indexes(raw_data):
+    """The dicts and lists that initiatives used to look owners up in."""
+    return {
+        'files': {path: team for path, team in raw_data['files']},
+        'urls': [([re.compile(pattern) for pattern in patterns], team)
+                 for patterns, team in raw_data['urls']],
+        'queues': dict(raw_data['queues']),
+        'graphql-queries': dict(raw_data['graphql-queries']),
+        'routes': {route: team
+                   for route, _, team in raw_data['server-routes']},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data',
+                        help='An ownership_data.json to use, rather than '
+                             'synthetic data')
+    parser.add_argument('--routes',
+                        help='A file of routes, one per line, to use rather '
+                             'than synthetic ones')
+    parser.add_argument('--count', type=int, default=5,
+                        help='How many times each report looks each route '
+                             'up (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the data (default %(default)s)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    (raw_data, routes, paths) = _synthetic_data(rng, initiatives.TEAM_IDS)
+    if args.data:
+        with open(args.data) as f:
+            raw_data = json.load(f)
+        paths = [path for (path, _) in raw_data['files']]
+        paths += [path.rsplit('/', 1)[0] + '/new.py' for path in paths]
+    if args.routes:
+        with open(args.routes) as f:
+            routes = [line.strip() for line in f if line.strip()]
+    print ('%s distinct routes, %s paths, %s url regexp entries; each '
+           'looked up %s times' % (len(routes), len(paths),
+                                   len(raw_data['urls']), args.count))
+
+    start = time.time()
+    raw = _raw_indexes(raw_data)
+    for _ in xrange(args.count):
+        old = _old_classify(raw, routes, paths)
+    old_secs = time.time() - start
+
+    start = time.time()
+    initiatives._data_cache = initiatives._build_data(raw_data)
+    build_secs = time.time() - start
+    new = _new_classify(routes, paths)
+    cold_secs = time.time() - start
+    for _ in xrange(args.count - 1):
+        _new_classify(routes, paths)
+    new_secs = time.time() - start
+
+    (old_routes, old_urls, old_files) = old
+    (new_routes, new_urls, new_files) = new
+    if ([sorted(owners) for owners in old_routes] !=
+            [sorted(owners) for owners in new_routes]
+            or old_urls != new_urls or old_files != new_files):
+        print 'MISMATCH: the index gives different owners!'
+
+    print '%-28s %10s' % ('', 'seconds')
+    print '%-28s %10.3f' % ('old (linear)', old_secs)
+    print '%-28s %10.3f' % ('index: build', build_secs)
+    print '%-28s %10.3f' % ('index: first pass (cold)', cold_secs)
+    print '%-28s %10.3f' % ('index: all passes', new_secs)
+
+
+if __name__ == '__main__':
+    main()
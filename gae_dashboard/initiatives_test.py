@@ -0,0 +1,240 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import initiatives
+
+
+_RAW_DATA = {
+    'files': [['content', 'content-platform'],
+              ['content/models', 'learning-platform'],
+              ['coaches/reports.py', 'classroom']],
+    'urls': ([[['/api/internal/user', r'.*/profile$'], 'learning-platform'],
+              [['/api/internal/user'], 'infrastructure'],
+              # Groups of its own, so it's checked on its own.
+              [[r'/(coach|teacher)/'], 'classroom'],
+              [['/coach/reports'], 'districts']] +
+             # Enough to need more than one combined pattern.
+             [[['/p%d/' % i], 'team%d' % i] for i in xrange(250)]),
+    'queues': [['emails', ['mpp']]],
+    'graphql-queries': [['getCourse', ['content-platform']],
+                        ['getCoach', ['classroom']]],
+    'server-routes': [['/api/internal/user', 'GET', 'infrastructure'],
+                      ['/coach/reports', 'GET', 'districts']],
+    'teams': [{'id': 'classroom', 'readable_name': 'Classroom',
+               'slack_channel': '#classroom'}],
+}
+
+
+class TestOwnership(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        self.mock(initiatives, '_data_cache',
+                  initiatives._build_data(_RAW_DATA))
+
+    def mock(self, container, var_str, new_value):
+        oldval = getattr(container, var_str)
+        self.mock_origs[(container, var_str)] = oldval
+        self.addCleanup(lambda: setattr(container, var_str, oldval))
+        setattr(container, var_str, new_value)
+
+    def test_file_owner(self):
+        self.assertEqual('content-platform',
+                         initiatives.file_owner('content/videos.py'))
+        self.assertEqual('learning-platform',
+                         initiatives.file_owner('/content/models/exercise.py'))
+        self.assertEqual('classroom',
+                         initiatives.file_owner('coaches/reports.py'))
+        # Prefixes have to be whole components.
+        self.assertEqual(None, initiatives.file_owner('contentious.py'))
+        self.assertEqual(None, initiatives.file_owner('coaches/other.py'))
+        self.assertEqual(None, initiatives.file_owner(''))
+
+    def test_url_owner(self):
+        self.assertEqual('learning-platform', initiatives.url_owner(
+            'https://www.khanacademy.org/api/internal/user/profile?x=1'))
+        # The first entry's other regexp doesn't match.
+        self.assertEqual('infrastructure', initiatives.url_owner(
+            'https://www.khanacademy.org/api/internal/user/kaid_1'))
+        # Entries match in order, even when checked on their own.
+        self.assertEqual('classroom', initiatives.url_owner(
+            'https://www.khanacademy.org/coach/reports'))
+        self.assertEqual('team0', initiatives.url_owner('/p0/'))
+        self.assertEqual('team98', initiatives.url_owner('/p98/x'))
+        self.assertEqual('team99', initiatives.url_owner('/p99/x'))
+        self.assertEqual('team249', initiatives.url_owner('/p249/x'))
+        self.assertEqual(None, initiatives.url_owner('/p250/x'))
+        self.assertEqual(None, initiatives.url_owner('/math'))
+
+    def test_route_owners(self):
+        self.assertEqual(['infrastructure'],
+                         initiatives.route_owners('/api/internal/user'))
+        self.assertEqual(['mpp'], initiatives.route_owners(
+            '/_ah/queue/deferred [emails]'))
+        self.assertEqual(['classroom', 'content-platform'], sorted(
+            initiatives.route_owners(
+                '/api/internal/graphql [POST] [getCourse+getCoach]')))
+        self.assertEqual(['unknown'], initiatives.route_owners('/math'))
+        # Callers get their own list, even from the memo.
+        owners = initiatives.route_owners('/coach/reports')
+        owners.append('mpp')
+        self.assertEqual(['districts'],
+                         initiatives.route_owners('/coach/reports'))
+
+
+class DataFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        self.data_file = os.path.join(tmpdir, 'ownership_data.json')
+        self.write_json(_RAW_DATA)
+        self.mock(initiatives, 'DATA_FILE', self.data_file)
+
+    def mock(self, container, var_str, new_value):
+        oldval = getattr(container, var_str)
+        self.mock_origs[(container, var_str)] = oldval
+        self.addCleanup(lambda: setattr(container, var_str, oldval))
+        setattr(container, var_str, new_value)
+
+    def write_json(self, raw_data, mtime=None):
+        with open(self.data_file, 'w') as f:
+            json.dump(raw_data, f)
+        if mtime is not None:
+            os.utime(self.data_file, (mtime, mtime))
+
+    def load(self):
+        self.mock(initiatives, '_data_cache', initiatives._parse_data())
+        return initiatives._data_cache
+
+
+class TestSnapshot(DataFileTestCase):
+    def test_lazy_sections(self):
+        self.load()
+        self.assertTrue(os.path.exists(
+            os.path.join(os.path.dirname(self.data_file),
+                         'ownership_data.snapshot')))
+
+        # Now we load from the snapshot, without looking at the JSON.
+        def fail(path):
+            raise AssertionError('Rebuilt the snapshot')
+        self.mock(initiatives, '_write_snapshot', fail)
+        data = self.load()
+        self.assertEqual('Classroom', initiatives.title('classroom'))
+        self.assertEqual(['teams'], data._sections.keys())
+        self.assertEqual('infrastructure', initiatives.url_owner(
+            '/api/internal/user/kaid_1'))
+        self.assertEqual('classroom', initiatives.url_owner('/coach/x'))
+        self.assertEqual('team150', initiatives.url_owner('/p150/'))
+        self.assertEqual('learning-platform',
+                         initiatives.file_owner('content/models/video.py'))
+        self.assertEqual(['mpp'], initiatives.route_owners(
+            '/_ah/queue/deferred [emails]'))
+
+    def test_stale_snapshot(self):
+        self.load()
+        raw_data = dict(_RAW_DATA, teams=[
+            {'id': 'classroom', 'readable_name': 'Teachers',
+             'slack_channel': '#classroom'}])
+        # The new JSON's the same size, but has a different mtime.
+        self.write_json(raw_data, mtime=os.path.getmtime(self.data_file) + 1)
+        self.load()
+        self.assertEqual('Teachers', initiatives.title('classroom'))
+
+
+class FakeGsutil(object):
+    """Serves ownership JSON as gsutil would; cp can be made to wait."""
+    def __init__(self, raw_data, generation):
+        self.raw_data = raw_data
+        self.generation = generation
+        self.calls = []
+        self.fail = False
+        self.cp_started = threading.Event()
+        self.allow_cp = threading.Event()
+        self.allow_cp.set()
+
+    def check_output(self, args):
+        self.calls.append(args[1])
+        if self.fail:
+            raise OSError('gsutil is broken')
+        return ('gs://webapp-artifacts/ownership_data.json:\n'
+                '    Generation:             %s\n'
+                '    Metageneration:         1\n' % self.generation)
+
+    def check_call(self, args):
+        self.calls.append(args[1])
+        self.cp_started.set()
+        self.allow_cp.wait()
+        with open(args[-1], 'w') as f:
+            json.dump(self.raw_data, f)
+
+
+class TestRefresh(DataFileTestCase):
+    def setUp(self):
+        super(TestRefresh, self).setUp()
+        os.unlink(self.data_file)
+        self.gsutil = FakeGsutil(_RAW_DATA, '1')
+        self.mock(initiatives.subprocess, 'check_output',
+                  self.gsutil.check_output)
+        self.mock(initiatives.subprocess, 'check_call',
+                  self.gsutil.check_call)
+        self.mock(initiatives, '_data_cache', None)
+        self.mock(initiatives, '_refresh_thread', None)
+
+    def make_stale(self):
+        day_ago = time.time() - initiatives.DAY - 1
+        os.utime(initiatives._generation_path(self.data_file),
+                 (day_ago, day_ago))
+
+    def test_first_fetch(self):
+        # With nothing local, we have to wait for it.
+        self.assertEqual('Classroom', initiatives.title('classroom'))
+        self.assertEqual(['stat', 'cp'], self.gsutil.calls)
+        # It's fresh now, so we don't check again.
+        self.load()
+        self.assertEqual(None, initiatives.refresh_in_background())
+        self.assertEqual(['stat', 'cp'], self.gsutil.calls)
+
+    def test_unchanged(self):
+        self.load()
+        self.make_stale()
+        self.load()
+        initiatives._refresh_thread.join()
+        # We only checked the generation.
+        self.assertEqual(['stat', 'cp', 'stat'], self.gsutil.calls)
+        self.assertFalse(initiatives._is_stale(self.data_file))
+
+    def test_refresh_in_background(self):
+        self.load()
+        self.make_stale()
+        self.gsutil.raw_data = dict(_RAW_DATA, teams=[
+            {'id': 'classroom', 'readable_name': 'Teachers',
+             'slack_channel': '#classroom'}])
+        self.gsutil.generation = '2'
+        self.gsutil.allow_cp.clear()
+        self.gsutil.cp_started.clear()
+
+        # While the new data is downloading, we use the old.
+        self.load()
+        self.gsutil.cp_started.wait()
+        self.assertEqual('Classroom', initiatives.title('classroom'))
+        self.gsutil.allow_cp.set()
+        initiatives._refresh_thread.join()
+        self.assertEqual('Teachers', initiatives.title('classroom'))
+
+    def test_gcs_failure(self):
+        self.load()
+        self.make_stale()
+        self.gsutil.fail = True
+        self.load()
+        initiatives._refresh_thread.join()
+        self.assertEqual('Classroom', initiatives.title('classroom'))
+        self.assertTrue(initiatives._is_stale(self.data_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""A small, thread-safe memo of a function's most recently used results.
+
+initiatives uses it for ownership lookups, and email_bq_data for the
+rows and sparklines it renders; both are used from several report
+threads at once (see report_runner).
+"""
+
+import collections
+import threading
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A memo of the max_size most recently used results of a function."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return compute(key), from the memo if we can."""
+        with self._lock:
+            value = self._items.pop(key, _MISSING)
+            if value is not _MISSING:
+                self._items[key] = value        # now the most recent
+                return value
+        value = compute(key)
+        with self._lock:
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return value
@@ -0,0 +1,25 @@
+import unittest
+
+import lru_cache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru_cache(self):
+        calls = []
+
+        def compute(key):
+            calls.append(key)
+            return key * 2
+
+        cache = lru_cache.LRUCache(2)
+        self.assertEqual(2, cache.get(1, compute))
+        self.assertEqual(4, cache.get(2, compute))
+        self.assertEqual(2, cache.get(1, compute))
+        self.assertEqual(6, cache.get(3, compute))      # evicts 2
+        self.assertEqual(2, cache.get(1, compute))
+        self.assertEqual(4, cache.get(2, compute))
+        self.assertEqual([1, 2, 3, 2], calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
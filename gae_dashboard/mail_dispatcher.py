@@ -0,0 +1,165 @@
+"""Send email from a background thread, over one SMTP connection.
+
+The reports in email_bq_data send an email per initiative per report,
+dozens a night, and used to connect to the mail server -- and wait for
+it -- for each one.  Instead, they hand their messages to a
+MailDispatcher, which queues them and delivers them in order from a
+worker thread, over a single SMTP session that it reconnects if the
+server hangs up.  It logs how long each message took to send, and keeps
+track of the ones that failed, and of which threads queued them (the
+report runner names each report's thread after the report).  Call
+close() when you're done, to wait
+for the queue to drain and print a summary; the default dispatcher is
+also closed at exit, so no queued mail is lost.
+"""
+
+import atexit
+import Queue
+import smtplib
+import socket
+import threading
+import time
+
+
+class MailDispatcher(object):
+    def __init__(self, host='localhost', max_messages_per_connection=100,
+                 verbose=True):
+        """Send mail via the SMTP server at host.
+
+        We start a new SMTP session every max_messages_per_connection
+        messages, since some servers limit how many they'll take in one.
+        If verbose, we print a line for each message sent.
+        """
+        self.host = host
+        self.max_messages_per_connection = max_messages_per_connection
+        self.verbose = verbose
+        # The seconds each message took to send, (subject, to,
+        # exception) for each one that failed, and the names of the
+        # threads that queued the ones that failed.
+        self.latencies = []
+        self.failures = []
+        self.failed_senders = set()
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._smtp = None
+        self._messages_on_connection = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, from_addr, to, msg):
+        """Queue msg, an email.Message, to be sent; don't wait for it."""
+        with self._lock:
+            if self._closed:
+                raise ValueError('Sending mail with a closed MailDispatcher')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='MailDispatcher')
+                # So that we can still close() from an atexit handler,
+                # which Python only runs after non-daemon threads exit.
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((from_addr, to, msg, time.time(),
+                         threading.current_thread().name))
+
+    def flush(self):
+        """Wait until all the mail queued so far has been sent (or failed)."""
+        self._queue.join()
+
+    def close(self):
+        """Send everything queued, close the connection, and summarize.
+
+        Returns the list of failures, as (subject, to, exception).
+        """
+        with self._lock:
+            if self._closed:
+                return self.failures
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+            print ('Sent %s emails (%.2fs on average, %.2fs at most); '
+                   '%s failed' % (len(self.latencies),
+                                  (sum(self.latencies) /
+                                   max(len(self.latencies), 1)),
+                                  max(self.latencies or [0]),
+                                  len(self.failures)))
+        return self.failures
+
+    def _connection(self):
+        if (self._smtp is not None and self._messages_on_connection
+                >= self.max_messages_per_connection):
+            self._disconnect()
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self.host)
+            self._messages_on_connection = 0
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass        # we're done with it either way
+            self._smtp = None
+
+    def _deliver(self, from_addr, to, msg_string):
+        """Send a message, reconnecting once if the server hung up on us."""
+        for attempt in (1, 2):
+            try:
+                self._connection().sendmail(from_addr, to, msg_string)
+                self._messages_on_connection += 1
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self._smtp = None       # no point trying to QUIT it
+                if attempt == 2:
+                    raise
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._disconnect()
+                    return
+                (from_addr, to, msg, queued_at, sender) = item
+                start = time.time()
+                try:
+                    self._deliver(from_addr, to, msg.as_string())
+                except Exception as e:
+                    # We catch everything, since there's no one to
+                    # raise it to, and the other messages should still
+                    # go out.
+                    self.failures.append((msg['Subject'], to, e))
+                    self.failed_senders.add(sender)
+                    print 'Failed to email "%s" to %s: %s' % (
+                        msg['Subject'], to, e)
+                else:
+                    self.latencies.append(time.time() - start)
+                    if self.verbose:
+                        print ('Emailed "%s" to %s in %.2fs '
+                               '(%.2fs after it was queued)'
+                               % (msg['Subject'], to, self.latencies[-1],
+                                  time.time() - queued_at))
+            finally:
+                self._queue.task_done()
+
+
+_default_dispatcher = None
+_default_dispatcher_lock = threading.Lock()
+
+
+def default_dispatcher():
+    """Return a MailDispatcher for localhost, closed at exit."""
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = MailDispatcher()
+            atexit.register(_default_dispatcher.close)
+        return _default_dispatcher
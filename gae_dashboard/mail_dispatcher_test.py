@@ -0,0 +1,89 @@
+import email.mime.text
+import smtplib
+import unittest
+
+import mail_dispatcher
+
+
+class FakeSMTP(object):
+    """Records what's sent; can be told to hang up or refuse mail."""
+    connections = []
+
+    def __init__(self, host):
+        self.host = host
+        self.sent = []
+        self.hang_up_after = None
+        self.quit_called = False
+        FakeSMTP.connections.append(self)
+
+    def sendmail(self, from_addr, to, msg_string):
+        if 'refuse' in msg_string:
+            raise smtplib.SMTPRecipientsRefused({to: (550, 'no')})
+        if (self.hang_up_after is not None
+                and len(self.sent) >= self.hang_up_after):
+            raise smtplib.SMTPServerDisconnected('bye')
+        self.sent.append((from_addr, to))
+
+    def quit(self):
+        self.quit_called = True
+
+
+def _message(subject):
+    msg = email.mime.text.MIMEText('body')
+    msg['Subject'] = subject
+    return msg
+
+
+class TestMailDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        FakeSMTP.connections = []
+        self.mock(mail_dispatcher.smtplib, 'SMTP', FakeSMTP)
+
+    def mock(self, container, var_str, new_value):
+        oldval = getattr(container, var_str)
+        self.mock_origs[(container, var_str)] = oldval
+        self.addCleanup(lambda: setattr(container, var_str, oldval))
+        setattr(container, var_str, new_value)
+
+    def test_one_connection(self):
+        with mail_dispatcher.MailDispatcher(verbose=False) as dispatcher:
+            for i in xrange(5):
+                dispatcher.send('me', ['team%s' % i], _message('hi'))
+        self.assertEqual(1, len(FakeSMTP.connections))
+        self.assertEqual([('me', ['team%s' % i]) for i in xrange(5)],
+                         FakeSMTP.connections[0].sent)
+        self.assertTrue(FakeSMTP.connections[0].quit_called)
+        self.assertEqual(5, len(dispatcher.latencies))
+        with self.assertRaises(ValueError):
+            dispatcher.send('me', ['late'], _message('hi'))
+
+    def test_reconnect(self):
+        dispatcher = mail_dispatcher.MailDispatcher(
+            max_messages_per_connection=2, verbose=False)
+        for i in xrange(3):
+            dispatcher.send('me', ['team%s' % i], _message('hi'))
+        dispatcher.flush()
+        self.assertEqual([2, 1],
+                         [len(smtp.sent) for smtp in FakeSMTP.connections])
+
+        # If the server hangs up, we reconnect and resend.
+        FakeSMTP.connections[-1].hang_up_after = 1
+        dispatcher.send('me', ['again'], _message('hi'))
+        self.assertEqual([], dispatcher.close())
+        self.assertEqual(3, len(FakeSMTP.connections))
+        self.assertEqual([('me', ['again'])], FakeSMTP.connections[-1].sent)
+
+    def test_failures(self):
+        dispatcher = mail_dispatcher.MailDispatcher(verbose=False)
+        dispatcher.send('me', ['a'], _message('refuse'))
+        dispatcher.send('me', ['b'], _message('ok'))
+        failures = dispatcher.close()
+        self.assertEqual([('refuse', ['a'])],
+                         [(subject, to) for (subject, to, _) in failures])
+        self.assertEqual([('me', ['b'])], FakeSMTP.connections[0].sent)
+        self.assertEqual(set(['MainThread']), dispatcher.failed_senders)
+
+
+if __name__ == '__main__':
+    unittest.main()
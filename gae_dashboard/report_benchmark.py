@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Time our bigquery reports end to end, against a local database.
+
+This runs email_bq_data's reports, email_uptime, check_failing_routes,
+and dos_alert against synthetic logs in a local sqlite database (see
+bq_local), so we can see where the time goes without paying for -- or
+waiting on -- bigquery.  Each report runs twice: once cold, and once
+warm, when the query cache and saved daily data are populated.  Nothing
+is emailed or sent to slack: the reports are run as dry runs, with
+their output thrown away.  Run as
+    ./report_benchmark.py [--db FILE] [--date YYYYMMDD] [--requests N]
+If the database doesn't exist, it's created first, which takes a while.
+"""
+
+import argparse
+import contextlib
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import bq_local
+import bq_util
+
+
+# email_uptime needs a month of history before the day it reports on.
+_FIXTURE_DAYS = 38
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Throw away stdout, where the dry-run reports print their emails."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _reports(date):
+    """Return a list of (name, function) of the reports to time."""
+    # We import these lazily since they need alertlib and friends,
+    # which aren't needed just to create the fixtures.
+    import check_failing_routes
+    import dos_alert
+    import email_bq_data
+    import email_uptime
+
+    # A five-minute window for dos_alert, in the middle of the day.
+    dos_end = datetime.datetime.combine(date, datetime.time(12))
+    dos_start = dos_end - datetime.timedelta(seconds=dos_alert.PERIOD)
+
+    reports = [(name, lambda fn=fn: fn(date, dry_run=True))
+               for (name, fn) in (
+                   ('email_instance_hours',
+                    email_bq_data.email_instance_hours),
+                   ('email_rpcs', email_bq_data.email_rpcs),
+                   ('email_out_of_memory_errors',
+                    email_bq_data.email_out_of_memory_errors),
+                   ('email_client_api_usage',
+                    email_bq_data.email_client_api_usage),
+                   ('email_rrs_stats', email_bq_data.email_rrs_stats),
+                   ('email_applog_sizes', email_bq_data.email_applog_sizes),
+                   ('check_failing_routes', check_failing_routes.check),
+               )]
+    reports.append(('email_uptime',
+                    lambda: email_uptime.daily_uptime_email_body(date)))
+    reports.append(('dos_alert', lambda: (
+        dos_alert.dos_detect(dos_start, dos_end),
+        dos_alert.scratchpad_detect(dos_start, dos_end))))
+    return reports
+
+
+def _time_report(fn):
+    """Return (seconds, error-or-None) for running fn()."""
+    start = time.time()
+    try:
+        with _quiet():
+            fn()
+        error = None
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    return (time.time() - start, error)
+
+
+def benchmark_reports(date, warm=True):
+    """Print how long each report takes, cold and (maybe) warm."""
+    import alertlib
+    # Make sure nothing goes to slack.
+    alertlib.Alert.send_to_slack = lambda *args, **kwargs: None
+
+    print '%-28s %10s %10s  %s' % ('report', 'cold', 'warm', 'bytes billed')
+    for (name, fn) in _reports(date):
+        billed_before = bq_util.bytes_scanned()['billed']
+        (cold_secs, error) = _time_report(fn)
+        billed = bq_util.bytes_scanned()['billed'] - billed_before
+        if warm and not error:
+            (warm_secs, error) = _time_report(fn)
+            warm_time = '%9.2fs' % warm_secs
+        else:
+            warm_time = '%10s' % '-'
+        print '%-28s %9.2fs %s  %s' % (name, cold_secs, warm_time, billed)
+        if error:
+            print '    FAILED: %s' % error
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(),
+                                                     'bq_local.sqlite'),
+                        help='The sqlite database of logs; created if it '
+                             'does not exist (default %(default)s)')
+    parser.add_argument('--date', metavar='YYYYMMDD', default='20190115',
+                        help='The day to run the reports for '
+                             '(default "%(default)s")')
+    parser.add_argument('--requests', type=int, default=100000,
+                        help='Requests per day, when creating the database '
+                             '(default %(default)s)')
+    parser.add_argument('--cold-only', action='store_true',
+                        help="Don't rerun the reports with warm caches.")
+    args = parser.parse_args()
+    date = datetime.datetime.strptime(args.date, '%Y%m%d')
+
+    if not os.path.exists(args.db):
+        dates = [date.date() - datetime.timedelta(i)
+                 for i in xrange(_FIXTURE_DAYS - 1, -1, -1)]
+        bq_local.create_fixtures(args.db, dates,
+                                 requests_per_day=args.requests,
+                                 fastly_rows_per_day=args.requests,
+                                 verbose=True)
+
+    # Start each benchmark with empty caches and no saved data.
+    tmpdir = tempfile.mkdtemp()
+    bq_util.use_local_backend(args.db, data_directory=tmpdir)
+    try:
+        benchmark_reports(date, warm=not args.cold_only)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
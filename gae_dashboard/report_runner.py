@@ -0,0 +1,276 @@
+"""Run a registry of daily reports concurrently, in dependency order.
+
+Each Report declares what it reads and writes: the bigquery queries it
+runs (so they can all be prefetched at once), the daily tables those
+queries read, the saved daily data (see bq_util.save_daily_data) it
+reads for the day and for its history, and the daily data it saves.
+From that, run_reports() works out which reports have to wait for
+which -- a report that reads data another one saves runs after it --
+and runs the rest concurrently, a few at a time.  A report that fails
+doesn't stop the others, though reports that depend on it are skipped.
+
+We also remember a fingerprint of each report's inputs when it
+succeeds -- and, if the caller passes a deliver function, once what it
+sent has been delivered: the last-modified time and size of its tables,
+and which of its daily data and days of history we had.  With
+changed_only, a
+report whose inputs are the same as on its last successful run for
+that day isn't run again, so re-running after a partial failure only
+re-sends what failed (or what a backfill has since filled in).
+"""
+
+import datetime
+import hashlib
+import Queue
+import threading
+import time
+import traceback
+
+import bq_util
+
+
+# The daily data we save the input fingerprints under.
+_RUNS_REPORT = 'report_runs'
+
+
+class Report(object):
+    """A report, or another step that reports depend on."""
+    __slots__ = ('name', 'fn', 'queries', 'tables', 'reads', 'history',
+                 'outputs')
+
+    def __init__(self, name, fn, queries=None, tables=(), reads=(),
+                 history=(), outputs=()):
+        """Declare a report.
+
+        Arguments:
+           name: what to call the report, e.g. on the command line.
+           fn: called as fn(date, dry_run=...) to run the report.
+           queries: a function from YYYYMMDD to a dict of the queries
+               the report runs, stats-name -> sql, which we can run
+               ahead of time to warm the query cache.
+           tables: the bigquery tables the report reads, as
+               'dataset.table' with %(yyyymmdd)s for the date.
+           reads: the saved daily data the report reads for the day.
+           history: (report, days) for the saved daily data the report
+               reads for the days before, e.g. for sparklines.
+           outputs: the daily data the report saves.
+        """
+        self.name = name
+        self.fn = fn
+        self.queries = queries
+        self.tables = tuple(tables)
+        self.reads = tuple(reads)
+        self.history = tuple(history)
+        self.outputs = tuple(outputs)
+
+
+class ReportResult(object):
+    __slots__ = ('name', 'status', 'seconds', 'error')
+
+    def __init__(self, name, status, seconds=0.0, error=None):
+        # status is 'ok', 'failed', 'skipped' (a dependency failed) or
+        # 'unchanged' (skipped since its inputs haven't changed).
+        self.name = name
+        self.status = status
+        self.seconds = seconds
+        self.error = error
+
+
+def dependencies(reports):
+    """Return a dict from report name to the names of reports it waits for.
+
+    A report waits for the reports, among these, that save daily data
+    it reads.  Raises ValueError if that makes a cycle.
+    """
+    producers = {}
+    for report in reports:
+        for output in report.outputs:
+            producers.setdefault(output, set()).add(report.name)
+    deps = {report.name: set(name for read in report.reads
+                             for name in producers.get(read, ())
+                             if name != report.name)
+            for report in reports}
+
+    # Check for cycles, by repeatedly taking the reports with no
+    # remaining dependencies.
+    remaining = {name: set(names) for (name, names) in deps.iteritems()}
+    while remaining:
+        ready = [name for (name, names) in remaining.iteritems() if not names]
+        if not ready:
+            raise ValueError('Reports depend on each other: %s'
+                             % ', '.join(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for names in remaining.itervalues():
+            names.difference_update(ready)
+    return deps
+
+
+def with_dependencies(reports, names):
+    """Return the reports with the given names, and those they wait for."""
+    deps = dependencies(reports)
+    wanted = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(deps[name])
+    return [report for report in reports if report.name in wanted]
+
+
+def prefetch_queries(reports, yyyymmdd):
+    """Run all the reports' queries at once, to warm the query cache.
+
+    This way the queries take about as long as the slowest one, rather
+    than (a few at a time) the sum of them.  The reports themselves then
+    get their results from the cache.
+    """
+    queries = {}
+    for report in reports:
+        if report.queries:
+            queries.update(report.queries(yyyymmdd))
+    if not queries:
+        return
+    start = time.time()
+    for (name, result) in bq_util.query_bigquery_many(
+            queries, cache_ttl=bq_util.QUERY_CACHE_TTL):
+        if isinstance(result, bq_util.BQException):
+            # The report will retry, and report the failure, itself.
+            print 'Prefetching %s failed: %s' % (name, result)
+        else:
+            print 'Prefetched %s (%s rows)' % (name, len(result))
+    print 'Prefetched all queries in %.1f seconds' % (time.time() - start)
+
+
+def input_fingerprint(report, date):
+    """Return a hash of the state of the report's inputs for date."""
+    yyyymmdd = date.strftime("%Y%m%d")
+    parts = []
+    for table in report.tables:
+        table_name = table % {'yyyymmdd': yyyymmdd}
+        metadata = bq_util.get_table_metadata(table_name)
+        parts.append((table_name, metadata and (metadata['last_modified'],
+                                                metadata['row_count'],
+                                                metadata['size_bytes'])))
+    # If a report's data was deleted, say, we want to run it again.
+    for name in report.reads + report.outputs:
+        parts.append((name, bq_util.has_daily_data(name, yyyymmdd)))
+    for (history_report, days) in report.history:
+        for i in xrange(days, 0, -1):
+            day = (date - datetime.timedelta(i)).strftime("%Y%m%d")
+            parts.append((history_report, day,
+                          bq_util.has_daily_data(history_report, day)))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def _load_fingerprints(yyyymmdd):
+    rows = bq_util.get_daily_data(_RUNS_REPORT, yyyymmdd) or []
+    return {row['report']: row['fingerprint'] for row in rows}
+
+
+def _save_fingerprints(fingerprints, yyyymmdd):
+    bq_util.save_daily_data(
+        [{'report': name, 'fingerprint': fingerprint}
+         for (name, fingerprint) in sorted(fingerprints.iteritems())],
+        _RUNS_REPORT, yyyymmdd)
+
+
+def _run_one(report, date, dry_run, results):
+    start = time.time()
+    try:
+        report.fn(date, dry_run=dry_run)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    results.put((report.name, time.time() - start, error))
+
+
+def run_reports(reports, date, dry_run=False, max_workers=4,
+                changed_only=False, deliver=None):
+    """Run the reports for date, concurrently where they're independent.
+
+    At most max_workers reports run at once.  A report that raises is
+    recorded as failed, and the reports that wait for it are skipped.
+    With changed_only, reports whose inputs haven't changed since they
+    last succeeded for date are skipped (see input_fingerprint).  Input
+    fingerprints aren't recorded for dry runs.
+
+    Reports often just queue their emails, so if deliver is given we
+    call it once they've all run.  It should wait for what they queued
+    to go out, and return the names of the reports some of whose output
+    couldn't be delivered.  (Each report runs in a thread named after
+    it.)  Those are recorded as failed too, and don't get fingerprints.
+
+    Returns a list of ReportResults, in the order the reports finished.
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    by_name = {report.name: report for report in reports}
+    waiting_for = dependencies(reports)
+    fingerprints = _load_fingerprints(yyyymmdd)
+    new_fingerprints = {}
+    results = Queue.Queue()
+    retval = []
+    running = set()
+
+    def finish(result):
+        retval.append(result)
+        del waiting_for[result.name]
+        if result.status in ('failed', 'skipped'):
+            for (name, deps) in waiting_for.items():
+                if result.name in deps and name in waiting_for:
+                    finish(ReportResult(
+                        name, 'skipped',
+                        error='%s did not succeed' % result.name))
+        else:
+            for deps in waiting_for.itervalues():
+                deps.discard(result.name)
+
+    while waiting_for:
+        ready = [name for (name, deps) in waiting_for.iteritems()
+                 if not deps and name not in running]
+        for name in sorted(ready):
+            if len(running) >= max_workers:
+                break
+            if changed_only:
+                fingerprint = input_fingerprint(by_name[name], date)
+                if fingerprints.get(name) == fingerprint:
+                    print 'Skipping %s: its inputs have not changed' % name
+                    finish(ReportResult(name, 'unchanged'))
+                    continue
+            print 'Running %s' % name
+            running.add(name)
+            threading.Thread(target=_run_one, name=name,
+                             args=(by_name[name], date, dry_run,
+                                   results)).start()
+        if not running:
+            continue        # we finished some as unchanged; look again
+
+        (name, seconds, error) = results.get()
+        running.remove(name)
+        if error:
+            print 'Report %s FAILED after %.1f seconds:\n%s' % (
+                name, seconds, error)
+            finish(ReportResult(name, 'failed', seconds, error))
+        else:
+            print 'Report %s done in %.1f seconds' % (name, seconds)
+            # We fingerprint the inputs after the run, since running
+            # the report may have filled them in.
+            new_fingerprints[name] = input_fingerprint(by_name[name], date)
+            finish(ReportResult(name, 'ok', seconds))
+
+    if deliver is not None:
+        undelivered = deliver()
+        for (i, result) in enumerate(retval):
+            if result.name in undelivered and result.status == 'ok':
+                print 'Report %s FAILED: its output was not delivered' % (
+                    result.name)
+                retval[i] = ReportResult(
+                    result.name, 'failed', result.seconds,
+                    error='its output was not delivered')
+                new_fingerprints.pop(result.name, None)
+
+    if new_fingerprints and not dry_run:
+        fingerprints.update(new_fingerprints)
+        _save_fingerprints(fingerprints, yyyymmdd)
+    return retval
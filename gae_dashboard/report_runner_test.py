@@ -0,0 +1,126 @@
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
+
+import bq_util
+import report_runner
+
+
+class RunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_origs = {}
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        self.mock(bq_util, '_DATA_DIRECTORY', data_dir)
+        self.mock(bq_util, 'get_table_metadata', lambda table: (
+            self.tables.get(table)))
+        self.tables = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.date = datetime.date(2019, 1, 15)
+
+    def mock(self, container, var_str, new_value):
+        oldval = getattr(container, var_str)
+        self.mock_origs[(container, var_str)] = oldval
+        self.addCleanup(lambda: setattr(container, var_str, oldval))
+        setattr(container, var_str, new_value)
+
+    def report(self, name, fail=False, **kwargs):
+        def fn(date, dry_run=False):
+            with self.lock:
+                self.calls.append(name)
+            if fail:
+                raise RuntimeError('%s is broken' % name)
+            for output in kwargs.get('outputs', ()):
+                bq_util.save_daily_data([{'x': 1}], output,
+                                        date.strftime("%Y%m%d"))
+        return report_runner.Report(name, fn, **kwargs)
+
+    def statuses(self, results):
+        return {result.name: result.status for result in results}
+
+
+class TestRunReports(RunnerTestCase):
+    def test_dependency_order(self):
+        reports = [self.report('a', reads=['facts']),
+                   self.report('facts', outputs=['facts']),
+                   self.report('b', reads=['facts'], outputs=['b']),
+                   self.report('c')]
+        self.assertEqual({'a': set(['facts']), 'b': set(['facts']),
+                          'facts': set(), 'c': set()},
+                         report_runner.dependencies(reports))
+        results = report_runner.run_reports(reports, self.date,
+                                            max_workers=2)
+        self.assertEqual({'a': 'ok', 'b': 'ok', 'c': 'ok', 'facts': 'ok'},
+                         self.statuses(results))
+        self.assertLess(self.calls.index('facts'), self.calls.index('a'))
+        self.assertLess(self.calls.index('facts'), self.calls.index('b'))
+        self.assertEqual(['facts', 'b'], [
+            r.name for r in report_runner.with_dependencies(reports, ['b'])])
+
+    def test_failures(self):
+        reports = [self.report('facts', fail=True, outputs=['facts']),
+                   self.report('a', reads=['facts']),
+                   self.report('c', fail=True),
+                   self.report('d')]
+        results = report_runner.run_reports(reports, self.date)
+        self.assertEqual({'facts': 'failed', 'a': 'skipped', 'c': 'failed',
+                          'd': 'ok'}, self.statuses(results))
+        self.assertNotIn('a', self.calls)
+        self.assertIn('RuntimeError: c is broken',
+                      [r.error for r in results if r.name == 'c'][0])
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            report_runner.dependencies(
+                [self.report('a', reads=['b'], outputs=['a']),
+                 self.report('b', reads=['a'], outputs=['b'])])
+
+    def test_changed_only(self):
+        self.tables['logs.requestlogs_20190115'] = {
+            'last_modified': 1, 'row_count': 10, 'size_bytes': 100}
+        reports = [self.report('a', tables=['logs.requestlogs_%(yyyymmdd)s'],
+                               outputs=['a']),
+                   self.report('b', history=[('b', 3)], outputs=['b'])]
+        report_runner.run_reports(reports, self.date, changed_only=True)
+        self.assertEqual(['a', 'b'], sorted(self.calls))
+
+        self.calls = []
+        results = report_runner.run_reports(reports, self.date,
+                                            changed_only=True)
+        self.assertEqual([], self.calls)
+        self.assertEqual({'a': 'unchanged', 'b': 'unchanged'},
+                         self.statuses(results))
+
+        # The table got more rows, and b's history got filled in.
+        self.tables['logs.requestlogs_20190115']['row_count'] = 20
+        bq_util.save_daily_data([], 'b', '20190113')
+        report_runner.run_reports(reports, self.date, changed_only=True)
+        self.assertEqual(['a', 'b'], sorted(self.calls))
+
+    def test_undelivered_output(self):
+        senders = []
+
+        def fn(date, dry_run=False):
+            senders.append(threading.current_thread().name)
+        reports = [report_runner.Report('a', fn),
+                   report_runner.Report('b', fn)]
+        results = report_runner.run_reports(
+            reports, self.date, changed_only=True,
+            deliver=lambda: set(['a']))
+        self.assertEqual(['a', 'b'], sorted(senders))
+        self.assertEqual({'a': 'failed', 'b': 'ok'}, self.statuses(results))
+
+        # We only send a's again.
+        del senders[:]
+        results = report_runner.run_reports(reports, self.date,
+                                            changed_only=True)
+        self.assertEqual(['a'], senders)
+        self.assertEqual({'a': 'ok', 'b': 'unchanged'},
+                         self.statuses(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
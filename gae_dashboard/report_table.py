@@ -0,0 +1,157 @@
+"""A small columnar table, for the reports that email_bq_data sends.
+
+The reports get their data as lists of dicts, one per row, but what
+they do with it is mostly column-at-a-time: add a percent-of-total or
+per-request column, take the top rows, slice out each initiative's
+rows, and render the columns in a given order.  A Table keeps each
+column as a sequence -- an array, for columns of ints or floats -- and
+does that math a column at a time, rather than key by key in each row.
+
+Columns are never modified in place -- set_column() replaces a column
+wholesale -- so select() can share the columns' storage with the
+original table; take() and top() copy just the rows they keep.
+"""
+
+import array
+import heapq
+import itertools
+
+
+def _column_storage(values):
+    """Store a column of ints or of floats in an array, else in a list.
+
+    We only use an array when every value has the same type, so that
+    values come back out as they went in (a float column stays floats,
+    which email_bq_data formats differently from ints).
+    """
+    values = list(values)
+    if values and all(type(v) is int for v in values):
+        try:
+            return array.array('l', values)
+        except OverflowError:
+            return values
+    if values and all(type(v) is float for v in values):
+        return array.array('d', values)
+    return values
+
+
+class Table(object):
+    """A table with named columns, in order, of equal length."""
+    __slots__ = ('names', '_columns', '_length')
+
+    def __init__(self, names, columns):
+        """names is a list of column names, and columns their values."""
+        self.names = list(names)
+        self._columns = {}
+        self._length = None
+        for (name, values) in zip(self.names, columns):
+            self._set(name, values)
+        if self._length is None:
+            self._length = 0
+
+    @classmethod
+    def from_rows(cls, rows, names):
+        """Make a table from a list of dicts, keeping the given columns."""
+        return cls(names, [[row[name] for row in rows] for name in names])
+
+    def _set(self, name, values):
+        if not isinstance(values, array.array):
+            values = _column_storage(values)
+        if self._length is not None and len(values) != self._length:
+            raise ValueError('Column %s has %s values, not %s'
+                             % (name, len(values), self._length))
+        self._length = len(values)
+        self._columns[name] = values
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, name):
+        """Return a column's values, which should not be modified."""
+        return self._columns[name]
+
+    def rows(self):
+        """Iterate over the rows, as tuples in the order of self.names."""
+        return itertools.izip(*[self._columns[name] for name in self.names])
+
+    def set_column(self, name, values):
+        """Add a column at the end, or replace the one with this name."""
+        if name not in self._columns:
+            self.names.append(name)
+        self._set(name, values)
+
+    def derive(self, name, fn, *source_names):
+        """Set a column to fn(values...) of the source columns, per row."""
+        sources = [self._columns[source] for source in source_names]
+        if len(sources) == 1:
+            values = [fn(v) for v in sources[0]]
+        else:
+            values = [fn(*vs) for vs in itertools.izip(*sources)]
+        self.set_column(name, values)
+
+    def percent_of_total(self, name, source_name):
+        """Set a column to what percent each row is of source's total."""
+        total = float(sum(self._columns[source_name]))
+        scale = 100.0 / total if total else 0.0
+        self.set_column(name, array.array(
+            'd', (v * scale for v in self._columns[source_name])))
+
+    def ratio(self, name, numerator_name, denominator_name, scale=1):
+        """Set a column to numerator * scale / denominator, as a float.
+
+        For example, use a scale of 1000 for "per 1k requests".
+        """
+        self.set_column(name, array.array('d', (
+            n * float(scale) / d
+            for (n, d) in itertools.izip(self._columns[numerator_name],
+                                         self._columns[denominator_name]))))
+
+    def select(self, names):
+        """Return a table with just the given columns, in the given order."""
+        return Table(names, [self._columns[name] for name in names])
+
+    def take(self, indices):
+        """Return a table with just the rows with the given indices."""
+        retval = Table([], [])
+        retval._length = len(indices)
+        for name in self.names:
+            column = self._columns[name]
+            values = [column[i] for i in indices]
+            if isinstance(column, array.array):
+                values = array.array(column.typecode, values)
+            retval.names.append(name)
+            retval._columns[name] = values
+        return retval
+
+    def top(self, n, by=None):
+        """Return the first n rows, or the n with the largest values of by.
+
+        When by is given, the rows are returned largest first; ties keep
+        the order they had.
+        """
+        if by is None:
+            return self.take(range(min(n, self._length)))
+        column = self._columns[by]
+        return self.take(heapq.nlargest(n, xrange(self._length),
+                                        key=column.__getitem__))
+
+    def to_html(self, render_row, attributes=''):
+        """Return the table as an HTML <table>, and the images it uses.
+
+        render_row(row) is given each row, as a tuple, and should return
+        the row's <tr> element and a list of the images it refers to.
+        (The images are whatever the caller wants to collect up; see
+        email_bq_data._render_row.)  Column names are used as-is in the
+        header row, so they should already be escaped as needed.
+        """
+        html = ['<table %s>' % attributes if attributes else '<table>',
+                '<thead>', '<tr>']
+        html.extend('<th>%s</th>' % name for name in self.names)
+        html.extend(['</tr>', '</thead>', '<tbody>'])
+        images = []
+        for row in self.rows():
+            (row_html, row_images) = render_row(row)
+            html.append(row_html)
+            images.extend(row_images)
+        html.extend(['</tbody>', '</table>'])
+        return ('\n'.join(html), images)
@@ -0,0 +1,60 @@
+import array
+import unittest
+
+import report_table
+
+
+class TestTable(unittest.TestCase):
+    def setUp(self):
+        self.table = report_table.Table.from_rows(
+            [{'route': '/a', 'hours': 3.0, 'count': 300},
+             {'route': '/b', 'hours': 1.0, 'count': 10},
+             {'route': '/c', 'hours': 4.0, 'count': 8000}],
+            ['route', 'hours', 'count'])
+
+    def test_storage(self):
+        self.assertEqual(3, len(self.table))
+        self.assertIsInstance(self.table['hours'], array.array)
+        self.assertIsInstance(self.table['count'], array.array)
+        self.assertEqual([('/a', 3.0, 300), ('/b', 1.0, 10),
+                          ('/c', 4.0, 8000)], list(self.table.rows()))
+        # Mixed types stay as they were.
+        table = report_table.Table(['x'], [[1, 2.5, '(None)']])
+        self.assertEqual([1, 2.5, '(None)'], table['x'])
+        with self.assertRaises(ValueError):
+            table.set_column('y', [1, 2])
+
+    def test_derived_columns(self):
+        self.table.percent_of_total('%', 'hours')
+        self.table.ratio('per 1k', 'hours', 'count', scale=1000)
+        self.table.derive('label', lambda route, count: '%s:%s' % (
+            route, count), 'route', 'count')
+        self.assertEqual(['route', 'hours', 'count', '%', 'per 1k', 'label'],
+                         self.table.names)
+        self.assertEqual([37.5, 12.5, 50.0], list(self.table['%']))
+        self.assertEqual([10.0, 100.0, 0.5], list(self.table['per 1k']))
+        self.assertEqual(['/a:300', '/b:10', '/c:8000'], self.table['label'])
+
+    def test_slicing(self):
+        self.assertEqual([('/a', 3.0), ('/b', 1.0)],
+                         list(self.table.select(['route', 'hours'])
+                              .top(2).rows()))
+        self.assertEqual(['/c', '/a'], self.table.top(2, by='hours')['route'])
+        self.assertEqual(['/c', '/a', '/b'],
+                         self.table.top(10, by='hours')['route'])
+        taken = self.table.take([2, 0])
+        self.assertEqual(array.array('l', [8000, 300]), taken['count'])
+        # The original is unchanged.
+        self.assertEqual(['/a', '/b', '/c'], self.table['route'])
+
+    def test_to_html(self):
+        (html, images) = self.table.select(['route', 'count']).top(1).to_html(
+            lambda row: ('<tr>%s</tr>' % '|'.join(map(str, row)), [row[0]]))
+        self.assertEqual('<table>\n<thead>\n<tr>\n<th>route</th>\n'
+                         '<th>count</th>\n</tr>\n</thead>\n<tbody>\n'
+                         '<tr>/a|300</tr>\n</tbody>\n</table>', html)
+        self.assertEqual(['/a'], images)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+"""A daily per-route summary of the request logs, shared by our reports.
+
+Several reports -- email_bq_data's instance-hours, RPC and out-of-memory
+reports, and check_failing_routes -- each used to scan the whole day's
+logs.requestlogs_YYYYMMDD table for a handful of numbers per route.
+Instead, we scan it once to make a small "fact table", with a row per
+(url_route, module_id, is_znd) and a column for every number those
+reports need, and the reports compute their tables from that locally.
+The fact table is saved with bq_util.save_daily_data, so the first
+report to run each day (or email_bq_data's prefetch) pays for the scan,
+and the rest just read it from disk.
+
+The columns of the fact table are:
+    url_route, module_id, is_znd
+        What the row summarizes.  is_znd is also true for requests with
+        no version, which the reports have always skipped along with
+        the znds.
+    requests
+        The number of requests.
+    dynamic_requests, dynamic_latency
+        The number of requests, and their total latency in seconds, that
+        weren't for static files.  (Latency is per request, not per log
+        entry: see _REQUEST_FACTS.)
+    log_rows, ok_rows, bot_rows
+        The number of log entries, and how many of those had an ok
+        status, or came from bots.  See check_failing_routes.
+    num_ips, min_ip, max_ip
+        The number of distinct IPs (approximate, as bigquery counts
+        them) and the smallest and largest, so we can tell for sure
+        whether there was more than one over several rows.
+    rpc_<name> for each name in RPC_STATS
+        The sum of the stats.rpc_ops.* values for the requests.
+    oom_messages, oom_requests, oom_numserved
+        How many out-of-memory messages were logged, by how many
+        requests, and a comma-separated list of how many requests the
+        instance had served when it ran out (for python instances).
+
+Reports that group the data some other way -- email_applog_sizes by the
+first word of log messages, and email_uptime by ten-second buckets --
+still run their own queries.
+"""
+
+import collections
+import datetime
+
+import bq_util
+
+
+# The name the fact table is saved under, with bq_util.save_daily_data.
+FACTS_REPORT = 'requestlogs_facts'
+
+# The rpc stats we sum up, as fact-table column -> stats.rpc_ops key.
+# They're pivoted into columns with one conditional sum each, in the same
+# pass over the logs as everything else (see _rpc_pivot), so adding one
+# here adds a column to the fact table, not another scan.
+RPC_STATS = collections.OrderedDict(
+    [('rpc_%s' % op, 'stats.rpc_ops.%s.count' % op)
+     for op in ('Get', 'Put', 'Next', 'RunQuery', 'Delete', 'Commit')] +
+    [('rpc_cost', 'stats.rpc_ops.cost')])
+
+# Out-of-memory errors for python look like:
+#   Exceeded soft memory limit of 2048 MB with 2078 MB after servicing 1497 requests total. Consider setting a larger instance class in app.yaml.  #@Nolint
+# Out-of-memory errors for kotlin look like:
+#   java.lang.OutOfMemoryError: <reason>
+#   (where <reason> is some text that may take on a number of values
+#   depending on whether the problem is lack of heap space, the garbage
+#   collector taking too long to stay ahead of garbage accumulation, etc.)
+# Note that older messages (before the gVisor sandboxs) started with
+# "Exceeded soft private memory limit" instead.
+_IS_OOM = ("(app_logs.message CONTAINS 'Exceeded soft memory limit' "
+           "OR app_logs.message CONTAINS 'OutOfMemoryError')")
+
+# Statuses that check_failing_routes counts as ok; 401s, 404s and 405s are
+# due to client error rather than broken routes.
+_IS_OK = ('((status >= 200 AND status < 400) '
+          'OR status IN (401, 404, 405, 501))')
+
+# The innermost query works on log entries.  It uses WITHIN RECORD to
+# aggregate over each entry's repeated fields, since legacy sql won't
+# flatten two independently repeated fields in the same query.
+_LOG_ENTRY_FACTS = """\
+SELECT request_id, elog_url_route, module_id, version_id, url_map_entry,
+       latency, ip,
+       %(is_ok)s AS is_ok,
+       elog_device_type IS NULL OR elog_device_type = 'bot/dev' AS is_bot,
+%(rpc_stats)s,
+       SUM(IF(%(is_oom)s, 1, 0)) WITHIN RECORD AS oom_messages,
+       GROUP_CONCAT(IF(%(is_oom)s,
+                       REGEXP_EXTRACT(app_logs.message,
+                                      r'servicing (\\d+) requests'),
+                       NULL)) WITHIN RECORD AS oom_numserved
+FROM [logs.requestlogs_%(yyyymmdd)s]
+"""
+
+# When logs get split into multiple entries, each has latency calculated
+# from the start of the request to the point where the log line was
+# emitted.  This means the total latency is the maximum value that
+# appears, not the sum.
+_REQUEST_FACTS = """\
+SELECT FIRST(elog_url_route) AS url_route,
+       IFNULL(FIRST(module_id), 'default') AS module_id,
+       IFNULL(LEFT(FIRST(version_id), 3) = 'znd', true) AS is_znd,
+       IFNULL(FIRST(url_map_entry), '') != '' AS is_dynamic,
+       MAX(latency) AS latency,
+       COUNT(1) AS log_rows,
+       SUM(is_ok) AS ok_rows,
+       SUM(is_bot) AS bot_rows,
+       MIN(ip) AS min_ip,
+       MAX(ip) AS max_ip,
+%(rpc_stats)s,
+       SUM(oom_messages) AS oom_messages,
+       GROUP_CONCAT(oom_numserved) AS oom_numserved
+FROM (%(log_entry_facts)s)
+GROUP BY request_id
+"""
+
+_FACTS = """\
+SELECT url_route, module_id, is_znd,
+       COUNT(1) AS requests,
+       SUM(is_dynamic) AS dynamic_requests,
+       SUM(IF(is_dynamic, latency, 0)) AS dynamic_latency,
+       SUM(log_rows) AS log_rows,
+       SUM(ok_rows) AS ok_rows,
+       SUM(bot_rows) AS bot_rows,
+       COUNT(DISTINCT min_ip) AS num_ips,
+       MIN(min_ip) AS min_ip,
+       MAX(max_ip) AS max_ip,
+%(rpc_stats)s,
+       SUM(oom_messages) AS oom_messages,
+       SUM(oom_messages > 0) AS oom_requests,
+       GROUP_CONCAT(oom_numserved) AS oom_numserved
+FROM (%(request_facts)s)
+GROUP BY url_route, module_id, is_znd
+"""
+
+
+def _rpc_pivot():
+    """Return select-list items pivoting a log entry's rpc stats.
+
+    elog_stats_rpc_ops is a repeated key/value record; we sum each of
+    the keys in RPC_STATS into its own column.
+    """
+    return ',\n'.join(
+        "       SUM(IF(elog_stats_rpc_ops.key = '%s', "
+        "elog_stats_rpc_ops.value, 0)) WITHIN RECORD AS %s"
+        % (key, column) for (column, key) in RPC_STATS.iteritems())
+
+
+def facts_query(yyyymmdd):
+    """Return the query that computes the fact table for a day."""
+    log_entry_facts = _LOG_ENTRY_FACTS % {
+        'is_ok': _IS_OK,
+        'is_oom': _IS_OOM,
+        'rpc_stats': _rpc_pivot(),
+        'yyyymmdd': yyyymmdd,
+    }
+    request_facts = _REQUEST_FACTS % {
+        'rpc_stats': ',\n'.join('       SUM(%s) AS %s' % (column, column)
+                                for column in RPC_STATS),
+        'log_entry_facts': log_entry_facts,
+    }
+    return _FACTS % {
+        'rpc_stats': ',\n'.join('       SUM(%s) AS %s' % (column, column)
+                                for column in RPC_STATS),
+        'request_facts': request_facts,
+    }
+
+
+def get_facts(yyyymmdd):
+    """Return the fact table for a day, as a list of dicts.
+
+    We run the query the first time we're asked for a day, and save the
+    result with bq_util.save_daily_data for next time.
+    """
+    facts = bq_util.get_daily_data(FACTS_REPORT, yyyymmdd)
+    if facts is None:
+        facts = bq_util.query_bigquery(facts_query(yyyymmdd),
+                                       cache_ttl=bq_util.QUERY_CACHE_TTL,
+                                       stats_name=FACTS_REPORT)
+        bq_util.save_daily_data(facts, FACTS_REPORT, yyyymmdd)
+    return facts
+
+
+def _sum_by(facts, key_columns, value_columns, where=None):
+    """Sum some columns of the fact table, grouped by others.
+
+    Returns a list of dicts with the key and value columns, one for
+    each distinct key among the rows for which where(row) is true.
+    """
+    sums = collections.OrderedDict()
+    for row in facts:
+        if where is not None and not where(row):
+            continue
+        key = tuple(row[c] for c in key_columns)
+        if key not in sums:
+            sums[key] = dict(zip(key_columns, key))
+            sums[key].update((c, 0) for c in value_columns)
+        total = sums[key]
+        for c in value_columns:
+            total[c] += row[c] or 0
+    return sums.values()
+
+
+def _not_znd(row):
+    return not row['is_znd']
+
+
+def instance_hours(facts, module_cpu_count):
+    """Return instance hours by route, most first.
+
+    module_cpu_count maps a module to what a second of request latency
+    costs in cpu-seconds; other modules count as free.  Each row has
+    url_route, count_ (of dynamic requests) and instance_hours.
+    """
+    def cost(row):
+        return row['dynamic_latency'] * module_cpu_count.get(
+            row['module_id'], 0)
+
+    retval = _sum_by(
+        [dict(row, instance_hours=cost(row) / 3600) for row in facts],
+        ['url_route'], ['dynamic_requests', 'instance_hours'],
+        where=lambda row: _not_znd(row) and row['dynamic_requests'])
+    for row in retval:
+        row['count_'] = row.pop('dynamic_requests')
+    retval.sort(key=lambda row: row['instance_hours'], reverse=True)
+    return retval
+
+
+def rpcs(facts):
+    """Return RPC counts and costs by route, most expensive first.
+
+    Each row has url_route, requests, and a column for each of RPC_STATS.
+    As the RPCs are what cost us money, we count them for znds too, but
+    only count the requests to non-znd versions.
+    """
+    requests = _sum_by(facts, ['url_route'], ['requests'], where=_not_znd)
+    by_route = {row['url_route']: row for row in _sum_by(
+        facts, ['url_route'], list(RPC_STATS))}
+    for row in requests:
+        row.update(by_route[row['url_route']])
+        for column in RPC_STATS:
+            if column != 'rpc_cost':
+                row[column] = int(row[column])
+    requests.sort(key=lambda row: row['rpc_cost'], reverse=True)
+    return requests
+
+
+def _quantile(values, n, k=101):
+    """Like bigquery's NTH(n, QUANTILES(values, k)), but exact.
+
+    Given no values, we return '(None)', like query_bigquery does for
+    NULLs.
+    """
+    if not values:
+        return '(None)'
+    values = sorted(values)
+    return values[int(round((n - 1) * (len(values) - 1) / (k - 1.0)))]
+
+
+def oom_by_module(facts):
+    """Return out-of-memory errors by module, most first.
+
+    Each row has module_id, count_ (of OOM messages) and numserved_10th,
+    _50th and _90th, quantiles of how many requests the instances had
+    served when they ran out of memory.
+    """
+    retval = _sum_by(facts, ['module_id'], ['oom_messages'],
+                     where=lambda row: _not_znd(row) and row['oom_messages'])
+    # oom_numserved is '(None)' -- see bq_util.query_bigquery -- when
+    # none of the messages said how many requests were served.
+    numserved = collections.defaultdict(list)
+    for row in facts:
+        if _not_znd(row):
+            numserved[row['module_id']].extend(
+                int(n) for n in row['oom_numserved'].split(',')
+                if n.isdigit())
+    for row in retval:
+        row['count_'] = row.pop('oom_messages')
+        for n in (10, 50, 90):
+            row['numserved_%sth' % n] = _quantile(
+                numserved[row['module_id']], n)
+    retval.sort(key=lambda row: row['count_'], reverse=True)
+    return retval
+
+
+def oom_by_route(facts):
+    """Return requests with out-of-memory errors by module and route.
+
+    Each row has module_id, url_route and count_ (of requests).
+    """
+    retval = _sum_by(facts, ['module_id', 'url_route'], ['oom_requests'],
+                     where=lambda row: _not_znd(row) and row['oom_requests'])
+    for row in retval:
+        row['count_'] = row.pop('oom_requests')
+    retval.sort(key=lambda row: row['count_'], reverse=True)
+    return retval
+
+
+def failing_routes(facts):
+    """Return routes that never returned an ok status, as check_failing_routes.
+
+    We skip routes where the only errors were for bots, or from a single
+    IP.  Each row has route, ok_reqs, bot_reqs, num_ips and total_reqs.
+    The same IP may appear in several of a route's rows (one per module
+    and per znd-or-not), so num_ips is a lower bound: the most any one
+    row saw, or 2 if the rows together saw two different IPs.
+    """
+    ip_range = {}
+    num_ips = collections.defaultdict(int)
+    for row in facts:
+        route = row['url_route']
+        num_ips[route] = max(num_ips[route], row['num_ips'])
+        # Like COUNT(DISTINCT ip), ignore rows where no IP was logged.
+        if row['min_ip'] == '(None)':
+            continue
+        (lo, hi) = ip_range.get(route, (row['min_ip'], row['max_ip']))
+        ip_range[route] = (min(lo, row['min_ip']), max(hi, row['max_ip']))
+    retval = []
+    for row in _sum_by(facts, ['url_route'],
+                       ['log_rows', 'ok_rows', 'bot_rows']):
+        (lo, hi) = ip_range.get(row['url_route'], (None, None))
+        if (row['ok_rows'] == 0 and row['log_rows'] > 0 and
+                row['log_rows'] > row['bot_rows'] and lo != hi):
+            retval.append({'route': row['url_route'],
+                           'ok_reqs': row['ok_rows'],
+                           'bot_reqs': row['bot_rows'],
+                           'num_ips': max(num_ips[row['url_route']], 2),
+                           'total_reqs': row['log_rows']})
+    return retval
+
+
+def backfill(derived_reports, end_date, history_length, max_concurrent=5):
+    """Fill in missing days of reports computed from the fact table.
+
+    derived_reports maps a report name, as passed to save_daily_data, to
+    a function from a day's fact table to the rows saved for it.  For
+    each of the history_length days before end_date where one of the
+    reports is missing, we get the fact table -- running the queries
+    for days we don't have it, concurrently, see
+    bq_util.backfill_daily_data -- and save the reports' data.
+    """
+    dates = [(end_date - datetime.timedelta(i)).strftime("%Y%m%d")
+             for i in xrange(history_length, 0, -1)]
+    missing = [yyyymmdd for yyyymmdd in dates
+               if not all(bq_util.has_daily_data(report, yyyymmdd)
+                          for report in derived_reports)]
+    if not missing:
+        return
+    bq_util.backfill_daily_data({FACTS_REPORT: facts_query}, end_date,
+                                history_length, dates=missing,
+                                max_concurrent=max_concurrent)
+    for yyyymmdd in missing:
+        facts = bq_util.get_daily_data(FACTS_REPORT, yyyymmdd)
+        if facts is None:       # the backfill failed or had no logs
+            continue
+        for (report, fn) in derived_reports.iteritems():
+            if not bq_util.has_daily_data(report, yyyymmdd):
+                bq_util.save_daily_data(fn(facts), report, yyyymmdd)
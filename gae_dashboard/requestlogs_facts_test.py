@@ -0,0 +1,101 @@
+import unittest
+
+import requestlogs_facts
+
+
+def _fact(url_route, module_id='default', is_znd=False, **values):
+    row = {'url_route': url_route, 'module_id': module_id, 'is_znd': is_znd,
+           'requests': 0, 'dynamic_requests': 0, 'dynamic_latency': 0.0,
+           'log_rows': 0, 'ok_rows': 0, 'bot_rows': 0, 'num_ips': 0,
+           'min_ip': '(None)', 'max_ip': '(None)',
+           'oom_messages': 0, 'oom_requests': 0, 'oom_numserved': '(None)'}
+    row.update((column, 0) for column in requestlogs_facts.RPC_STATS)
+    row.update(values)
+    return row
+
+
+class TestDerivedReports(unittest.TestCase):
+    def test_instance_hours(self):
+        facts = [
+            _fact('/a', dynamic_requests=2, dynamic_latency=3600.0),
+            _fact('/a', module_id='batch', dynamic_requests=1,
+                  dynamic_latency=3600.0),
+            _fact('/a', is_znd=True, dynamic_requests=5,
+                  dynamic_latency=36000.0),
+            _fact('/b', dynamic_requests=1, dynamic_latency=36000.0),
+            _fact('/static', requests=10),
+        ]
+        self.assertEqual(
+            [{'url_route': '/b', 'count_': 1, 'instance_hours': 10.0},
+             {'url_route': '/a', 'count_': 3, 'instance_hours': 5.0}],
+            requestlogs_facts.instance_hours(facts,
+                                             {'default': 1, 'batch': 4}))
+
+    def test_rpcs(self):
+        facts = [
+            _fact('/a', requests=2, rpc_Get=4.0, rpc_cost=1.5),
+            _fact('/a', is_znd=True, requests=7, rpc_Get=1.0, rpc_cost=0.5),
+            _fact('/b', requests=1, rpc_Put=3.0, rpc_cost=3.0),
+        ]
+        rows = requestlogs_facts.rpcs(facts)
+        self.assertEqual(['/b', '/a'], [row['url_route'] for row in rows])
+        self.assertEqual(2, rows[1]['requests'])
+        self.assertEqual(5, rows[1]['rpc_Get'])
+        self.assertEqual(2.0, rows[1]['rpc_cost'])
+
+    def test_oom(self):
+        facts = [
+            _fact('/a', oom_messages=2, oom_requests=2,
+                  oom_numserved='100,300'),
+            _fact('/b', oom_messages=1, oom_requests=1,
+                  oom_numserved='200'),
+            _fact('/a', module_id='kotlin', oom_messages=1, oom_requests=1),
+            _fact('/a', is_znd=True, oom_messages=9, oom_requests=9,
+                  oom_numserved='1'),
+        ]
+        self.assertEqual(
+            [{'module_id': 'default', 'count_': 3, 'numserved_10th': 100,
+              'numserved_50th': 200, 'numserved_90th': 300},
+             {'module_id': 'kotlin', 'count_': 1, 'numserved_10th': '(None)',
+              'numserved_50th': '(None)', 'numserved_90th': '(None)'}],
+            requestlogs_facts.oom_by_module(facts))
+        self.assertEqual(
+            [{'module_id': 'default', 'url_route': '/a', 'count_': 2},
+             {'module_id': 'default', 'url_route': '/b', 'count_': 1},
+             {'module_id': 'kotlin', 'url_route': '/a', 'count_': 1}],
+            requestlogs_facts.oom_by_route(facts))
+
+    def test_failing_routes(self):
+        facts = [
+            # Failing, from two IPs across two rows.
+            _fact('/a', log_rows=3, num_ips=1, min_ip='1.1.1.1',
+                  max_ip='1.1.1.1'),
+            _fact('/a', module_id='batch', log_rows=1, num_ips=1,
+                  min_ip='2.2.2.2', max_ip='2.2.2.2'),
+            # Failing, but from only one IP (and some with none logged).
+            _fact('/b', log_rows=5, num_ips=1, min_ip='1.1.1.1',
+                  max_ip='1.1.1.1'),
+            _fact('/b', module_id='batch', log_rows=1),
+            # Failing, from three IPs, two of them in both rows.
+            _fact('/e', log_rows=3, num_ips=3, min_ip='1.1.1.1',
+                  max_ip='3.3.3.3'),
+            _fact('/e', module_id='batch', log_rows=2, num_ips=2,
+                  min_ip='1.1.1.1', max_ip='2.2.2.2'),
+            # Failing, but only for bots.
+            _fact('/c', log_rows=2, bot_rows=2, num_ips=2, min_ip='1.1.1.1',
+                  max_ip='2.2.2.2'),
+            # Not failing.
+            _fact('/d', log_rows=2, ok_rows=1, num_ips=2, min_ip='1.1.1.1',
+                  max_ip='2.2.2.2'),
+        ]
+        self.assertEqual(
+            [{'route': '/a', 'ok_reqs': 0, 'bot_reqs': 0, 'num_ips': 2,
+              'total_reqs': 4},
+             {'route': '/e', 'ok_reqs': 0, 'bot_reqs': 0, 'num_ips': 3,
+              'total_reqs': 5}],
+            sorted(requestlogs_facts.failing_routes(facts),
+                   key=lambda row: row['route']))
+
+
+if __name__ == '__main__':
+    unittest.main()
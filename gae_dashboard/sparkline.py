@@ -0,0 +1,121 @@
+"""Render sparklines -- small, axis-less line plots -- to PNGs.
+
+The reports in email_bq_data put a sparkline of the last two weeks in
+some table cells.  We used to have gnuplot draw each one, which meant a
+process per cell (hundreds per night) and a dependency on gnuplot.  This
+draws the same plot in pure python: it rasterizes the line, anti-aliased,
+into a grayscale bitmap, and writes that out as a zlib-compressed PNG.
+"""
+
+import struct
+import zlib
+
+
+_PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def _encode_png(pixels, width, height):
+    """Return a grayscale PNG, given a bytearray of rows of pixels."""
+    # Each row of the image data starts with its filter type; we use 0
+    # (none), which zlib does fine with for images this simple.
+    raw = ''.join('\x00' + str(pixels[y * width:(y + 1) * width])
+                  for y in xrange(height))
+    return ''.join([
+        _PNG_SIGNATURE,
+        # 8-bit depth, color type 0 (grayscale), default compression,
+        # filtering and interlacing.
+        _png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                       8, 0, 0, 0, 0)),
+        _png_chunk('IDAT', zlib.compress(raw, 9)),
+        _png_chunk('IEND', ''),
+    ])
+
+
+class _Canvas(object):
+    """A grayscale bitmap that we draw anti-aliased black lines on.
+
+    We keep each pixel's coverage -- how much of it the line covers,
+    from 0 to 1 -- and take the max where segments overlap, so the joins
+    between segments don't come out darker than the segments.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.coverage = [0.0] * (width * height)
+
+    def _plot(self, x, y, coverage):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            i = y * self.width + x
+            if coverage > self.coverage[i]:
+                self.coverage[i] = coverage
+
+    def line(self, x0, y0, x1, y1):
+        """Draw a line between two points, in (fractional) pixels.
+
+        This is Xiaolin Wu's algorithm: we step along the major axis one
+        pixel at a time, and split the ink between the two pixels the
+        line passes between on the minor axis.  Parts of the line off
+        the canvas are clipped.  Unlike Wu, we ink the end pixels fully,
+        so the joins between the segments of a sparkline aren't faint.
+        """
+        steep = abs(y1 - y0) > abs(x1 - x0)
+        if steep:
+            (x0, y0, x1, y1) = (y0, x0, y1, x1)
+        if x0 > x1:
+            (x0, y0, x1, y1) = (x1, y1, x0, y0)
+        dx = x1 - x0
+        gradient = (y1 - y0) / dx if dx else 1.0
+
+        for x in xrange(int(round(x0)), int(round(x1)) + 1):
+            y = y0 + gradient * (x - x0)
+            y_floor = int(y // 1)
+            frac = y - y_floor
+            for (minor, coverage) in ((y_floor, 1 - frac),
+                                      (y_floor + 1, frac)):
+                if steep:
+                    self._plot(minor, x, coverage)
+                else:
+                    self._plot(x, minor, coverage)
+
+    def to_png(self):
+        pixels = bytearray(255 - int(round(255 * min(c, 1.0)))
+                           for c in self.coverage)
+        return _encode_png(pixels, self.width, self.height)
+
+
+def render_png(data, width=100, height=20):
+    """Render a list of values as a sparkline, and return the PNG contents.
+
+    A datapoint may be None if it should be omitted; the line is broken
+    there.  This draws what _render_sparkline in email_bq_data used to
+    ask gnuplot for: black lines on white, no border, axes or margins,
+    x running from 1 to len(data) (so the first point only sets where
+    the line comes in from the left edge) and y from -5% to 105% of the
+    largest value.  It returns None if data has no positive values to
+    scale by.
+    """
+    existing_data = [datum for datum in data if datum is not None]
+    if not existing_data or max(existing_data) <= 0:
+        return None
+    ymax = 1.05 * max(existing_data)
+    ymin = -0.05 * max(existing_data)
+    (xmin, xmax) = (1, max(len(data), 2))
+
+    def to_pixels(i, datum):
+        # Pixel centers run from 0 to width - 1, and from height - 1 at
+        # the bottom to 0 at the top.
+        return ((i - xmin) * (width - 1.0) / (xmax - xmin),
+                (ymax - datum) * (height - 1.0) / (ymax - ymin))
+
+    canvas = _Canvas(width, height)
+    for i in xrange(len(data) - 1):
+        if data[i] is not None and data[i + 1] is not None:
+            (x0, y0) = to_pixels(i, data[i])
+            (x1, y1) = to_pixels(i + 1, data[i + 1])
+            canvas.line(x0, y0, x1, y1)
+    return canvas.to_png()
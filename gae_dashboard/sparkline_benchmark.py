@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""Time rendering sparklines in python (sparkline.py) versus with gnuplot.
+
+This renders a night's worth of random two-week sparklines both ways,
+and reports the time per image and the image sizes.  gnuplot is only
+timed if it's installed.  With --outdir, it also writes the first few
+images from each renderer there, so you can eyeball them side by side.
+Run as
+    ./sparkline_benchmark.py [--count N] [--outdir DIR]
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import textwrap
+import time
+
+import sparkline
+
+
+def render_with_gnuplot(data, width=100, height=20):
+    """Render a sparkline the way email_bq_data used to: with gnuplot."""
+    existing_data = [datum for datum in data if datum is not None]
+    data_lines = []
+    for i, datum in enumerate(data):
+        if datum is None:
+            data_lines.append("")
+        else:
+            data_lines.append("%s %s" % (i, datum))
+    gnuplot_script = textwrap.dedent(
+        """\
+        unset border
+        unset xtics
+        unset ytics
+        unset key
+        set lmargin 0
+        set rmargin 0
+        set tmargin 0
+        set bmargin 0
+        set yrange [%(ymin)s:%(ymax)s]
+        set xrange [%(xmin)s:%(xmax)s]
+        set terminal pngcairo size %(width)s,%(height)s
+        plot "-" using 1:2 notitle with lines linetype rgb "black"
+        %(data)s
+        e
+        """
+    ) % {
+        'data': '\n'.join(data_lines),
+        'ymax': 1.05 * max(existing_data),
+        'ymin': -0.05 * max(existing_data),
+        'xmin': 1,
+        'xmax': len(data),
+        'width': width,
+        'height': height,
+    }
+    gnuplot_proc = subprocess.Popen(['gnuplot'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+    png, _ = gnuplot_proc.communicate(gnuplot_script)
+    return png
+
+
+def _have_gnuplot():
+    try:
+        subprocess.check_call(['gnuplot', '--version'],
+                              stdout=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def _random_series(rng, days=14):
+    """Return a two-week series like the reports', with the odd gap."""
+    level = rng.uniform(1, 1000)
+    return [None if rng.random() < 0.05
+            else level * rng.uniform(0.5, 1.5)
+            for _ in xrange(days)]
+
+
+def _time_renderer(render, series):
+    start = time.time()
+    images = [render(data) for data in series]
+    return (time.time() - start, images)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=500,
+                        help='How many sparklines to render '
+                             '(default %(default)s)')
+    parser.add_argument('--outdir',
+                        help='Write a few of the images here, to compare')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the data (default %(default)s)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    series = [_random_series(rng) for _ in xrange(args.count)]
+
+    renderers = [('python', sparkline.render_png)]
+    if _have_gnuplot():
+        renderers.append(('gnuplot', render_with_gnuplot))
+    else:
+        print 'gnuplot is not installed; only timing the python renderer.'
+
+    print '%-10s %12s %12s' % ('renderer', 'ms/image', 'avg bytes')
+    for (name, render) in renderers:
+        (secs, images) = _time_renderer(render, series)
+        print '%-10s %12.2f %12d' % (
+            name, 1000.0 * secs / len(series),
+            sum(len(image) for image in images) / len(images))
+        if args.outdir:
+            if not os.path.isdir(args.outdir):
+                os.makedirs(args.outdir)
+            for (i, image) in enumerate(images[:10]):
+                with open(os.path.join(args.outdir, '%s_%d.png' % (name, i)),
+                          'wb') as f:
+                    f.write(image)
+
+
+if __name__ == '__main__':
+    main()
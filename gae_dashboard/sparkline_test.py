@@ -0,0 +1,61 @@
+import struct
+import unittest
+import zlib
+
+import sparkline
+
+
+def _decode(png):
+    """Return (width, height, rows of pixel values) for our PNGs."""
+    assert png.startswith('\x89PNG\r\n\x1a\n')
+    pos = 8
+    chunks = {}
+    while pos < len(png):
+        (length,) = struct.unpack('>I', png[pos:pos + 4])
+        chunk_type = png[pos + 4:pos + 8]
+        data = png[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack('>I', png[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(chunk_type + data) & 0xffffffff
+        chunks[chunk_type] = data
+        pos += 12 + length
+    (width, height, depth, color_type) = struct.unpack(
+        '>IIBB', chunks['IHDR'][:10])
+    assert (depth, color_type) == (8, 0)
+    raw = zlib.decompress(chunks['IDAT'])
+    rows = [bytearray(raw[y * (width + 1) + 1:(y + 1) * (width + 1)])
+            for y in xrange(height)]
+    return (width, height, rows)
+
+
+class TestRenderPng(unittest.TestCase):
+    def test_size(self):
+        (width, height, rows) = _decode(sparkline.render_png([1, 2, 3, 4]))
+        self.assertEqual((100, 20), (width, height))
+        self.assertEqual(20, len(rows))
+
+    def test_flat_line(self):
+        # A constant series is drawn 1/22 of the way down.  x runs from
+        # 1 to len(data), so the second point is at the left edge, and
+        # the last is in the middle.
+        (_, _, rows) = _decode(sparkline.render_png([5, 5, 5], 11, 23))
+        dark_rows = [y for (y, row) in enumerate(rows) if min(row) < 128]
+        self.assertEqual([1], dark_rows)
+        self.assertEqual([0] * 6 + [255] * 5, list(rows[1]))
+
+    def test_gaps(self):
+        (_, _, rows) = _decode(sparkline.render_png([1, 1, None, 1, 1],
+                                                    41, 10))
+        columns_drawn = [x for x in xrange(41)
+                         if min(row[x] for row in rows) < 255]
+        # The points are at x=0, 10, 20 and 30 (the first is off the
+        # left edge); the lines to and from the missing one aren't drawn.
+        self.assertNotIn(10, columns_drawn)
+        self.assertIn(25, columns_drawn)
+
+    def test_no_data(self):
+        self.assertIsNone(sparkline.render_png([None, None, None]))
+        self.assertIsNone(sparkline.render_png([0, 0, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()